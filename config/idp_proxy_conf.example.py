@@ -85,6 +85,7 @@ SERVICE = {
         "authorization_endpoint": "https://accounts.google.com/o/oauth2/auth",
         "token_endpoint": "https://accounts.google.com/o/oauth2/token",
         "verification_endpoint": "https://www.googleapis.com/oauth2/v1/tokeninfo",
+        "jwks_uri": "https://www.googleapis.com/oauth2/v3/certs",
         "userinfo_endpoint": "https://www.googleapis.com/oauth2/v1/userinfo",
         "scope": ["https://www.googleapis.com/auth/userinfo.profile",
                   "https://www.googleapis.com/auth/userinfo.email"],
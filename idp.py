@@ -5,9 +5,21 @@ import urlparse
 import argparse
 import idpproxy
 
+from collections import OrderedDict
+
+from idpproxy import binding
 from idpproxy import idp_srv
 from idpproxy import utils
+from idpproxy.assets import ASSETS
+from idpproxy.metadata.secret import CONST_STATIC_FILE
 from idpproxy.metadata.secret import MetadataGeneration
+from idpproxy.metadata.ondemand import MetaDataOnDemand
+from idpproxy.metadata import snapshot
+from idpproxy.social import HandlerRegistry
+from idpproxy.social import transport
+from idpproxy.social.breaker import BREAKERS
+from idpproxy.social import offload
+from idpproxy.social.openidconnect.provider import REGISTRATIONS
 
 from saml2 import server
 from saml2 import BINDING_HTTP_REDIRECT
@@ -15,6 +27,9 @@ from saml2 import BINDING_HTTP_REDIRECT
 from saml2.eptid import EptidShelve
 
 from idpproxy import cache
+from idpproxy import router
+from idpproxy import sign
+from idpproxy import template
 
 # ----------------------------------------------------------------------------
 from saml2.config import LOG_LEVEL
@@ -91,6 +106,10 @@ def application(environ, start_response):
     _logger.propagate = False
     _logger.info("%s %s" % (environ.get("REQUEST_METHOD", ''), path))
 
+    route, arg = SERVER_ENV["router"](path)
+    if route == router.STATIC:
+        return idpproxy.static(environ, start_response, arg)
+
     kaka = environ.get("HTTP_COOKIE", '')
     logger.debug("Cookie: %s" % (kaka,))
 
@@ -104,13 +123,7 @@ def application(environ, start_response):
 
     logger.debug("SID: %s" % sid)
 
-    if idpproxy.static_file(SERVER_ENV, path):
-        return idpproxy.static(environ, start_response,
-                               SERVER_ENV["STATIC_DIR"] + path)
-    elif idpproxy.metadata_file(SERVER_ENV, path):
-        return idpproxy.static(environ, start_response,
-                               SERVER_ENV["METADATA_DIR"] + path)
-    if path == BASE:
+    if route == router.BASE:
         user = environ.get("REMOTE_USER", "")
 #        if not user:
 #            user = environ.get("repoze.who.identity", "")
@@ -122,18 +135,22 @@ def application(environ, start_response):
             logger.debug("-- No USER --")
             #return idpproxy.not_found(environ, start_response)
             return idpproxy.not_authn(environ, start_response)
-    elif path.startswith("/logo/"):
+    elif route == router.LOGO:
         environ['idpproxy.url_args'] = "." + path
         return idp_srv.logo(environ, start_response, SERVER_ENV)
-    elif path == "/logout":
+    elif route == router.LOGOUT:
         return idp_srv.logout(environ, start_response, sid, SERVER_ENV)
-    elif GENERATE_METADATA is not None and GENERATE_METADATA.verify_handle_request(
-            path):
+    elif route == router.STATUS:
+        return idp_srv.status(environ, start_response, SERVER_ENV)
+    elif route == router.METADATA and GENERATE_METADATA is not None:
         return GENERATE_METADATA.handle_request(environ, start_response, path)
-    else:
+    elif route == router.SERVICE:
         environ['idpproxy.url_args'] = ""
         return idp_srv.auth_choice(path, environ, start_response, sid,
-                                   SERVER_ENV)
+                                   SERVER_ENV, route=arg)
+    else:
+        return idp_srv.not_found(environ, start_response,
+                                 'Unknown service: %s' % path)
 
 # ----------------------------------------------------------------------------
 __author__ = 'rohe0002'
@@ -167,7 +184,27 @@ def setup_server_env(proxy_conf, conf_mod, key):
 
     SERVER_ENV["eptid"] = EptidShelve(proxy_conf.SECRET, proxy_conf.EPTID_DB)
 
-    _idp = server.Server(conf_mod)
+    if SERVER_ENV.get("METADATA_SNAPSHOT"):
+        snap = snapshot.Snapshot(SERVER_ENV["METADATA_SNAPSHOT"], conf_mod,
+                                 key)
+        _idp = server.Server(config=snap.config())
+    else:
+        snap = None
+        _idp = server.Server(conf_mod)
+    if SERVER_ENV.get("SIGN_IN_PROCESS"):
+        _idp.sec.crypto = sign.InProcessBackend(_idp.sec.key_file,
+                                                _idp.sec.crypto)
+    mds = _idp.metadata
+    if SERVER_ENV.get("METADATA_ON_DEMAND"):
+        # The sources are searched in order, so the on demand sources are
+        # only asked about entities that aren't in the metadata loaded at
+        # startup
+        mds.metadata = OrderedDict(sorted(mds.metadata.items()))
+    for spec in SERVER_ENV.get("METADATA_ON_DEMAND", []):
+        spec = spec.copy()
+        mds.metadata[spec["source"]] = MetaDataOnDemand(
+            mds.onts, mds.attrc, spec.pop("source"), security=mds.security,
+            http=mds.http, **spec)
 
     if key:
         rsa_key = RSAKey(key=key)
@@ -175,11 +212,44 @@ def setup_server_env(proxy_conf, conf_mod, key):
     else:
         rsa_key = None
 
-    args = {"metad": _idp.metadata, "dkeys": [rsa_key]}
+    args = {"metad": _idp.metadata, "dkeys": [rsa_key],
+            "eager": SERVER_ENV.get("CONSUMER_INFO_EAGER", False),
+            "processes": SERVER_ENV.get("CONSUMER_INFO_PROCESSES"),
+            "memo": snap.memo if snap else None}
 
     SERVER_ENV["consumer_info"] = utils.ConsumerInfo(proxy_conf.CONSUMER_INFO,
                                                      **args)
+    if snap and snap.stale:
+        memo = {}
+        for src in SERVER_ENV["consumer_info"].info:
+            if isinstance(src, utils.MetadataInfo):
+                memo = src.memo()
+        snap.save(_idp.metadata, memo)
     SERVER_ENV["service"] = proxy_conf.SERVICE
+    SERVER_ENV["bindings"] = binding.BindingCache(_idp)
+    if SERVER_ENV.get("RESPONSE_TEMPLATES"):
+        SERVER_ENV["templates"] = template.ResponseTemplates(_idp)
+    SERVER_ENV["transport"] = transport.Transport(
+        pool_size=SERVER_ENV.get("HTTP_POOL_SIZE", transport.POOL_SIZE),
+        idle_timeout=SERVER_ENV.get("HTTP_IDLE_TIMEOUT",
+                                    transport.IDLE_TIMEOUT),
+        timeout=SERVER_ENV.get("HTTP_TIMEOUT", transport.TIMEOUT))
+    REGISTRATIONS.filename = SERVER_ENV.get("OIC_REGISTRATION_DB")
+    BREAKERS.kwargs.update(SERVER_ENV.get("CIRCUIT_BREAKER", {}))
+    if SERVER_ENV.get("OFFLOAD_WORKERS"):
+        if proxy_conf.CACHE == "cookie":
+            # The workers can't see a session that is kept in the cookie
+            logger.warning("OFFLOAD_WORKERS can't be used with a cookie cache")
+        else:
+            SERVER_ENV["offload"] = offload.OffloadQueue(
+                SERVER_ENV["OFFLOAD_WORKERS"],
+                SERVER_ENV.get("OFFLOAD_MAX_PENDING", offload.MAX_PENDING),
+                wait=SERVER_ENV.get("OFFLOAD_WAIT", offload.WAIT))
+    SERVER_ENV["handlers"] = HandlerRegistry(
+        proxy_conf.SERVICE, DOMAIN=proxy_conf.DOMAIN,
+        transport=SERVER_ENV["transport"])
+    # Handlers are made per consumer key and secret
+    SERVER_ENV["consumer_info"].listeners.append(SERVER_ENV["handlers"].clear)
 
     # add the service endpoints
     part = urlparse.urlparse(_idp.config.entityid)
@@ -216,15 +286,19 @@ def setup_server_env(proxy_conf, conf_mod, key):
     SERVER_ENV["STATIC_DIR"] = proxy_conf.STATIC_DIR
     SERVER_ENV["METADATA_DIR"] = proxy_conf.METADATA_DIR
     SERVER_ENV["SIGN"] = proxy_conf.SIGN
+    SERVER_ENV["router"] = router.router_factory(SERVER_ENV)
+
+    ASSETS.check_interval = SERVER_ENV.get("STATIC_CHECK_INTERVAL",
+                                           ASSETS.check_interval)
+    for _dir in [proxy_conf.STATIC_DIR, proxy_conf.METADATA_DIR,
+                 CONST_STATIC_FILE]:
+        ASSETS.preload(_dir)
 
     #print SERVER_ENV
-    if proxy_conf.CACHE == "memory":
-        SERVER_ENV["CACHE"] = cache.Cache(SERVER_ENV["SERVER_NAME"],
-                                          SERVER_ENV["SECRET"])
-    elif proxy_conf.CACHE.startswith("file:"):
-        SERVER_ENV["CACHE"] = cache.Cache(SERVER_ENV["SERVER_NAME"],
-                                          SERVER_ENV["SECRET"],
-                                          filename=proxy_conf.CACHE[5:])
+    SERVER_ENV["CACHE"] = cache.factory(
+        proxy_conf.CACHE, SERVER_ENV["SERVER_NAME"], SERVER_ENV["SECRET"],
+        lifetime=SERVER_ENV.get("CACHE_LIFETIME", cache.LIFETIME),
+        max_size=SERVER_ENV.get("CACHE_MAX_SIZE", cache.MAX_SIZE))
 
     logger = setup_logger(_idp.config)
     if proxy_conf.DEBUG:
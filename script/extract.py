@@ -1,21 +1,204 @@
 #!/usr/bin/env python
-from saml2 import md
+"""
+Extracts entity descriptors from a metadata aggregate. The aggregate is
+read as a stream and every entity descriptor is thrown away as soon as it
+has been looked at, so memory use doesn't grow with the size of the
+aggregate.
+"""
+import re
 import sys
-from saml2.md import EntitiesDescriptor
+import argparse
+
+from xml.etree import cElementTree as ElementTree
+from xml.sax.saxutils import quoteattr
 
 __author__ = 'rolandh'
 
-xml_str = open(sys.argv[1]).read()
+MD_NS = "urn:oasis:names:tc:SAML:2.0:metadata"
+MDRPI_NS = "urn:oasis:names:tc:SAML:metadata:rpi"
+
+ENTITIES_DESCRIPTOR = "{%s}EntitiesDescriptor" % MD_NS
+ENTITY_DESCRIPTOR = "{%s}EntityDescriptor" % MD_NS
+REGISTRATION_INFO = "{%s}Extensions/{%s}RegistrationInfo" % (MD_NS, MDRPI_NS)
+
+# Attributes of the aggregate that are kept
+KEEP_ATTRIBUTES = ["Name", "validUntil", "cacheDuration"]
+
+
+def read_ids(filename):
+    """ One entity ID per line, empty lines and lines starting with # are
+    skipped """
+    ids = set()
+    for line in open(filename):
+        line = line.strip()
+        if line and not line.startswith("#"):
+            ids.add(line)
+    return ids
+
+
+def registrar(elem):
+    info = elem.find(REGISTRATION_INFO)
+    if info is None:
+        return None
+    return info.get("registrationAuthority")
+
+
+class Filter(object):
+    def __init__(self, ids=None, patterns=None, registrars=None):
+        """
+        :param ids: Entity IDs to keep
+        :param patterns: Regular expressions, entity IDs that match one of
+            them are kept
+        :param registrars: If given only entities registered by one of these
+            are kept
+        """
+        self.ids = set(ids or [])
+        self.patterns = [re.compile(p) for p in patterns or []]
+        self.registrars = set(registrars or [])
+
+    def __call__(self, elem):
+        if self.registrars and registrar(elem) not in self.registrars:
+            return False
+        if not self.ids and not self.patterns:
+            return True
+        entity_id = elem.get("entityID")
+        if entity_id in self.ids:
+            return True
+        for pattern in self.patterns:
+            if pattern.search(entity_id):
+                return True
+        return False
+
+
+def declare(xml, namespaces):
+    """
+    ElementTree only declares the namespaces used in element and attribute
+    names. Prefixes that are only used in values, like xsi:type="xs:string",
+    would be left undeclared, so the namespaces that were in scope in the
+    aggregate are declared on the element too.
+
+    :param xml: A serialized element
+    :param namespaces: (prefix, uri) tuples
+    :return: The element with the missing declarations added
+    """
+    end = xml.index(">")
+    if xml[end - 1] == "/":
+        end -= 1
+    declared = set(re.findall(r"xmlns:([^=\s]+)=", xml[:end]))
+    decls = []
+    for prefix, uri in namespaces:
+        if prefix and prefix not in declared:
+            declared.add(prefix)
+            decls.append(" xmlns:%s=%s" % (prefix, quoteattr(uri)))
+    return xml[:end] + "".join(decls) + xml[end:]
+
+
+def extract(source, keep, out):
+    """
+    :param source: File name or file object of the aggregate
+    :param keep: Called with every EntityDescriptor element, returns True
+        if it should be kept
+    :param out: Where the new aggregate is written
+    :return: The number of entities kept
+    """
+    # uri -> prefix as used in the aggregate
+    prefixes = {}
+    # Parents of the element being parsed
+    stack = []
+    # The namespaces declared on each of them
+    scopes = []
+    # Declared since the last start event
+    pending = []
+    # The entity being parsed and the namespaces declared within it
+    entity = None
+    inner = []
+    end = ""
+    count = 0
+
+    for event, elem in ElementTree.iterparse(source,
+                                             events=("start-ns", "start",
+                                                     "end")):
+        if event == "start-ns":
+            prefix, uri = elem
+            prefixes.setdefault(uri, prefix)
+            pending.append((prefix, uri))
+            if entity is not None:
+                inner.append((prefix, uri))
+            if prefix:
+                try:
+                    # So that the entities are written with the prefixes
+                    # they had
+                    ElementTree.register_namespace(prefix, uri)
+                except ValueError:
+                    pass
+        elif event == "start":
+            if not stack and elem.tag == ENTITIES_DESCRIPTOR:
+                prefix = prefixes.get(MD_NS) or "md"
+                attrs = "".join([" %s=%s" % (attr, quoteattr(elem.get(attr)))
+                                 for attr in KEEP_ATTRIBUTES
+                                 if elem.get(attr) is not None])
+                out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+                out.write('<%s:EntitiesDescriptor xmlns:%s="%s"%s>\n' % (
+                    prefix, prefix, MD_NS, attrs))
+                end = "</%s:EntitiesDescriptor>\n" % prefix
+            if elem.tag == ENTITY_DESCRIPTOR:
+                entity = elem
+                inner = list(pending)
+            stack.append(elem)
+            scopes.append(pending)
+            pending = []
+        else:
+            stack.pop()
+            scopes.pop()
+            if elem.tag != ENTITY_DESCRIPTOR:
+                continue
+            entity = None
+            if keep(elem):
+                elem.tail = None
+                namespaces = [ns for scope in scopes for ns in scope] + inner
+                out.write(declare(ElementTree.tostring(elem, encoding="utf-8"),
+                                  namespaces))
+                out.write("\n")
+                count += 1
+            # Done with it, so memory use stays the same
+            elem.clear()
+            if stack:
+                stack[-1].remove(elem)
+
+    out.write(end)
+    return count
+
 
-entities_descr = md.entities_descriptor_from_string(xml_str)
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-f", dest="id_file", action="append", default=[],
+                        help="A file with entity IDs to keep, one per line")
+    parser.add_argument("-r", dest="regex", action="append", default=[],
+                        help="Keep entities whose entity ID matches this "
+                             "regular expression")
+    parser.add_argument("-a", dest="registrar", action="append", default=[],
+                        help="Only keep entities registered by this "
+                             "registration authority")
+    parser.add_argument("-o", dest="output", help="Output file")
+    parser.add_argument("metadata", help="The metadata aggregate")
+    parser.add_argument("entity_id", nargs="*", help="Entity IDs to keep")
+    args = parser.parse_args(args)
 
-keep = sys.argv[2:]
-eds = []
+    ids = set(args.entity_id)
+    for filename in args.id_file:
+        ids.update(read_ids(filename))
 
-for entity_descr in entities_descr.entity_descriptor:
-    if entity_descr.entity_id in keep:
-        eds.append(entity_descr)
+    if args.output:
+        out = open(args.output, "w")
+    else:
+        out = sys.stdout
+    try:
+        count = extract(args.metadata, Filter(ids, args.regex, args.registrar),
+                        out)
+    finally:
+        if args.output:
+            out.close()
+    print >> sys.stderr, "%d entities extracted" % count
 
-print EntitiesDescriptor(name=entities_descr.name, entity_descriptor=eds,
-                         valid_until = entities_descr.valid_until,
-                         cache_duration=entities_descr.cache_duration)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
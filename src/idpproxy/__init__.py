@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 __author__ = 'rolandh'
 
-import os
 import sys
 import urlparse
 import traceback
@@ -28,6 +27,9 @@ from saml2.httputil import unpack_artifact
 from saml2.s_utils import UnknownPrincipal
 from saml2.s_utils import UnsupportedBinding
 
+from idpproxy.assets import ASSETS
+from idpproxy.login import LoginContext
+
 logger = logging.getLogger(__name__)
 
 # ----------------------------------------------------------------------------
@@ -62,6 +64,14 @@ def cgi_field_storage_to_dict(field_storage):
 # ----------------------------------------------------------------------------
 
 
+def pick_binding(server_env, service, bindings=None, entity_id=""):
+    """ Uses the binding cache if there is one """
+    if "bindings" in server_env:
+        return server_env["bindings"](service, bindings, entity_id=entity_id)
+    return server_env["idp"].pick_binding(service, bindings,
+                                          entity_id=entity_id)
+
+
 #noinspection PyUnusedLocal
 def logout_response(server_env, req_info, status=None):
     logger.info("LOGOUT of '%s' by '%s'" % (req_info.subject_id(),
@@ -70,9 +80,9 @@ def logout_response(server_env, req_info, status=None):
     _idp = server_env["idp"]
     if req_info.binding != BINDING_SOAP:
         bindings = [BINDING_HTTP_REDIRECT, BINDING_HTTP_POST]
-        binding, destination = _idp.pick_binding("single_logout_service",
-                                                 bindings,
-                                                 entity_id=req_info.sender())
+        binding, destination = pick_binding(server_env,
+                                            "single_logout_service", bindings,
+                                            entity_id=req_info.sender())
         bindings = [binding]
     else:
         bindings = [BINDING_SOAP]
@@ -91,6 +101,7 @@ def logout_response(server_env, req_info, status=None):
 def err_response(server_env, req_info, info,
                  endpoint="assertion_consumer_service"):
     """
+    :param req_info: A LoginContext instance
     :param info: Either an exception or and 2-tuple (SAML error code, txt)
     """
 
@@ -98,14 +109,14 @@ def err_response(server_env, req_info, info,
 
     if req_info.binding != BINDING_SOAP:
         bindings = [BINDING_HTTP_REDIRECT, BINDING_HTTP_POST]
-        binding, destination = _idp.pick_binding(endpoint, bindings,
-                                                 entity_id=req_info.sender())
+        binding, destination = pick_binding(server_env, endpoint, bindings,
+                                            entity_id=req_info.sender())
         bindings = [binding]
     else:
         bindings = [BINDING_SOAP]
         destination = ""
 
-    err_resp = _idp.create_error_response(req_info.message.id, destination,
+    err_resp = _idp.create_error_response(req_info.id, destination,
                                           info, issuer=req_info.sender())
 
     logger.info("ErrResponse: %s" % err_resp)
@@ -131,19 +142,25 @@ def authn_response(server_env, req_info, userid, identity,
     logger.info("ISSUER: %s" % issuer)
     _idp = server_env["idp"]
 
-    binding, destination = _idp.pick_binding("assertion_consumer_service",
-                                             entity_id=req_info.sender())
+    binding, destination = pick_binding(server_env,
+                                        "assertion_consumer_service",
+                                        entity_id=req_info.sender())
 
     logger.debug("binding: %s, destination: %s" % (binding, destination))
 
-    authn_resp = _idp.create_authn_response(identity, req_info.message.id,
-                                            destination,
-                                            req_info.sender(),
-                                            req_info.message.name_id_policy,
-                                            str(userid), authn=authn, 
-                                            sign_assertion=server_env["SIGN"],
-                                            authn_decl=authn_decl,
-                                            issuer=issuer)
+    if "templates" in server_env:
+        create_authn_response = server_env["templates"]
+    else:
+        create_authn_response = _idp.create_authn_response
+
+    authn_resp = create_authn_response(identity, req_info.id,
+                                       destination,
+                                       req_info.sender(),
+                                       req_info.name_id_policy,
+                                       str(userid), authn=authn,
+                                       sign_assertion=server_env["SIGN"],
+                                       authn_decl=authn_decl,
+                                       issuer=issuer)
 
     logger.info("LOGIN success: sp_entity_id=%s#authn=%s" % (req_info.sender(),
                                                              authn))
@@ -254,8 +271,8 @@ def return_active_info(environ, start_response, server_env, state):
     #def do_req_response(req_info, response, _environ, source, session,
     #service):
 
-    resp = do_req_response(server_env, req_info, identity, environ, authn_auth, 
-                           session)
+    resp = do_req_response(server_env, LoginContext.from_request(req_info),
+                           identity, environ, authn_auth, session)
     return resp(environ, start_response)
 
 # ----------------------------------------------------------------------------
@@ -426,36 +443,8 @@ def authn_init(environ, start_response, server_env, state, _debug,
 # ----------------------------------------------------------------------------
 
 
-def static_file(server_env, path):
-    try:
-        os.stat(server_env["STATIC_DIR"]+path)
-        return True
-    except OSError:
-        return False
-
-
-def metadata_file(server_env, path):
-    try:
-        os.stat(server_env["METADATA_DIR"]+path)
-        return True
-    except OSError:
-        return False
-
-
 def static(environ, start_response, path):
-    try:
-        text = open(path).read()
-        if path.endswith(".ico"):
-            resp = Response(text, headers=[('Content-Type', "image/x-icon")])
-        elif path.endswith(".html"):
-            resp = Response(text, headers=[('Content-Type', 'text/html')])
-        elif path.endswith(".txt"):
-            resp = Response(text, headers=[('Content-Type', 'text/plain')])
-        else:
-            resp = Response(text, headers=[('Content-Type', 'text/xml')])
-    except IOError:
-        resp = NotFound()
-    return resp(environ, start_response)
+    return ASSETS(environ, start_response, path)
 
 # ----------------------------------------------------------------------------
 #
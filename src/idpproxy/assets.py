@@ -0,0 +1,251 @@
+import os
+import gzip
+import time
+import hashlib
+import logging
+import threading
+
+from cStringIO import StringIO
+from email.utils import formatdate
+from email.utils import mktime_tz
+from email.utils import parsedate_tz
+
+from saml2.httputil import NotFound
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = {
+    ".ico": "image/x-icon",
+    ".png": "image/png",
+    ".gif": "image/gif",
+    ".jpg": "image/jpeg",
+    ".html": "text/html",
+    ".txt": "text/plain",
+    ".css": "text/css",
+    ".js": "application/javascript",
+}
+DEFAULT_CONTENT_TYPE = "text/xml"
+
+# Content types that gain nothing from being compressed
+UNCOMPRESSED = ["image/png", "image/gif", "image/jpeg"]
+# Files smaller than this are not worth compressing
+MIN_COMPRESS_SIZE = 256
+
+
+def content_type(path):
+    return CONTENT_TYPE.get(os.path.splitext(path)[1], DEFAULT_CONTENT_TYPE)
+
+
+def gzip_compress(data):
+    buf = StringIO()
+    # mtime=0 makes the output only depend on the data
+    _gz = gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=9, mtime=0)
+    _gz.write(data)
+    _gz.close()
+    return buf.getvalue()
+
+
+def accepted_encodings(header):
+    """
+    :param header: The value of the Accept-Encoding header
+    :return: The set of content codings the client accepts
+    """
+    res = set()
+    for part in header.split(","):
+        items = part.strip().split(";")
+        coding = items[0].strip().lower()
+        if not coding:
+            continue
+        qvalue = 1.0
+        for param in items[1:]:
+            param = param.strip()
+            if param.startswith("q="):
+                try:
+                    qvalue = float(param[2:])
+                except ValueError:
+                    qvalue = 0.0
+        if qvalue > 0:
+            res.add(coding)
+    return res
+
+
+class Asset(object):
+    """ A static file kept in memory together with its validators and
+    precompressed variants """
+
+    def __init__(self, path, data, stat):
+        self.path = path
+        self.mtime = stat.st_mtime
+        self.size = stat.st_size
+        self.inode = stat.st_ino
+        self.checked = time.time()
+        self.content_type = content_type(path)
+        self.last_modified = formatdate(self.mtime, usegmt=True)
+        _digest = hashlib.sha1(data).hexdigest()
+
+        # coding -> (data, etag)
+        self.variants = {"identity": (data, '"%s"' % _digest)}
+        if len(data) >= MIN_COMPRESS_SIZE and \
+                self.content_type not in UNCOMPRESSED:
+            _gz = gzip_compress(data)
+            if len(_gz) < len(data):
+                self.variants["gzip"] = (_gz, '"%s-gz"' % _digest)
+            if brotli is not None:
+                _br = brotli.compress(data)
+                if len(_br) < len(data):
+                    self.variants["br"] = (_br, '"%s-br"' % _digest)
+
+    def modified(self, stat):
+        return (self.mtime != stat.st_mtime or self.size != stat.st_size or
+                self.inode != stat.st_ino)
+
+    def select(self, accept_encoding):
+        """
+        :param accept_encoding: The value of the Accept-Encoding header
+        :return: The content coding to use
+        """
+        if len(self.variants) > 1 and accept_encoding:
+            _accepted = accepted_encodings(accept_encoding)
+            for coding in ["br", "gzip"]:
+                if coding in self.variants and coding in _accepted:
+                    return coding
+        return "identity"
+
+    def not_modified(self, environ, etag):
+        """
+        Evaluates the conditional request headers.
+
+        :return: True if the client already has the current version
+        """
+        inm = environ.get("HTTP_IF_NONE_MATCH")
+        if inm:
+            for tag in inm.split(","):
+                tag = tag.strip()
+                if tag.startswith("W/"):
+                    tag = tag[2:]
+                if tag == "*" or tag == etag:
+                    return True
+            # If-Modified-Since must be ignored if If-None-Match is present
+            return False
+
+        ims = environ.get("HTTP_IF_MODIFIED_SINCE")
+        if ims:
+            _date = parsedate_tz(ims)
+            if _date is not None:
+                try:
+                    return int(self.mtime) <= mktime_tz(_date)
+                except (OverflowError, ValueError):
+                    pass
+        return False
+
+    def __call__(self, environ, start_response):
+        coding = self.select(environ.get("HTTP_ACCEPT_ENCODING", ""))
+        data, etag = self.variants[coding]
+
+        headers = [("ETag", etag), ("Last-Modified", self.last_modified)]
+        if len(self.variants) > 1:
+            headers.append(("Vary", "Accept-Encoding"))
+
+        if self.not_modified(environ, etag):
+            start_response("304 Not Modified", headers)
+            return []
+
+        headers.append(("Content-Type", self.content_type))
+        headers.append(("Content-Length", str(len(data))))
+        if coding != "identity":
+            headers.append(("Content-Encoding", coding))
+
+        start_response("200 OK", headers)
+        if environ.get("REQUEST_METHOD") == "HEAD":
+            return []
+        return [data]
+
+
+class AssetCache(object):
+    """
+    Keeps static files in memory, keyed by their normalized path. A file is
+    loaded when the cache is preloaded or the first time it is asked for.
+    At most every check_interval seconds a cached file is checked against
+    the file system and reloaded if it has changed.
+    """
+
+    def __init__(self, check_interval=10):
+        self.check_interval = check_interval
+        self._assets = {}
+        self._lock = threading.Lock()
+
+    def load(self, path):
+        path = os.path.normpath(path)
+        try:
+            stat = os.stat(path)
+            _fil = open(path, "rb")
+            try:
+                data = _fil.read()
+            finally:
+                _fil.close()
+        except (IOError, OSError):
+            with self._lock:
+                self._assets.pop(path, None)
+            return None
+
+        asset = Asset(path, data, stat)
+        with self._lock:
+            self._assets[path] = asset
+        return asset
+
+    def preload(self, directory):
+        """
+        Loads all the files below a directory.
+
+        :param directory: The directory name
+        :return: Number of files loaded
+        """
+        if not directory or not os.path.isdir(directory):
+            return 0
+
+        n = 0
+        for dirpath, _, filenames in os.walk(directory):
+            for name in filenames:
+                if self.load(os.path.join(dirpath, name)) is not None:
+                    n += 1
+        logger.debug("Preloaded %d files from %s" % (n, directory))
+        return n
+
+    def get(self, path):
+        """
+        :param path: The path to the file
+        :return: An Asset instance or None if there is no such file
+        """
+        path = os.path.normpath(path)
+        asset = self._assets.get(path)
+        if asset is None:
+            return self.load(path)
+
+        now = time.time()
+        if now - asset.checked > self.check_interval:
+            asset.checked = now
+            try:
+                stat = os.stat(path)
+            except OSError:
+                with self._lock:
+                    self._assets.pop(path, None)
+                return None
+            if asset.modified(stat):
+                logger.debug("Reloading %s" % path)
+                return self.load(path)
+        return asset
+
+    def __call__(self, environ, start_response, path):
+        asset = self.get(path)
+        if asset is None:
+            resp = NotFound()
+            return resp(environ, start_response)
+        return asset(environ, start_response)
+
+# Shared by everything that serves static files
+ASSETS = AssetCache()
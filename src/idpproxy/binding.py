@@ -0,0 +1,68 @@
+import time
+import logging
+
+from idpproxy.utils import LRUCache
+from idpproxy.utils import add_post_load_process
+
+logger = logging.getLogger(__name__)
+
+# Max number of (service, entity, bindings) combinations remembered
+MAX_SIZE = 10000
+# Seconds a result is used, metadata looked up on demand may change
+# without the metadata being reloaded
+LIFETIME = 3600
+
+
+class BindingCache(object):
+    """
+    Remembers which binding and endpoint pick_binding chose for a service
+    and an SP. The choice only changes when the metadata changes, so
+    everything is forgotten when the metadata is reloaded.
+    """
+
+    def __init__(self, idp, max_size=MAX_SIZE, lifetime=LIFETIME):
+        """
+        :param idp: The saml2.server.Server instance
+        :param max_size: Max number of results kept
+        :param lifetime: Seconds a result is used
+        """
+        self.idp = idp
+        self.max_size = max_size
+        self.lifetime = lifetime
+        # (service, entity_id, bindings) -> (expires, (binding, destination))
+        self._cache = LRUCache(max_size)
+        self.hits = 0
+        self.misses = 0
+        add_post_load_process(idp.metadata, self.clear)
+
+    def __call__(self, service, bindings=None, entity_id=""):
+        """
+        Same as pick_binding but only for the service, bindings and entity
+        ID arguments.
+
+        :return: A (binding, destination) tuple
+        """
+        if bindings is not None:
+            bindings = tuple(bindings)
+        key = (service, entity_id, bindings)
+        now = time.time()
+        expires, res = self._cache.get(key, (0, None))
+        if expires > now:
+            self.hits += 1
+            return res
+
+        self.misses += 1
+        # Errors, like an unknown SP, aren't remembered
+        res = self.idp.pick_binding(
+            service, list(bindings) if bindings else None,
+            entity_id=entity_id)
+        self._cache[key] = (now + self.lifetime, res)
+        return res
+
+    def clear(self):
+        self._cache.clear()
+        logger.debug("Binding cache cleared")
+
+    def stats(self):
+        return {"size": len(self._cache), "hits": self.hits,
+                "misses": self.misses}
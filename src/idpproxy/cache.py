@@ -2,13 +2,25 @@
 from Cookie import SimpleCookie
 import hashlib
 import hmac
+import cPickle as pickle
 
-import shelve
+import ast
 import logging
+import sqlite3
+import threading
 import uuid
 import time
+
+from collections import OrderedDict
 from oic.utils import time_util
 
+from idpproxy.envelope import Envelope
+
+try:
+    import memcache
+except ImportError:
+    memcache = None
+
 logger = logging.getLogger(__name__)
 
 def _expiration(timeout, strformat=None):
@@ -18,17 +30,382 @@ def _expiration(timeout, strformat=None):
         # validity time should match lifetime of assertions
         return time_util.in_a_while(minutes=timeout, time_format=strformat)
 
+
+# Number of minutes a session is kept, matches the lifetime of the cookie
+LIFETIME = 60
+MAX_SIZE = 100000
+# Number of writes between sweeps for expired entries
+SWEEP_INTERVAL = 100
+# Larger cookies are dropped by browsers
+MAX_COOKIE_SIZE = 4000
+
+
+class MemoryStore(object):
+    """
+    A dictionary like store where every entry expires a fixed time after it
+    was last written. Entries are kept in the order they were written, so
+    the oldest, which is also the one that expires first, is always in
+    front. Expired entries are swept away on access, and when the store is
+    full the entry that was written longest ago is evicted.
+    """
+
+    def __init__(self, lifetime=LIFETIME, max_size=MAX_SIZE,
+                 sweep_interval=SWEEP_INTERVAL):
+        """
+        :param lifetime: Minutes an entry is kept after it was written
+        :param max_size: Max number of entries
+        :param sweep_interval: Number of writes between sweeps
+        """
+        self.lifetime = lifetime * 60
+        self.max_size = max_size
+        self.sweep_interval = sweep_interval
+        self._db = OrderedDict()
+        self._lock = threading.RLock()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _sweep(self, now):
+        while self._db:
+            key = next(iter(self._db))
+            if self._db[key][0] > now:
+                break
+            del self._db[key]
+            self.expirations += 1
+
+    def __setitem__(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._db.pop(key, None)
+            self._db[key] = (now + self.lifetime, value)
+
+            self._writes += 1
+            if self._writes >= self.sweep_interval:
+                self._writes = 0
+                self._sweep(now)
+
+            while len(self._db) > self.max_size:
+                self._db.popitem(last=False)
+                self.evictions += 1
+
+    def __getitem__(self, key):
+        with self._lock:
+            try:
+                expires, value = self._db[key]
+            except KeyError:
+                self.misses += 1
+                raise
+
+            if expires <= time.time():
+                del self._db[key]
+                self.expirations += 1
+                self.misses += 1
+                raise KeyError(key)
+
+            self.hits += 1
+            return value
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._db[key]
+
+    def __contains__(self, key):
+        with self._lock:
+            try:
+                return self._db[key][0] > time.time()
+            except KeyError:
+                return False
+
+    def __len__(self):
+        return len(self._db)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def get_multi(self, keys):
+        res = {}
+        for key in keys:
+            try:
+                res[key] = self[key]
+            except KeyError:
+                pass
+        return res
+
+    def keys(self):
+        now = time.time()
+        with self._lock:
+            return [k for k, (e, _) in self._db.items() if e > now]
+
+    def stats(self):
+        _lookups = self.hits + self.misses
+        if _lookups:
+            hit_rate = float(self.hits) / _lookups
+        else:
+            hit_rate = 0.0
+
+        return {"size": len(self._db), "hits": self.hits,
+                "misses": self.misses, "hit_rate": hit_rate,
+                "evictions": self.evictions, "expirations": self.expirations}
+
+
+class SQLiteStore(object):
+    """
+    A dictionary like store kept in a SQLite database in WAL mode. Every
+    entry is a row of its own, indexed by its key, so a write only touches
+    the entry that changed. Like the MemoryStore entries expire a fixed
+    time after they were last written. Expired rows are deleted every
+    sweep_interval writes and when compact() is called.
+
+    Values are pickled, so changes to a value that has been read must be
+    written back to be kept.
+    """
+
+    def __init__(self, filename, table="session", lifetime=LIFETIME,
+                 sweep_interval=SWEEP_INTERVAL, timeout=10.0):
+        """
+        :param filename: The name of the database file
+        :param table: The name of the table in the database
+        :param lifetime: Minutes an entry is kept after it was written
+        :param sweep_interval: Number of writes between sweeps
+        :param timeout: Seconds to wait for a lock on the database
+        """
+        self.filename = filename
+        self.table = table
+        self.lifetime = lifetime * 60
+        self.sweep_interval = sweep_interval
+        self.timeout = timeout
+        self._local = threading.local()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+
+        _con = self._connection()
+        _con.execute("PRAGMA journal_mode=WAL")
+        _con.execute(
+            "CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, "
+            "expires REAL NOT NULL, value BLOB NOT NULL)" % table)
+        _con.execute("CREATE INDEX IF NOT EXISTS %s_expires ON %s (expires)"
+                     % (table, table))
+
+    def _connection(self):
+        # sqlite3 connections can not be shared between threads
+        try:
+            return self._local.connection
+        except AttributeError:
+            _con = sqlite3.connect(self.filename, timeout=self.timeout,
+                                   isolation_level=None)
+            _con.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = _con
+            return _con
+
+    def _sweep(self, now):
+        _cur = self._connection().execute(
+            "DELETE FROM %s WHERE expires <= ?" % self.table, (now,))
+        self.expirations += _cur.rowcount
+
+    def __setitem__(self, key, value):
+        now = time.time()
+        _value = sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        self._connection().execute(
+            "INSERT OR REPLACE INTO %s (key, expires, value) VALUES (?, ?, ?)"
+            % self.table, (key, now + self.lifetime, _value))
+
+        self._writes += 1
+        if self._writes >= self.sweep_interval:
+            self._writes = 0
+            self._sweep(now)
+
+    def __getitem__(self, key):
+        row = self._connection().execute(
+            "SELECT value FROM %s WHERE key = ? AND expires > ?" % self.table,
+            (key, time.time())).fetchone()
+        if row is None:
+            self.misses += 1
+            raise KeyError(key)
+
+        self.hits += 1
+        return pickle.loads(str(row[0]))
+
+    def __delitem__(self, key):
+        _cur = self._connection().execute(
+            "DELETE FROM %s WHERE key = ?" % self.table, (key,))
+        if not _cur.rowcount:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        row = self._connection().execute(
+            "SELECT 1 FROM %s WHERE key = ? AND expires > ?" % self.table,
+            (key, time.time())).fetchone()
+        return row is not None
+
+    def __len__(self):
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM %s" % self.table).fetchone()[0]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def get_multi(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        rows = self._connection().execute(
+            "SELECT key, value FROM %s WHERE expires > ? AND key IN (%s)" % (
+                self.table, ",".join("?" * len(keys))),
+            [time.time()] + keys).fetchall()
+        self.hits += len(rows)
+        self.misses += len(keys) - len(rows)
+        return dict([(k, pickle.loads(str(v))) for k, v in rows])
+
+    def keys(self):
+        return [row[0] for row in self._connection().execute(
+            "SELECT key FROM %s WHERE expires > ?" % self.table,
+            (time.time(),))]
+
+    def compact(self):
+        """ Deletes all expired entries and truncates the write ahead log """
+        self._sweep(time.time())
+        try:
+            self._connection().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except sqlite3.OperationalError:
+            self._connection().execute("PRAGMA wal_checkpoint")
+
+    def stats(self):
+        _lookups = self.hits + self.misses
+        if _lookups:
+            hit_rate = float(self.hits) / _lookups
+        else:
+            hit_rate = 0.0
+
+        return {"size": len(self), "hits": self.hits, "misses": self.misses,
+                "hit_rate": hit_rate, "expirations": self.expirations}
+
+
+class MemcacheStore(object):
+    """
+    A dictionary like store kept in one or more memcached servers, which
+    makes it possible for several proxy processes, on one or many hosts, to
+    share sessions. Entries expire a fixed time after they were last
+    written.
+
+    The memcache client keeps one connection per server and thread, so the
+    connections are pooled over the threads of the server. Values are
+    pickled, so changes to a value that has been read must be written back
+    to be kept.
+    """
+
+    def __init__(self, servers, prefix="session", lifetime=LIFETIME,
+                 socket_timeout=3):
+        """
+        :param servers: List of memcached servers, as 'host:port'
+        :param prefix: Prepended to every key, separates the stores that
+            share the same servers
+        :param lifetime: Minutes an entry is kept after it was written
+        :param socket_timeout: Seconds to wait for a server
+        """
+        if memcache is None:
+            raise ValueError("The memcache cache needs python-memcached")
+
+        self.servers = servers
+        self.prefix = "%s:" % prefix
+        self.lifetime = lifetime * 60
+        self.client = memcache.Client(servers, socket_timeout=socket_timeout,
+                                      pickleProtocol=pickle.HIGHEST_PROTOCOL)
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, key):
+        return self.prefix + key
+
+    def __setitem__(self, key, value):
+        if not self.client.set(self._key(key), value, time=self.lifetime):
+            logger.error("Could not store %s in memcache" % key)
+
+    def __getitem__(self, key):
+        value = self.client.get(self._key(key))
+        if value is None:
+            self.misses += 1
+            raise KeyError(key)
+
+        self.hits += 1
+        return value
+
+    def __delitem__(self, key):
+        if not self.client.delete(self._key(key)):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return self.client.get(self._key(key)) is not None
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def get_multi(self, keys):
+        """
+        Fetches several entries in one round trip per server.
+
+        :param keys: The keys
+        :return: A dictionary with the entries that were found
+        """
+        res = self.client.get_multi(keys, key_prefix=self.prefix)
+        self.hits += len(res)
+        self.misses += len(keys) - len(res)
+        return res
+
+    def keys(self):
+        # memcached has no way of listing keys
+        return []
+
+    def stats(self):
+        _lookups = self.hits + self.misses
+        if _lookups:
+            hit_rate = float(self.hits) / _lookups
+        else:
+            hit_rate = 0.0
+
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": hit_rate}
+
+
 class Cache(object):
-    def __init__(self, name="", secret="", filename=None):
+    def __init__(self, name="", secret="", filename=None, db=None,
+                 alt_id=None):
+        """
+        :param name: The name of the cookie
+        :param secret: Used when signing cookies
+        :param filename: If given the sessions are kept in this file
+        :param db: The store the sessions are kept in
+        :param alt_id: The store for mapping alternate ids to session ids
+        """
         self._secret = secret
         self.name = name
-        if filename:
-            self._db = shelve.open(filename, writeback=True)
-            self._sync = True
+        if db is not None:
+            self._db = db
+        elif filename:
+            self._db = SQLiteStore(filename)
+        else:
+            self._db = MemoryStore()
+
+        if alt_id is not None:
+            self.alt_id = alt_id
+        elif db is None and filename:
+            self.alt_id = SQLiteStore(filename, table="alternate")
+        elif db is None:
+            self.alt_id = MemoryStore()
         else:
-            self._db = {}
             self.alt_id = {}
-            self._sync = False
 
     def sid(self):
         sid = str(uuid.uuid4())
@@ -41,13 +418,8 @@ class Cache(object):
     def __delitem__(self, key):
         del self._db[key]
 
-        if self._sync:
-            self._db.sync()
-
     def __setitem__(self, key, value):
         self._db[key] = value
-        if self._sync:
-            self._db.sync()
 
     def set(self, key, value):
         self[key] = value
@@ -55,6 +427,16 @@ class Cache(object):
     def __getitem__(self, item):
         return self._db[item]
 
+    def get_multi(self, keys):
+        """
+        :param keys: Session ids
+        :return: A dictionary with the sessions that were found
+        """
+        try:
+            return self._db.get_multi(keys)
+        except AttributeError:
+            return dict([(k, self._db[k]) for k in keys if k in self._db])
+
     def keys(self):
         return self._db.keys()
 
@@ -72,6 +454,24 @@ class Cache(object):
     def alternate_sid(self, sid, aid):
         self.alt_id[aid] = sid
 
+    def wrap_start_response(self, sid, cookie, start_response):
+        """
+        Gives the cache a chance to update the cookie when the response is
+        sent, after the session has been updated.
+
+        :param sid: Session id
+        :param cookie: The cookie header, as returned by create_cookie()
+        :param start_response: The WSGI start_response function
+        :return: A start_response function
+        """
+        return start_response
+
+    def stats(self):
+        try:
+            return self._db.stats()
+        except AttributeError:
+            return {"size": len(self._db)}
+
 # =============================================================================
 
     def cookie_signature(self, *parts):
@@ -143,3 +543,158 @@ class Cache(object):
     def digest(self, item):
         return hmac.new(self._secret, item, digestmod=hashlib.sha1).hexdigest()
 
+
+class RequestStore(object):
+    """
+    Keeps the sessions of the request the current thread is handling.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _data(self):
+        try:
+            return self._local.data
+        except AttributeError:
+            self._local.data = {}
+            return self._local.data
+
+    def reset(self, data=None):
+        self._local.data = data or {}
+
+    def __setitem__(self, key, value):
+        self._data()[key] = value
+
+    def __getitem__(self, key):
+        return self._data()[key]
+
+    def __delitem__(self, key):
+        del self._data()[key]
+
+    def __contains__(self, key):
+        return key in self._data()
+
+    def __len__(self):
+        return len(self._data())
+
+    def get_multi(self, keys):
+        _data = self._data()
+        return dict([(k, _data[k]) for k in keys if k in _data])
+
+    def keys(self):
+        return self._data().keys()
+
+
+class StatelessCache(Cache):
+    """
+    Keeps no sessions on the server. The session is sealed into the cookie
+    and opened again when the cookie comes back, so any process that knows
+    the secret can continue a login without looking anything up. While a
+    request is handled its session is kept in a RequestStore.
+
+    What the social service said about the user is only needed while the
+    response to the SP is made, so it isn't put in the cookie. Browsers
+    drop cookies that are larger than about 4 KB.
+    """
+
+    # Session keys that are never sealed into the cookie
+    unsealed = ["service_info", "identity"]
+
+    def __init__(self, name="", secret="", lifetime=LIFETIME):
+        Cache.__init__(self, name, secret, db=RequestStore(),
+                       alt_id=MemoryStore(lifetime))
+        self.envelope = Envelope(secret, lifetime * 60)
+        self._cookie_args = threading.local()
+
+    def sid(self):
+        # A new request without a session
+        self._db.reset()
+        return str(uuid.uuid4())
+
+    def known_as(self, kaka):
+        cookie_obj = SimpleCookie(kaka)
+        morsel = cookie_obj.get(self.name)
+        if morsel is None:
+            return None
+
+        try:
+            sid, session = self.envelope.open(morsel.value)
+        except Exception, err:
+            logger.info("Could not open session cookie: %s" % err)
+            return None
+
+        self._db.reset({sid: session})
+        return sid
+
+    def seal(self, sid):
+        try:
+            session = self._db[sid]
+        except KeyError:
+            session = {}
+        session = dict([(k, v) for k, v in session.items()
+                        if k not in self.unsealed])
+        return self.envelope.seal(sid, session)
+
+    def create_cookie(self, sid, expire=0, domain="", path=""):
+        self._cookie_args.args = (expire, domain, path)
+
+        cookie = SimpleCookie()
+        cookie[self.name] = self.seal(sid)
+        if path:
+            cookie[self.name]["path"] = path
+        if domain:
+            cookie[self.name]["domain"] = domain
+        if expire:
+            cookie[self.name]["expires"] = \
+                _expiration(expire, "%a, %d-%b-%Y %H:%M:%S CET")
+
+        _header = tuple(cookie.output().split(": ", 1))
+        if len(_header[1]) > MAX_COOKIE_SIZE:
+            logger.error("Session cookie is %d bytes, browsers will drop "
+                         "it" % len(_header[1]))
+        return _header
+
+    def wrap_start_response(self, sid, cookie, start_response):
+        def _start_response(status, headers, exc_info=None):
+            # reseal, the session may have changed since the cookie was made
+            if cookie in headers:
+                expire, domain, path = self._cookie_args.args
+                _cookie = self.create_cookie(sid, expire, domain, path)
+                headers = [_cookie if h == cookie else h for h in headers]
+            if exc_info:
+                return start_response(status, headers, exc_info)
+            return start_response(status, headers)
+
+        return _start_response
+
+
+def factory(spec, name, secret, lifetime=LIFETIME, max_size=MAX_SIZE):
+    """
+    Creates a session cache from the CACHE configuration directive.
+
+    :param spec: The cache specification
+    :param name: The name of the cookie
+    :param secret: Used when signing cookies
+    :param lifetime: Minutes a session is kept
+    :param max_size: Max number of sessions kept in memory
+    :return: A Cache instance
+    """
+    if spec == "cookie":
+        return StatelessCache(name, secret, lifetime)
+    elif spec == "memory":
+        return Cache(name, secret, db=MemoryStore(lifetime, max_size),
+                     alt_id=MemoryStore(lifetime, max_size))
+    elif spec.startswith("file:"):
+        filename = spec[5:]
+        return Cache(name, secret,
+                     db=SQLiteStore(filename, "session", lifetime),
+                     alt_id=SQLiteStore(filename, "alternate", lifetime))
+    elif spec.startswith("memcache:"):
+        servers = ast.literal_eval(spec[9:])
+        return Cache(name, secret,
+                     db=MemcacheStore(servers, "%s:session" % name, lifetime),
+                     alt_id=MemcacheStore(servers, "%s:alternate" % name,
+                                          lifetime))
+    else:
+        raise ValueError("Unknown cache specification: %s" % spec)
+
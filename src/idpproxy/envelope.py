@@ -0,0 +1,94 @@
+import os
+import hmac
+import time
+import zlib
+import base64
+import hashlib
+import cPickle as pickle
+
+from Crypto.Cipher import AES
+
+VERSION = "\x01"
+BLOCK_SIZE = 16
+MAC_SIZE = 32
+
+
+class EnvelopeError(Exception):
+    pass
+
+
+def b64u_encode(data):
+    return base64.urlsafe_b64encode(data).rstrip("=")
+
+
+def b64u_decode(data):
+    return base64.urlsafe_b64decode(str(data) + "=" * (-len(data) % 4))
+
+
+class Envelope(object):
+    """
+    Seals information so that it can be handed to the user agent and
+    later be returned. The information is compressed, encrypted with
+    AES-256-CBC and MACed with HMAC-SHA256 (encrypt-then-MAC), using two
+    keys derived from a shared secret. Any process that knows the secret
+    can open the envelope.
+    """
+
+    def __init__(self, secret, lifetime=3600):
+        """
+        :param secret: The shared secret
+        :param lifetime: Number of seconds a sealed envelope can be opened
+        """
+        self.lifetime = lifetime
+        self._enc_key = hmac.new(secret, "envelope encryption",
+                                 hashlib.sha256).digest()
+        self._mac_key = hmac.new(secret, "envelope authentication",
+                                 hashlib.sha256).digest()
+
+    def _mac(self, msg):
+        return hmac.new(self._mac_key, msg, hashlib.sha256).digest()
+
+    def seal(self, sid, info):
+        """
+        :param sid: Session id
+        :param info: The information to seal, must be picklable
+        :return: An URL and cookie safe string
+        """
+        expires = int(time.time()) + self.lifetime
+        plain = zlib.compress(pickle.dumps((expires, sid, info),
+                                           pickle.HIGHEST_PROTOCOL))
+        pad = BLOCK_SIZE - len(plain) % BLOCK_SIZE
+        plain += chr(pad) * pad
+
+        iv = os.urandom(BLOCK_SIZE)
+        msg = VERSION + iv + AES.new(self._enc_key, AES.MODE_CBC,
+                                     iv).encrypt(plain)
+        return b64u_encode(msg + self._mac(msg))
+
+    def open(self, token):
+        """
+        :param token: A string produced by seal()
+        :return: A (sid, info) tuple
+        """
+        try:
+            data = b64u_decode(token)
+        except (TypeError, ValueError):
+            raise EnvelopeError("Not an envelope")
+
+        if len(data) < 1 + 2 * BLOCK_SIZE + MAC_SIZE or data[0] != VERSION:
+            raise EnvelopeError("Not an envelope")
+
+        msg, mac = data[:-MAC_SIZE], data[-MAC_SIZE:]
+        # Nothing is decrypted or unpickled before the MAC is verified
+        if not hmac.compare_digest(self._mac(msg), mac):
+            raise EnvelopeError("Invalid MAC")
+
+        iv = msg[1:1 + BLOCK_SIZE]
+        plain = AES.new(self._enc_key, AES.MODE_CBC, iv).decrypt(
+            msg[1 + BLOCK_SIZE:])
+        plain = plain[:-ord(plain[-1])]
+        expires, sid, info = pickle.loads(zlib.decompress(plain))
+        if expires < time.time():
+            raise EnvelopeError("Envelope has expired")
+
+        return sid, info
@@ -1,10 +1,16 @@
 #!/usr/bin/env python
+import json
+
 from saml2 import BINDING_HTTP_REDIRECT
+from saml2 import samlp
 
 __author__ = 'rolandh'
 
 from idpproxy import exception_log
 from idpproxy import bad_request
+from idpproxy import err_response
+from idpproxy.login import LoginContext
+from idpproxy.social.breaker import BREAKERS
 from urlparse import parse_qs
 
 from saml2.httputil import Response, NotFound, ServiceError, unpack_redirect
@@ -67,7 +73,23 @@ def local_path(path):
 #               CONSUMER[social_service]["secret"]
 
 
-def auth_choice(path, environ, start_response, sid, server_env):
+def find_service(path, services):
+    """
+    Linear search for the service that should handle the request.
+
+    :param path: The local part or the URL
+    :param services: The SERVICE definitions
+    :return: A (service key, function name) tuple or None
+    """
+    for key, _dict in services.items():
+        if match(path, _dict["saml_endpoint"]):
+            return key, "begin"
+        elif match(path, _dict["social_endpoint"]):
+            return key, "callback"
+    return None
+
+
+def auth_choice(path, environ, start_response, sid, server_env, route=None):
     """
 
     :param path: The local part or the URL
@@ -75,6 +97,8 @@ def auth_choice(path, environ, start_response, sid, server_env):
     :param start_response: The start_response function
     :param sid: A key into the session cache
     :param server_env:
+    :param route: A (service key, function name) tuple as found by the
+        router. If not given the services are searched for a match.
     :return: A WSGI response
     """
 
@@ -83,24 +107,17 @@ def auth_choice(path, environ, start_response, sid, server_env):
     if path.startswith("/"):
         path = path[1:]
 
-    _dic = key = None
-    func_name = None
-    for key, _dict in server_env["service"].items():
-        if match(path, _dict["saml_endpoint"]):
-            _dic = _dict
-            func_name = "begin"
-            break
-        elif match(path, _dict["social_endpoint"]):
-            _dic = _dict
-            func_name = "callback"
-            break
+    if route is None:
+        route = find_service(path, server_env["service"])
 
-    _dic["DOMAIN"] = server_env["DOMAIN"]
-
-    if _dic is None:
+    if route is None:
         return not_found(environ, start_response, 'Unknown service: %s' % path)
 
-    logger.debug("[auth_choice] service: %s, function: %s" % (key, func_name))
+    service, func_name = route
+    _dic = server_env["service"][service]
+
+    logger.debug("[auth_choice] service: %s, function: %s" % (service,
+                                                              func_name))
     logger.debug("environ: %s" % environ)
 
     environ['idpproxy.url_args'] = local_path(path)
@@ -152,13 +169,15 @@ def auth_choice(path, environ, start_response, sid, server_env):
                 type(req_info), type(req_info.message)))
 
             entity_id = req_info.sender()
-            _cache.set(sid, {"req_info": req_info, "entity_id": entity_id})
+            _ctx = LoginContext.from_request(req_info, BINDING_HTTP_REDIRECT)
+            _cache.set(sid, {"req_info": _ctx, "entity_id": entity_id})
         else:
             return not_found(environ, start_response, "No query")
 
     logger.debug("SID: %s" % sid)
-    cookie = server_env["CACHE"].create_cookie(
+    cookie = _cache.create_cookie(
         sid, path="/%s" % _dic["social_endpoint"], expire=60)
+    start_response = _cache.wrap_start_response(sid, cookie, start_response)
 
     logger.debug("NEW COOKIE: %s" % (cookie,))
     #logger.debug("_dic: %s" % (_dic,))
@@ -169,7 +188,15 @@ def auth_choice(path, environ, start_response, sid, server_env):
         return not_found(environ, start_response,
                          "No consumer key and secret (%s)" % err)
 
-    c = _dic["class"](key, sec, **_dic)
+    c = server_env["handlers"](service, key, sec)
+    if func_name == "begin" and not c.transport.available():
+        # Don't send the user to a social service that is down
+        logger.warning("%s is not available" % _dic["name"])
+        resp = err_response(server_env, _cache[sid]["req_info"],
+                            (samlp.STATUS_NO_AVAILABLE_IDP,
+                             "%s is not available" % _dic["name"]))
+        return resp(environ, start_response)
+
     func = getattr(c, func_name)
     logger.debug("Proxy function: %s" % func)
     return func(environ, server_env, start_response, cookie, sid, query)
@@ -189,6 +216,22 @@ def logo(environ, start_response, serv_env):
 # ----------------------------------------------------------------------------
 
 
+def status(environ, start_response, server_env):
+    """ The state of the circuit breakers, the caches and the offload queue
+    as JSON """
+    info = {"breakers": BREAKERS.stats(),
+            "cache": server_env["CACHE"].stats(),
+            "consumer_info": server_env["consumer_info"].stats()}
+    if "offload" in server_env:
+        info["offload"] = server_env["offload"].stats()
+    if "bindings" in server_env:
+        info["bindings"] = server_env["bindings"].stats()
+    if "templates" in server_env:
+        info["templates"] = server_env["templates"].stats()
+    resp = Response(json.dumps(info), content="application/json")
+    return resp(environ, start_response)
+
+
 def logout(environ, start_response, sid, server_env):
     msg = ""
     resp = Response(msg)
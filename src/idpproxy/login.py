@@ -0,0 +1,69 @@
+from saml2 import samlp
+
+
+class LoginContext(object):
+    """
+    The parts of a parsed AuthnRequest that are needed to send a response
+    back to the SP. This is what is kept in the session between the
+    request from the SP and the callback from the social service, so it's
+    kept small.
+    """
+    __slots__ = ["id", "issuer", "binding", "relay_state", "name_id_format",
+                 "sp_name_qualifier", "allow_create", "force_authn"]
+
+    def __init__(self, id="", issuer="", binding=None, relay_state="",
+                 name_id_format=None, sp_name_qualifier=None,
+                 allow_create=None, force_authn=None):
+        self.id = id
+        self.issuer = issuer
+        self.binding = binding
+        self.relay_state = relay_state
+        self.name_id_format = name_id_format
+        self.sp_name_qualifier = sp_name_qualifier
+        self.allow_create = allow_create
+        self.force_authn = force_authn
+
+    @classmethod
+    def from_request(cls, req_info, binding=None, relay_state=None):
+        """
+        :param req_info: A parsed AuthnRequest
+        :param binding: The binding the request was received over
+        :param relay_state: The RelayState that came with the request
+        :return: A LoginContext instance
+        """
+        message = req_info.message
+        if binding is None:
+            binding = getattr(req_info, "binding", None)
+        if relay_state is None:
+            relay_state = getattr(req_info, "relay_state", "")
+
+        ctx = cls(message.id, req_info.sender(), binding, relay_state,
+                  force_authn=message.force_authn)
+        policy = message.name_id_policy
+        if policy is not None:
+            ctx.name_id_format = policy.format
+            ctx.sp_name_qualifier = policy.sp_name_qualifier
+            ctx.allow_create = policy.allow_create
+        return ctx
+
+    def __getstate__(self):
+        return tuple([getattr(self, attr) for attr in self.__slots__])
+
+    def __setstate__(self, state):
+        for attr, val in zip(self.__slots__, state):
+            setattr(self, attr, val)
+
+    def __repr__(self):
+        return "<LoginContext id=%s issuer=%s>" % (self.id, self.issuer)
+
+    def sender(self):
+        return self.issuer
+
+    @property
+    def name_id_policy(self):
+        if self.name_id_format is None and self.sp_name_qualifier is None \
+                and self.allow_create is None:
+            return None
+        return samlp.NameIDPolicy(format=self.name_id_format,
+                                  sp_name_qualifier=self.sp_name_qualifier,
+                                  allow_create=self.allow_create)
@@ -0,0 +1,246 @@
+import os
+import time
+import calendar
+import logging
+import urllib
+
+from hashlib import sha1
+
+from saml2 import md
+from saml2.mdstore import InMemoryMetaData
+from saml2.mdstore import SAML_METADATA_CONTENT_TYPE
+from saml2.time_util import str_to_time
+from saml2.time_util import valid
+
+from idpproxy.utils import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Max number of parsed entities kept in memory
+MAX_ENTITIES = 1000
+# Seconds a parsed entity is used before it's looked up again
+LIFETIME = 3600
+# Seconds it's remembered that an entity couldn't be found
+NEGATIVE_LIFETIME = 60
+# Seconds to wait for the metadata server
+TIMEOUT = 10
+
+
+def valid_until(ent):
+    """
+    :param ent: A parsed entity descriptor
+    :return: When the metadata stops being valid, in seconds since the
+        epoch, or None if it doesn't say
+    """
+    try:
+        return calendar.timegm(str_to_time(ent["valid_until"]))
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return None
+
+
+def entity_hash(entity_id):
+    """ The sha1 transform of an entity ID used by the metadata query
+    protocol """
+    if isinstance(entity_id, unicode):
+        entity_id = entity_id.encode("utf-8")
+    return sha1(entity_id).hexdigest()
+
+
+class EntityCache(object):
+    """
+    A bounded mapping from entity ID to parsed entity descriptor. The least
+    recently used entity is dropped when the cache is full. Entities that
+    couldn't be found are remembered as None for a short while.
+    """
+
+    def __init__(self, max_entities=MAX_ENTITIES, lifetime=LIFETIME,
+                 negative_lifetime=NEGATIVE_LIFETIME):
+        self.max_entities = max_entities
+        self.lifetime = lifetime
+        self.negative_lifetime = negative_lifetime
+        # entity_id -> (expires, entity)
+        self._cache = LRUCache(max_entities)
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, entity_id):
+        """
+        :return: The entity, None if it's known not to exist
+        :raise: KeyError if it has to be looked up
+        """
+        expires, ent = self._cache.get(entity_id, (0, None))
+        if expires < time.time():
+            self.misses += 1
+            if expires:
+                self._cache.pop(entity_id, None)
+            raise KeyError(entity_id)
+        self.hits += 1
+        return ent
+
+    def __setitem__(self, entity_id, ent):
+        now = time.time()
+        if ent is None:
+            expires = now + self.negative_lifetime
+        else:
+            expires = now + self.lifetime
+            # Not used after the metadata has stopped being valid
+            until = valid_until(ent)
+            if until is not None and until > now:
+                expires = min(expires, until)
+        self._cache[entity_id] = (expires, ent)
+
+    def __getitem__(self, entity_id):
+        ent = self.lookup(entity_id)
+        if ent is None:
+            raise KeyError(entity_id)
+        return ent
+
+    def __delitem__(self, entity_id):
+        self._cache.pop(entity_id)
+
+    def __contains__(self, entity_id):
+        return self._cache.peek(entity_id, (0, None))[1] is not None
+
+    def items(self):
+        return [(k, v) for k, (_, v) in self._cache.items() if v is not None]
+
+    def keys(self):
+        return [k for k, _ in self.items()]
+
+    def values(self):
+        return [v for _, v in self.items()]
+
+    def __len__(self):
+        return len(self.items())
+
+    def stats(self):
+        return {"entities": len(self._cache), "hits": self.hits,
+                "misses": self.misses}
+
+
+class MetaDataOnDemand(InMemoryMetaData):
+    """
+    Metadata where an entity is looked up the first time it's asked for
+    instead of everything being parsed at startup. The entities are found
+    either at a metadata query server, as <url>/entities/{sha1}<hash>, or
+    in a directory with one file per entity named <hash>.xml, where hash is
+    the hex encoded sha1 digest of the entity ID.
+
+    Only the entities that have been used recently are kept in memory, so
+    items() and keys() don't return all the entities there are.
+    """
+
+    def __init__(self, onts, attrc, source, cert=None, security=None,
+                 http=None, max_entities=MAX_ENTITIES, lifetime=LIFETIME,
+                 timeout=TIMEOUT, **kwargs):
+        """
+        :param source: URL of a metadata query server or a directory
+        :param cert: Certificate the metadata must be signed with
+        :param security: SecurityContext used to verify the signature
+        :param http: HTTPBase used to talk to the metadata query server
+        :param max_entities: Max number of parsed entities kept
+        :param lifetime: Seconds before an entity is looked up again
+        :param timeout: Seconds to wait for the metadata query server
+        """
+        super(MetaDataOnDemand, self).__init__(onts, attrc,
+                                               security=security, **kwargs)
+        self.source = source.rstrip("/")
+        self.cert = cert
+        self.http = http
+        self.timeout = timeout
+        self.entity = EntityCache(max_entities, lifetime)
+        if cert and security is None:
+            raise ValueError("A security context is needed to verify the "
+                             "metadata signatures")
+
+    def load(self):
+        # Nothing is loaded in advance
+        pass
+
+    def get_metadata_content(self, entity_id):
+        """
+        :return: The XML describing the entity or None if there is none
+        """
+        _hash = entity_hash(entity_id)
+        if self.source.startswith("http://") or \
+                self.source.startswith("https://"):
+            url = "%s/entities/%s" % (self.source,
+                                      urllib.quote("{sha1}%s" % _hash))
+            response = self.http.send(
+                url, headers={"Accept": SAML_METADATA_CONTENT_TYPE},
+                timeout=self.timeout)
+            if response.status_code == 200:
+                return response.text.encode("utf-8")
+            if response.status_code != 404:
+                logger.warning("Metadata lookup of %s failed: %s" % (
+                    entity_id, response.status_code))
+            return None
+        else:
+            try:
+                return open(os.path.join(self.source, _hash + ".xml")).read()
+            except IOError:
+                return None
+
+    def _fetch(self, entity_id):
+        try:
+            _txt = self.get_metadata_content(entity_id)
+        except Exception, err:
+            logger.error("Metadata lookup of %s failed: %s" % (entity_id,
+                                                               err))
+            # Not remembered, so it's tried again next time
+            raise KeyError(entity_id)
+
+        if _txt is not None and self.cert:
+            node_name = self.node_name or "%s:%s" % (
+                md.EntityDescriptor.c_namespace, md.EntityDescriptor.c_tag)
+            try:
+                verified = self.security.verify_signature(
+                    _txt, node_name=node_name, cert_file=self.cert)
+            except Exception, err:
+                # A bad signature raises an exception
+                logger.error("Metadata signature of %s is not valid: %s" % (
+                    entity_id, err))
+                verified = False
+            if not verified:
+                logger.error("Metadata signature of %s could not be "
+                             "verified" % entity_id)
+                _txt = None
+
+        if _txt is not None:
+            try:
+                del self.entity[entity_id]
+            except KeyError:
+                pass
+            # do_entity_descriptor adds what it finds to self.entity
+            self.parse(_txt)
+
+        ent = None
+        if entity_id in self.entity:
+            ent = self.entity[entity_id]
+        if ent is not None and self.check_validity and \
+                not valid(ent.get("valid_until")):
+            logger.error("Metadata of %s isn't valid anymore" % entity_id)
+            ent = None
+        if ent is None:
+            self.entity[entity_id] = None
+            raise KeyError(entity_id)
+        return ent
+
+    def __getitem__(self, item):
+        try:
+            ent = self.entity.lookup(item)
+        except KeyError:
+            return self._fetch(item)
+        if ent is None:
+            raise KeyError(item)
+        return ent
+
+    def __contains__(self, item):
+        try:
+            self[item]
+        except KeyError:
+            return False
+        return True
+
+    def stats(self):
+        return self.entity.stats()
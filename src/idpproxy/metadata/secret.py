@@ -8,6 +8,7 @@ import uuid
 import json
 from urlparse import parse_qs
 from idpproxy import utils
+from idpproxy.assets import ASSETS
 from mako.lookup import TemplateLookup
 from jwkest.jwe import JWE
 from jwkest.jwk import RSAKey
@@ -21,7 +22,6 @@ from saml2.extension import idpdisc
 from saml2.extension import dri
 from saml2.extension import ui
 from saml2.httputil import Response
-from saml2.httputil import NotFound
 from saml2.mdstore import MetadataStore
 from saml2.mdstore import MetaData
 from saml2.saml import Attribute
@@ -208,12 +208,7 @@ class MetadataGeneration(object):
         :param filename: The name of the file.
         :return: True if the file exists, otherwise false.
         """
-        try:
-            with open(filename):
-                pass
-        except IOError:
-            return False
-        return True
+        return ASSETS.get(filename) is not None
 
     def handle_metadata(self, environ, start_response):
         """
@@ -354,8 +349,9 @@ class MetadataGeneration(object):
                     first = True
                     if ci is not None:
                         for item in ci.info:
-                            if item.ava is not None and entity_id in item.ava:
-                                for social in item.ava[entity_id]:
+                            secret = item.entity(entity_id)
+                            if secret:
+                                for social in secret:
                                     if not first:
                                         services += ","
                                     else:
@@ -380,19 +376,4 @@ class MetadataGeneration(object):
         :param path: the static file and path to the file.
         :return: wsgi response for the static file.
         """
-        try:
-            text = open(path).read()
-            if path.endswith(".ico"):
-                resp = Response(text,
-                                headers=[('Content-Type', "image/x-icon")])
-            elif path.endswith(".html"):
-                resp = Response(text, headers=[('Content-Type', 'text/html')])
-            elif path.endswith(".txt"):
-                resp = Response(text, headers=[('Content-Type', 'text/plain')])
-            elif path.endswith(".css"):
-                resp = Response(text, headers=[('Content-Type', 'text/css')])
-            else:
-                resp = Response(text, headers=[('Content-Type', 'text/xml')])
-        except IOError:
-            resp = NotFound()
-        return resp(environ, start_response)
\ No newline at end of file
+        return ASSETS(environ, start_response, path)
@@ -0,0 +1,198 @@
+import os
+import time
+import logging
+import tempfile
+import cPickle
+
+from hashlib import sha256
+from os.path import isfile, join
+
+from saml2.config import IdPConfig
+from saml2.mdstore import MetaDataFile
+from saml2.time_util import valid
+
+logger = logging.getLogger(__name__)
+
+# Changed when what is kept in a snapshot changes
+FORMAT = 1
+
+
+def source_files(cnf):
+    """
+    :param cnf: The IdP configuration
+    :return: The metadata files the configuration points to or None if
+        the metadata isn't only made up of local files
+    """
+    if "metadata" in cnf.get("service", {}).get("idp", {}):
+        return None
+    spec = cnf.get("metadata")
+    if not isinstance(spec, dict) or set(spec.keys()) != set(["local"]):
+        return None
+
+    files = []
+    for name in spec["local"]:
+        if os.path.isdir(name):
+            files.extend(sorted([join(name, f) for f in os.listdir(name)
+                                 if isfile(join(name, f))]))
+        else:
+            files.append(name)
+    return files
+
+
+def snapshot_digest(files, key=None):
+    """
+    :param files: The metadata files
+    :param key: The RSA key the consumer info is decrypted with
+    :return: A digest that changes when a file or the key changes
+    """
+    digest = sha256("%d\n" % FORMAT)
+    for fil in files:
+        digest.update("%s\n%s\n" % (fil, sha256(open(fil).read()).digest()))
+    if key is not None:
+        digest.update(sha256(key.publickey().exportKey("DER")).digest())
+    return digest.hexdigest()
+
+
+class Snapshot(object):
+    """
+    The parsed metadata, and the consumer info decrypted from it, kept in a
+    file. Parsing large metadata takes a long time, loading the snapshot
+    doesn't. The snapshot is only used if neither the metadata files nor
+    the decryption key have changed since it was made, otherwise the
+    metadata is parsed and a new snapshot is written.
+
+    The snapshot holds decrypted consumer secrets, so it's only readable by
+    the user that wrote it.
+    """
+
+    def __init__(self, filename, config_file, key=None):
+        """
+        :param filename: Where the snapshot is kept
+        :param config_file: The IdP configuration module
+        :param key: The RSA key the consumer info is decrypted with
+        """
+        self.filename = filename
+        self.config_file = config_file
+        self.key = key
+        self.files = None
+        self.digest = None
+        self.stale = True
+        # The decrypted consumer info, see MetadataInfo
+        self.memo = {}
+
+    def _read(self):
+        try:
+            _fil = open(self.filename, "rb")
+        except IOError:
+            return None
+
+        try:
+            # Unpickling runs code, so only a file that no one else could
+            # have written is read
+            stat = os.fstat(_fil.fileno())
+            if stat.st_uid != os.getuid() or stat.st_mode & 022:
+                logger.warning("Metadata snapshot %s isn't used, it's not "
+                               "owned by this user or writable by others" %
+                               self.filename)
+                return None
+            return cPickle.load(_fil)
+        except Exception, err:
+            logger.warning("Metadata snapshot %s can't be used: %s" % (
+                self.filename, err))
+            return None
+        finally:
+            _fil.close()
+
+    @staticmethod
+    def _valid(data):
+        for fil, valid_until in data["valid_until"].items():
+            if valid_until and not valid(valid_until):
+                logger.info("Metadata in %s isn't valid anymore" % fil)
+                return False
+        return True
+
+    def _restore(self, conf, data):
+        mds = conf.load_metadata({})
+        for fil in self.files:
+            _md = MetaDataFile(mds.onts, mds.attrc, fil)
+            _md.entity = dict([
+                (eid, ent) for eid, ent in data["entities"][fil].items()
+                if not ent.get("valid_until") or valid(ent["valid_until"])])
+            mds.metadata[fil] = _md
+        return mds
+
+    def config(self):
+        """
+        Loads the IdP configuration, with the metadata from the snapshot if
+        it's up to date.
+
+        :return: An IdPConfig instance
+        """
+        conf = IdPConfig().load_file(self.config_file,
+                                     metadata_construction=True)
+        conf.context = "idp"
+        config_file = self.config_file
+        if config_file.endswith(".py"):
+            config_file = config_file[:-3]
+        cnf = conf._load(config_file).CONFIG
+
+        self.files = source_files(cnf)
+        if self.files is None:
+            logger.warning("Metadata snapshots can only be made of local "
+                           "metadata files")
+        else:
+            start = time.time()
+            self.digest = snapshot_digest(self.files, self.key)
+            data = self._read()
+            if data is not None and data["digest"] == self.digest and \
+                    self._valid(data):
+                conf.setattr("", "metadata", self._restore(conf, data))
+                self.memo = data["memo"]
+                self.stale = False
+                logger.info("Loaded metadata snapshot in %.3f seconds" % (
+                    time.time() - start))
+                return conf
+
+        if "metadata" in cnf:
+            conf.setattr("", "metadata", conf.load_metadata(cnf["metadata"]))
+        if "metadata" in cnf.get("service", {}).get("idp", {}):
+            conf.setattr("idp", "metadata", conf.load_metadata(
+                cnf["service"]["idp"]["metadata"]))
+        return conf
+
+    def save(self, mds, memo=None):
+        """
+        Writes a new snapshot.
+
+        :param mds: The parsed metadata, a MetadataStore instance
+        :param memo: The decrypted consumer info
+        """
+        if self.files is None:
+            return
+
+        data = {"digest": self.digest, "entities": {}, "valid_until": {},
+                "memo": memo or {}}
+        for fil in self.files:
+            _md = mds.metadata[fil]
+            data["entities"][fil] = _md.entity
+            data["valid_until"][fil] = getattr(_md.entities_descr,
+                                               "valid_until", None)
+
+        # Written to a temporary file and renamed so that other processes
+        # never see half a snapshot
+        _dir = os.path.dirname(os.path.abspath(self.filename))
+        fd, tmp = tempfile.mkstemp(dir=_dir)
+        try:
+            os.chmod(tmp, 0600)
+            with os.fdopen(fd, "wb") as _fil:
+                cPickle.dump(data, _fil, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, self.filename)
+        except Exception:
+            logger.exception("Could not write the metadata snapshot")
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            return
+        self.stale = False
+        logger.info("Wrote metadata snapshot %s" % self.filename)
@@ -0,0 +1,138 @@
+import os
+import logging
+
+from idpproxy.assets import ASSETS
+
+logger = logging.getLogger(__name__)
+
+# Route types
+STATIC = "static"
+BASE = "base"
+LOGO = "logo"
+LOGOUT = "logout"
+METADATA = "metadata"
+SERVICE = "service"
+STATUS = "status"
+UNKNOWN = "unknown"
+
+
+def first_segment(path):
+    """
+    :param path: The URL path of the request
+    :return: The first non-empty part of the path
+    """
+    if path.startswith("/"):
+        path = path[1:]
+    return path.split("/", 1)[0]
+
+
+class Router(object):
+    """
+    Maps a request path to a route. The routes are compiled into
+    dictionaries when the server is set up, so that a request is dispatched
+    with at most two dictionary lookups. Only paths that match no route are
+    looked for among the static files, through the asset cache.
+    """
+
+    def __init__(self, assets=ASSETS):
+        """
+        :param assets: The AssetCache static files are looked up in
+        """
+        # full path -> (route, argument)
+        self.exact = {}
+        # first path segment -> (route, argument)
+        self.segment = {}
+        # Directories with static files
+        self.directories = []
+        self.assets = assets
+
+    def add_path(self, path, route, arg=None):
+        if path not in self.exact:
+            self.exact[path] = (route, arg)
+
+    def add_segment(self, name, route, arg=None):
+        if name not in self.segment:
+            self.segment[name] = (route, arg)
+
+    def add_directory(self, directory):
+        """
+        Makes every file below the directory reachable as a static file.
+        Which files there are is left to the asset cache, so files added
+        after the server was started are found too.
+
+        :param directory: The directory name, with a trailing '/'
+        """
+        if directory and directory not in self.directories:
+            self.directories.append(directory)
+
+    def static(self, path):
+        """
+        :param path: The URL path of the request
+        :return: The name of the file the path refers to or None if there
+            is no such file below any of the directories
+        """
+        for directory in self.directories:
+            root = os.path.normpath(directory)
+            # The path to the file is the directory name concatenated with
+            # the request path, which is how it was constructed before
+            _file = os.path.normpath(directory + path)
+            if not _file.startswith(root + os.sep):
+                # Outside of the directory
+                continue
+            if self.assets.get(_file) is not None:
+                return _file
+        return None
+
+    def add_services(self, services):
+        """
+        :param services: The SERVICE definition from the proxy configuration
+        """
+        for key, _dict in services.items():
+            self.add_segment(_dict["saml_endpoint"], SERVICE, (key, "begin"))
+        for key, _dict in services.items():
+            self.add_segment(_dict["social_endpoint"], SERVICE,
+                             (key, "callback"))
+
+    def __call__(self, path):
+        """
+        :param path: The URL path of the request
+        :return: A (route, argument) tuple
+        """
+        try:
+            return self.exact[path]
+        except KeyError:
+            pass
+
+        try:
+            return self.segment[first_segment(path)]
+        except KeyError:
+            pass
+
+        _file = self.static(path)
+        if _file is not None:
+            return STATIC, _file
+        return UNKNOWN, None
+
+
+def router_factory(server_env):
+    """
+    Compiles a router from the server environment.
+
+    :param server_env: The server environment
+    :return: A Router instance
+    """
+    router = Router()
+    router.add_directory(server_env["STATIC_DIR"])
+    router.add_directory(server_env["METADATA_DIR"])
+    router.add_path("/", BASE)
+    router.add_path("/logout", LOGOUT)
+    router.add_path("/metadata", METADATA)
+    if server_env.get("STATUS_PATH"):
+        router.add_path(server_env["STATUS_PATH"], STATUS)
+    router.add_segment("logo", LOGO)
+    router.add_segment("metadata", METADATA)
+    router.add_services(server_env["service"])
+
+    logger.debug("Routes: %d paths, %d segments, %d directories" % (
+        len(router.exact), len(router.segment), len(router.directories)))
+    return router
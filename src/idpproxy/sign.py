@@ -0,0 +1,211 @@
+import logging
+
+from base64 import b64encode
+
+from Crypto.Hash import SHA
+from Crypto.Hash import SHA224
+from Crypto.Hash import SHA256
+from Crypto.Hash import SHA384
+from Crypto.Hash import SHA512
+from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
+
+import xmldsig as ds
+
+from saml2.sigver import CryptoBackend
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+logger = logging.getLogger(__name__)
+
+DS = "{%s}" % ds.NAMESPACE
+EC_NS = "http://www.w3.org/2001/10/xml-exc-c14n#"
+EXC_C14N_WITH_COMMENTS = EC_NS + "WithComments"
+
+DIGEST = {
+    ds.DIGEST_SHA1: SHA,
+    ds.DIGEST_SHA224: SHA224,
+    ds.DIGEST_SHA256: SHA256,
+    ds.DIGEST_SHA384: SHA384,
+    ds.DIGEST_SHA512: SHA512,
+}
+
+SIGNATURE = {
+    ds.SIG_RSA_SHA1: SHA,
+    ds.SIG_RSA_SHA224: SHA224,
+    ds.SIG_RSA_SHA256: SHA256,
+    ds.SIG_RSA_SHA384: SHA384,
+    ds.SIG_RSA_SHA512: SHA512,
+}
+
+
+class Unsupported(Exception):
+    pass
+
+
+def _c14n(elem, algorithm, method):
+    """ Exclusive canonicalization of elem, which is all this signer does """
+    if algorithm not in [ds.ALG_EXC_C14N, EXC_C14N_WITH_COMMENTS]:
+        raise Unsupported(algorithm)
+    prefixes = None
+    incl = method.find("{%s}InclusiveNamespaces" % EC_NS)
+    if incl is not None and incl.get("PrefixList"):
+        prefixes = incl.get("PrefixList").split()
+    return etree.tostring(elem, method="c14n", exclusive=True,
+                          with_comments=algorithm == EXC_C14N_WITH_COMMENTS,
+                          inclusive_ns_prefixes=prefixes)
+
+
+class InProcessBackend(CryptoBackend):
+    """
+    Signs in the server process instead of running xmlsec1 for every
+    response. The key is read once, when the backend is created. Only
+    enveloped signatures with exclusive canonicalization and RSA are made
+    here, which is what pysaml2 asks for. Everything else, including
+    signing with another key, encryption and signature verification, is
+    left to the backend that was there before.
+    """
+
+    def __init__(self, key_file, fallback, debug=False):
+        """
+        :param key_file: The PEM file with the signing key
+        :param fallback: The CryptoBackend everything else is handed to
+        """
+        CryptoBackend.__init__(self, debug=debug)
+        if etree is None:
+            raise ImportError("lxml is needed to sign in process")
+        self.parser = etree.XMLParser(resolve_entities=False)
+        self.key_file = key_file
+        self.signer = PKCS1_v1_5.new(RSA.importKey(open(key_file).read()))
+        self.fallback = fallback
+
+    def version(self):
+        return "in-process, falling back to %s" % self.fallback.version()
+
+    def encrypt(self, *args, **kwargs):
+        return self.fallback.encrypt(*args, **kwargs)
+
+    def encrypt_assertion(self, *args, **kwargs):
+        return self.fallback.encrypt_assertion(*args, **kwargs)
+
+    def decrypt(self, *args, **kwargs):
+        return self.fallback.decrypt(*args, **kwargs)
+
+    def validate_signature(self, *args, **kwargs):
+        return self.fallback.validate_signature(*args, **kwargs)
+
+    def _node(self, doc, node_name, node_id, id_attr):
+        """ The element whose signature template is to be filled in """
+        namespace, tag = node_name.rsplit(":", 1)
+        tag = "{%s}%s" % (namespace, tag)
+        for elem in doc.iter(tag):
+            if not node_id or elem.get(id_attr) == node_id:
+                return elem
+        raise Unsupported("No %s with %s=%s" % (node_name, id_attr, node_id))
+
+    def _digest(self, doc, reference, id_attr):
+        uri = reference.get("URI")
+        if not uri or not uri.startswith("#"):
+            raise Unsupported("Reference %s" % uri)
+        elems = doc.xpath("//*[@%s=$ident]" % id_attr, ident=uri[1:])
+        if len(elems) != 1:
+            raise Unsupported("Reference %s" % uri)
+        elem = elems[0]
+        signature = reference.getparent().getparent()
+
+        algorithm = None
+        method = None
+        enveloped = False
+        for transform in reference.iterfind("%sTransforms/%sTransform" % (
+                DS, DS)):
+            if transform.get("Algorithm") == ds.TRANSFORM_ENVELOPED:
+                enveloped = True
+            elif algorithm is None:
+                algorithm = transform.get("Algorithm")
+                method = transform
+            else:
+                raise Unsupported("Transforms")
+        if not enveloped or signature.getparent() is not elem:
+            raise Unsupported("Only enveloped signatures")
+        if algorithm is None:
+            raise Unsupported("Inclusive canonicalization")
+
+        # The enveloped signature transform, the text around the signature
+        # is kept
+        parent = signature.getparent()
+        index = parent.index(signature)
+        tail = signature.tail
+        previous = signature.getprevious()
+        if previous is None:
+            text = parent.text
+            parent.text = (text or "") + (tail or "")
+        else:
+            text = previous.tail
+            previous.tail = (text or "") + (tail or "")
+        parent.remove(signature)
+        try:
+            data = _c14n(elem, algorithm, method)
+        finally:
+            if previous is None:
+                parent.text = text
+            else:
+                previous.tail = text
+            parent.insert(index, signature)
+            signature.tail = tail
+
+        digest_alg = reference.find("%sDigestMethod" % DS).get("Algorithm")
+        try:
+            return b64encode(DIGEST[digest_alg].new(data).digest())
+        except KeyError:
+            raise Unsupported(digest_alg)
+
+    def _sign(self, statement, node_name, node_id, id_attr):
+        if isinstance(statement, unicode):
+            statement = statement.encode("utf-8")
+        doc = etree.fromstring(statement, self.parser)
+        node = self._node(doc.getroottree(), node_name, node_id, id_attr)
+        signature = node.find("%sSignature" % DS)
+        if signature is None:
+            raise Unsupported("No signature template")
+        signed_info = signature.find("%sSignedInfo" % DS)
+
+        for reference in signed_info.iterfind("%sReference" % DS):
+            reference.find("%sDigestValue" % DS).text = self._digest(
+                doc, reference, id_attr)
+
+        c14n = signed_info.find("%sCanonicalizationMethod" % DS)
+        data = _c14n(signed_info, c14n.get("Algorithm"), c14n)
+        sig_alg = signed_info.find("%sSignatureMethod" % DS).get("Algorithm")
+        try:
+            digest = SIGNATURE[sig_alg].new(data)
+        except KeyError:
+            raise Unsupported(sig_alg)
+        signature.find("%sSignatureValue" % DS).text = b64encode(
+            self.signer.sign(digest))
+
+        return etree.tostring(doc, xml_declaration=True, encoding="UTF-8")
+
+    def sign_statement(self, statement, node_name, key_file, node_id,
+                       id_attr):
+        """
+        Sign an XML statement.
+
+        :param statement: The statement to be signed
+        :param node_name: string like 'urn:oasis:names:...:Assertion'
+        :param key_file: The file where the key can be found
+        :param node_id: The identifier of the node
+        :param id_attr: The attribute name for the identifier, normally one of
+            'id','Id' or 'ID'
+        :return: The signed statement
+        """
+        if key_file == self.key_file:
+            try:
+                return self._sign(statement, node_name, node_id, id_attr)
+            except Unsupported, err:
+                logger.info("Can't sign in process (%s), using %s" % (
+                    err, self.fallback.__class__.__name__))
+        return self.fallback.sign_statement(statement, node_name, key_file,
+                                            node_id, id_attr)
@@ -7,6 +7,10 @@ from saml2.httputil import Response
 from idpproxy import exception_log
 from idpproxy import err_response
 from idpproxy import do_req_response
+from idpproxy.social.breaker import BREAKERS
+from idpproxy.social.offload import please_wait
+from idpproxy.social.transport import TRANSPORT
+from idpproxy.utils import LRUCache
 
 logger = logging.getLogger(__name__)
 
@@ -14,13 +18,17 @@ logger = logging.getLogger(__name__)
 class Social(object):
     def __init__(self, client_id, client_secret, social_endpoint=None,
                  attribute_map=None, authenticating_authority=None,
-                 name="", **kwargs):
+                 name="", transport=None, **kwargs):
         self.client_id = client_id
         self.client_secret = client_secret
         self.attribute_map = attribute_map
         self.social_endpoint = social_endpoint
         self.authenticating_authority = authenticating_authority
         self.name = name
+        # Pooled HTTP transport used for all calls to the provider, through
+        # the circuit breaker of the provider
+        self.transport = (transport or TRANSPORT).for_provider(
+            BREAKERS(name or self.__class__.__name__), kwargs.get("timeout"))
         self.extra = kwargs
 
     def begin(self, environ, server_env, start_response,
@@ -46,8 +54,16 @@ class Social(object):
         else:
             req_info = None
 
+        offload = server_env.get("offload")
         try:
-            result = self.phaseN(environ, info, server_env, sid)
+            if offload is None:
+                result = self.phaseN(environ, info, server_env, sid)
+            else:
+                result = offload(sid, self.phaseN,
+                                 (dict(environ), info, server_env, sid))
+                if result is None:
+                    # Still waiting for the social service
+                    return please_wait(environ, start_response, cookie)
             logger.debug("[do_%s] response: %s" % (_service, result))
 
             if isinstance(session, list):  # in process
@@ -88,6 +104,8 @@ class Social(object):
                 error_info = (samlp.STATUS_AUTHN_FAILED, identity)
                 resp = err_response(server_env, req_info, error_info)
                 resp.headers.append(cookie)
+            # The session store may hand out copies
+            server_env["CACHE"][sid] = session
         else:
             resp = Response("%s" % identity)
 
@@ -115,4 +133,48 @@ class Social(object):
                     res[key] = profile[val]
             except KeyError:
                 pass
-        return res
\ No newline at end of file
+        return res
+
+
+class HandlerRegistry(object):
+    """
+    Hands out handler instances, one per service and consumer key and
+    secret. Handlers are created the first time they are asked for and
+    then reused, so they must not keep any per login state. When max_size
+    handlers have been made the one used longest ago is dropped.
+    """
+
+    def __init__(self, services, max_size=1000, **kwargs):
+        """
+        :param services: The SERVICE definition from the proxy configuration
+        :param max_size: Max number of handlers kept
+        :param kwargs: Extra arguments given to every handler, like DOMAIN
+            or transport
+        """
+        self.max_size = max_size
+        self._conf = {}
+        for key, _dict in services.items():
+            _conf = _dict.copy()
+            _conf.update(kwargs)
+            self._conf[key] = _conf
+        self._handlers = LRUCache(max_size)
+
+    def __call__(self, service, client_id, client_secret):
+        """
+        :param service: The key of the service in the SERVICE definition
+        :param client_id: The consumer key
+        :param client_secret: The consumer secret
+        :return: A Social instance
+        """
+        _key = (service, client_id, client_secret)
+        handler = self._handlers.get(_key)
+        if handler is not None:
+            return handler
+
+        _conf = self._conf[service]
+        handler = _conf["class"](client_id, client_secret, **_conf)
+        return self._handlers.setdefault(_key, handler)
+
+    def clear(self):
+        """ Drops all handlers, run when the consumer info has changed """
+        self._handlers.clear()
@@ -0,0 +1,151 @@
+import time
+import logging
+import threading
+
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Seconds of history the error rate is computed over
+WINDOW = 60
+# Min number of calls in the window before the breaker can open
+MIN_CALLS = 10
+# Error rate that opens the breaker
+ERROR_RATE = 0.5
+# Seconds the breaker stays open before a trial call is let through
+OPEN_TIME = 30
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Keeps track of how calls to one social service go. When too many of
+    the calls in the last window seconds have failed the breaker opens
+    and calls fail at once without being made. After open_time seconds one
+    trial call is let through; if it succeeds the breaker closes again,
+    otherwise it stays open for another open_time seconds.
+    """
+
+    def __init__(self, name, window=WINDOW, min_calls=MIN_CALLS,
+                 error_rate=ERROR_RATE, open_time=OPEN_TIME):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.open_time = open_time
+        self.state = CLOSED
+        self.opened = 0
+        # [second, calls, failures], oldest first
+        self._buckets = deque()
+        self._calls = 0
+        self._failures = 0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        limit = int(now) - self.window
+        while self._buckets and self._buckets[0][0] <= limit:
+            _, calls, failures = self._buckets.popleft()
+            self._calls -= calls
+            self._failures -= failures
+
+    def _record(self, now, failed):
+        second = int(now)
+        if self._buckets and self._buckets[-1][0] == second:
+            bucket = self._buckets[-1]
+        else:
+            bucket = [second, 0, 0]
+            self._buckets.append(bucket)
+        bucket[1] += 1
+        self._calls += 1
+        if failed:
+            bucket[2] += 1
+            self._failures += 1
+        self._expire(now)
+
+    def allow(self):
+        """
+        :return: True if a call can be made
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            now = time.time()
+            if self.state == OPEN and now - self.opened >= self.open_time:
+                self.state = HALF_OPEN
+                self._trial = False
+            if self.state == HALF_OPEN and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def available(self):
+        """ Like allow but doesn't use up a trial call """
+        with self._lock:
+            return self.state == CLOSED or (
+                self.state == OPEN and
+                time.time() - self.opened >= self.open_time)
+
+    def _open(self, now):
+        if self.state != OPEN:
+            logger.warning("Circuit breaker for %s opened" % self.name)
+        self.state = OPEN
+        self.opened = now
+
+    def success(self):
+        now = time.time()
+        with self._lock:
+            self._record(now, False)
+            if self.state == HALF_OPEN:
+                logger.info("Circuit breaker for %s closed" % self.name)
+                self.state = CLOSED
+
+    def failure(self):
+        now = time.time()
+        with self._lock:
+            self._record(now, True)
+            if self.state == HALF_OPEN:
+                self._open(now)
+            elif self.state == CLOSED and self._calls >= self.min_calls and \
+                    self._failures >= self.error_rate * self._calls:
+                self._open(now)
+
+    def stats(self):
+        with self._lock:
+            self._expire(time.time())
+            return {"state": self.state, "calls": self._calls,
+                    "failures": self._failures}
+
+
+class BreakerRegistry(object):
+    """ One circuit breaker per social service """
+
+    def __init__(self, **kwargs):
+        """
+        :param kwargs: Arguments given to every CircuitBreaker
+        """
+        self.kwargs = kwargs
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, name):
+        try:
+            return self._breakers[name]
+        except KeyError:
+            with self._lock:
+                return self._breakers.setdefault(
+                    name, CircuitBreaker(name, **self.kwargs))
+
+    def stats(self):
+        return dict([(name, breaker.stats())
+                     for name, breaker in self._breakers.items()])
+
+# Shared by all handlers
+BREAKERS = BreakerRegistry()
@@ -8,9 +8,15 @@ from oic.oauth2.message import SINGLE_OPTIONAL_INT
 
 from oic.oic import Client as oic_Client
 
+from idpproxy.social.jwks import JWKS
+from idpproxy.social.jwks import JWKSError
+
+import time
 import logging
 logger = logging.getLogger(__name__)
 
+ISSUERS = ["accounts.google.com", "https://accounts.google.com"]
+
 SCOPES = ["https://www.googleapis.com/auth/userinfo.profile",
           "https://www.googleapis.com/auth/userinfo.email"]
 
@@ -67,7 +73,43 @@ class GoogleOIC(OpenIDConnect):
         # default
         #self.flow_type = "code"
 
-    def verify_token(self, client, access_token):
+    def verify_id_token(self, id_token, access_token):
+        """
+        Verifies the id_token locally with the keys published by Google.
+
+        :return: The same information as the tokeninfo endpoint returns
+        """
+        claims = JWKS.verify(id_token, self.extra["jwks_uri"],
+                             self.extra.get("issuer", ISSUERS),
+                             self.client_id, access_token=access_token,
+                             transport=self.transport)
+        res = {"audience": claims["aud"],
+               "user_id": claims.get("sub", claims.get("id")),
+               "expires_in": max(0, int(claims["exp"] - time.time()))}
+        for attr in ["email", "email_verified"]:
+            if attr in claims:
+                res[attr] = claims[attr]
+        logger.info("Verification result: %s" % res)
+        return res
+
+    def verify_token(self, client, access_token, tokenresp=None):
+        """
+        The id_token is verified locally if possible, the tokeninfo endpoint
+        is only used if there is no id_token or the keys to verify it with
+        could not be fetched. An invalid id_token is never passed on to the
+        tokeninfo endpoint.
+        """
+        try:
+            id_token = tokenresp["id_token"]
+        except (TypeError, KeyError):
+            id_token = None
+
+        if id_token and "jwks_uri" in self.extra:
+            try:
+                return self.verify_id_token(id_token, access_token)
+            except JWKSError, err:
+                logger.warning("Using tokeninfo, %s" % err)
+
         resp = client.do_any(request=ValidationRequest, method="GET",
                              request_args={"access_token": access_token},
                              endpoint=self.extra["verification_endpoint"],
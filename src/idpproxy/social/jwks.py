@@ -0,0 +1,149 @@
+import time
+import logging
+import threading
+
+from jwkest import JWKESTException
+from jwkest.jwk import KEYS
+from jwkest.jws import JWS
+from jwkest.jws import JWSig
+from jwkest.jws import left_hash
+
+from idpproxy.social.transport import TRANSPORT
+from idpproxy.social.transport import cache_ttl
+
+logger = logging.getLogger(__name__)
+
+# Used when the JWKS response doesn't say for how long it can be cached
+DEFAULT_TTL = 3600
+# Min number of seconds between refreshes caused by an unknown key id
+MIN_REFRESH = 60
+# Allowed clock skew in seconds
+LEEWAY = 60
+
+
+class JWKSError(Exception):
+    """ The keys could not be fetched """
+    pass
+
+
+class IdTokenError(Exception):
+    """ The id_token is not valid """
+    pass
+
+
+class JWKSCache(object):
+    """
+    Keeps the signing keys of the issuers, one key set per issuer. The key
+    set is kept for as long as the issuer allows it to be cached. When a
+    token is signed with a key that is not known the key set is fetched
+    again, but not more often than every min_refresh seconds.
+    """
+
+    def __init__(self, transport=TRANSPORT, default_ttl=DEFAULT_TTL,
+                 min_refresh=MIN_REFRESH):
+        self.transport = transport
+        self.default_ttl = default_ttl
+        self.min_refresh = min_refresh
+        # jwks_uri -> (keys, expires, fetched)
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def fetch(self, jwks_uri, transport=None):
+        transport = transport or self.transport
+        try:
+            r = transport.request("GET", jwks_uri)
+        except Exception, err:
+            raise JWKSError("Could not fetch %s: %s" % (jwks_uri, err))
+        if r.status_code != 200:
+            raise JWKSError("Could not fetch %s: %s" % (jwks_uri,
+                                                        r.status_code))
+
+        keys = KEYS()
+        try:
+            keys.load_jwks(r.text)
+        except (ValueError, KeyError, JWKESTException), err:
+            raise JWKSError("Invalid key set from %s: %s" % (jwks_uri, err))
+
+        now = time.time()
+        ttl = cache_ttl(dict([(k.lower(), v) for k, v in r.headers.items()]),
+                        self.default_ttl)
+        logger.debug("Fetched %d keys from %s, valid for %d seconds" % (
+            len(keys), jwks_uri, ttl))
+        with self._lock:
+            self._keys[jwks_uri] = (keys, now + ttl, now)
+        return keys
+
+    def keys(self, jwks_uri, kid=None, transport=None):
+        """
+        :param jwks_uri: Where the issuer publishes its keys
+        :param kid: The id of the wanted key
+        :return: A list of keys
+        """
+        now = time.time()
+        try:
+            keys, expires, fetched = self._keys[jwks_uri]
+        except KeyError:
+            keys = self.fetch(jwks_uri, transport)
+        else:
+            if expires < now or (kid and kid not in keys.kids() and
+                                 now - fetched > self.min_refresh):
+                keys = self.fetch(jwks_uri, transport)
+
+        if kid:
+            return [k for k in keys if k.kid == kid]
+        return list(keys)
+
+    def verify(self, id_token, jwks_uri, issuers, audience,
+               access_token=None, transport=None, leeway=LEEWAY):
+        """
+        Verifies the signature and the claims of an id_token.
+
+        :param id_token: The id_token as a compact JWS
+        :param jwks_uri: Where the issuer publishes its keys
+        :param issuers: The accepted values of the iss claim
+        :param audience: The client id
+        :param access_token: If given it's checked against at_hash
+        :return: The claims
+        """
+        try:
+            header = JWSig().unpack(id_token).headers
+        except Exception:
+            raise IdTokenError("Not a JWS")
+
+        keys = self.keys(jwks_uri, header.get("kid"), transport)
+        if not keys:
+            raise IdTokenError("Unknown key %s" % header.get("kid"))
+
+        try:
+            claims = JWS().verify_compact(id_token, keys)
+        except (JWKESTException, KeyError, ValueError), err:
+            raise IdTokenError("Invalid signature: %s" % err)
+        if not isinstance(claims, dict):
+            raise IdTokenError("Not a JSON web token")
+
+        if claims.get("iss") not in issuers:
+            raise IdTokenError("Wrong issuer: %s" % claims.get("iss"))
+
+        aud = claims.get("aud")
+        if isinstance(aud, basestring):
+            aud = [aud]
+        if not aud or audience not in aud:
+            raise IdTokenError("Wrong audience: %s" % claims.get("aud"))
+
+        now = time.time()
+        try:
+            if int(claims["exp"]) + leeway < now:
+                raise IdTokenError("The id_token has expired")
+        except (KeyError, TypeError, ValueError):
+            raise IdTokenError("Missing or invalid exp")
+
+        if access_token and "at_hash" in claims:
+            # left_hash wants the hash size in HMAC terms
+            _alg = "HS" + header["alg"][2:]
+            if left_hash(access_token, _alg) != claims["at_hash"]:
+                raise IdTokenError("The access token doesn't match at_hash")
+
+        return claims
+
+# Shared by all handlers
+JWKS = JWKSCache()
@@ -15,9 +15,8 @@ class LinkedIn(OAuth):
         token = oauth.Token(key=info_set["oauth_token"][0],
                             secret=info_set["oauth_token_secret"][0])
 
-        client = oauth.Client(self.consumer, token)
-
-        resp, content = client.request(self.extra["userinfo_endpoint"], "GET")
+        resp, content = self.transport.oauth_request(
+            self.consumer, self.extra["userinfo_endpoint"], "GET", token=token)
 #        # content in XML :-(
 #        logger.debug("UserInfo XML: %s" % content)
 #        res = {}
@@ -23,7 +23,6 @@ class OAuth(Social):
 
         session = server_env["CACHE"][sid]
 
-        client = oauth.Client(self.consumer)
         try:
             url = "%s?scope=%s" % (self.extra["request_token_url"],
                                   "+".join(self.extra["scope"]))
@@ -31,7 +30,7 @@ class OAuth(Social):
             url = self.extra["request_token_url"]
 
         logger.debug("Request_token url: %s" % url)
-        resp, content = client.request(url, "GET")
+        resp, content = self.transport.oauth_request(self.consumer, url, "GET")
         if server_env["DEBUG"]:
             logger.info("Client resp: %s" % resp)
             logger.info("Client content: %s" % content)
@@ -41,11 +40,10 @@ class OAuth(Social):
 
         request_token = dict(parse_qs(content))
 
-        token = oauth.Token(request_token['oauth_token'][0],
-                            request_token['oauth_token_secret'][0])
-
+        # Only the strings are kept, the token is rebuilt in phaseN
         session['oauth_token'] = request_token['oauth_token'][0]
-        session[request_token['oauth_token'][0]] = token
+        session[request_token['oauth_token'][0]] = \
+            request_token['oauth_token_secret'][0]
         try:
             dig = session["sid_digest"]
         except KeyError:
@@ -99,18 +97,18 @@ class OAuth(Social):
 
         logger.info("response_oauth_token: %s" % response_oauth_token)
 
-        token = session[response_oauth_token]
+        token = oauth.Token(response_oauth_token,
+                            session[response_oauth_token])
 
         #token.set_verifier(oauth_verifier)
-        client = oauth.Client(self.consumer, token)
-
         if "oauth_verifier" in info:
             _body = "oauth_verifier=%s" % info["oauth_verifier"][0]
         else:
             _body = ""
 
-        resp, content = client.request(self.extra["token_endpoint"], "POST",
-                                       body=_body)
+        resp, content = self.transport.oauth_request(
+            self.consumer, self.extra["token_endpoint"], "POST", body=_body,
+            token=token)
         if resp['status'] != '200':
             logger.error("<token_endpoint> response: %s, content: %s" % (resp,
                                                                          content))
@@ -61,13 +61,15 @@ class OAuth2(Social):
 
         client = Client(client_id=self.client_id,
                         client_authn_method=CLIENT_AUTHN_METHOD)
+        self.transport.bind(client)
         response = client.parse_response(AuthorizationResponse, info, "dict")
         logger.info("Response: %s" % response)
 
         if isinstance(response, ErrorResponse):
             logger.info("%s" % response)
             session["authentication"] = "FAILED"
-            return False, "Authentication failed or permission not granted"
+            return (False, "Authentication failed or permission not granted",
+                    session)
 
         req_args = {
             "redirect_uri": callback,
@@ -86,7 +88,8 @@ class OAuth2(Social):
         if isinstance(tokenresp, ErrorResponse):
             logger.info("%s" % tokenresp)
             session["authentication"] = "FAILED"
-            return False, "Authentication failed or permission not granted"
+            return (False, "Authentication failed or permission not granted",
+                    session)
 
         # Download the user profile and cache a local instance of the
         # basic profile info
@@ -0,0 +1,133 @@
+import time
+import logging
+import threading
+
+from multiprocessing.pool import ThreadPool
+
+logger = logging.getLogger(__name__)
+
+WORKERS = 4
+MAX_PENDING = 1000
+# Seconds a finished job is kept waiting for the user agent to come back
+LIFETIME = 300
+# Seconds the user agent is asked to wait before it asks again
+RETRY_AFTER = 1
+# Seconds a request waits for its job before the user agent is asked to
+# come back
+WAIT = 2
+
+
+class Job(object):
+    def __init__(self):
+        self.created = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class OffloadQueue(object):
+    """
+    Runs the calls to the social services on a few worker threads instead
+    of in the request threads. When a callback arrives the call is handed
+    to a worker and the request waits a short while for it. Only if the
+    call takes longer than that is the user agent asked to come back, and
+    when it does and the call has finished the result is picked up. So a
+    slow provider only occupies the workers and not the threads that serve
+    requests, while logins through a fast one take no extra round trip.
+
+    Jobs are kept in memory, so the user agent has to come back to the same
+    process.
+    """
+
+    def __init__(self, workers=WORKERS, max_pending=MAX_PENDING,
+                 lifetime=LIFETIME, wait=WAIT):
+        """
+        :param workers: Number of worker threads
+        :param max_pending: Max number of jobs queued or running, when
+            there are more the calls are made in the request thread
+        :param lifetime: Seconds a finished job is kept
+        :param wait: Seconds a request waits for its job to finish
+        """
+        self.workers = workers
+        self.max_pending = max_pending
+        self.lifetime = lifetime
+        self.wait = wait
+        self._jobs = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._pool = None
+        self._purged = time.time()
+
+    def _run(self, job, func, args):
+        try:
+            job.result = func(*args)
+        except Exception, err:
+            job.error = err
+        finally:
+            with self._lock:
+                self._pending -= 1
+            job.done.set()
+
+    def _purge(self, now):
+        if now - self._purged < 10:
+            return
+        self._purged = now
+        for key, job in self._jobs.items():
+            if job.done.is_set() and now - job.created > self.lifetime:
+                del self._jobs[key]
+
+    def __call__(self, key, func, args):
+        """
+        Runs func(*args) in the background, once per key.
+
+        :param key: Identifies the job, the session id
+        :return: None if the user agent has to come back later, otherwise
+            what func returned. If func raised an exception it is raised
+            here.
+        """
+        now = time.time()
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is None and self._pending < self.max_pending:
+                if self._pool is None:
+                    # Created here so that it isn't created before a fork
+                    self._pool = ThreadPool(self.workers)
+                self._purge(now)
+                job = self._jobs[key] = Job()
+                self._pending += 1
+                self._pool.apply_async(self._run, (job, func, args))
+
+        if job is None:
+            logger.warning("Offload queue is full, running in request thread")
+            return func(*args)
+
+        if not job.done.wait(self.wait):
+            return None
+        with self._lock:
+            if self._jobs.get(key) is job:
+                del self._jobs[key]
+
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def stats(self):
+        return {"jobs": len(self._jobs), "pending": self._pending,
+                "workers": self.workers}
+
+
+def please_wait(environ, start_response, cookie, retry_after=RETRY_AFTER):
+    """ Asks the user agent to make the same request again """
+    url = environ.get("SCRIPT_NAME", "") + environ.get("PATH_INFO", "")
+    if environ.get("QUERY_STRING"):
+        url += "?" + environ["QUERY_STRING"]
+    url = url.replace("&", "&amp;").replace('"', "&quot;")
+
+    body = ('<html><head><meta http-equiv="refresh" content="%d;url=%s">'
+            '<title>Logging in</title></head>'
+            '<body>Logging in, please wait...</body></html>' % (retry_after,
+                                                               url))
+    start_response("200 OK", [("Content-Type", "text/html"),
+                              ("Retry-After", str(retry_after)),
+                              ("Cache-Control", "no-store"), cookie])
+    return [body]
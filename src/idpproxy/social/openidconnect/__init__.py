@@ -2,6 +2,8 @@ import copy
 import traceback
 from oic.utils.authn.client import CLIENT_AUTHN_METHOD
 from idpproxy.social import Social
+from idpproxy.social.openidconnect.provider import PROVIDERS
+from idpproxy.social.openidconnect.provider import REGISTRATIONS
 from oic import oic
 #from oic.oic import consumer
 from oic.oauth2 import rndstr
@@ -11,11 +13,47 @@ from oic.oic.message import AuthorizationResponse
 from oic.oic.message import AuthorizationRequest
 from oic.oic.message import AccessTokenResponse
 
+from multiprocessing.pool import ThreadPool
+
 import logging
 import sys
+import threading
 
 logger = logging.getLogger(__name__)
 
+# Max number of provider calls run in the background at the same time
+POOL_SIZE = 10
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def thread_pool():
+    """ The pool is created the first time it's needed, so that it isn't
+    created before a server forks """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPool(POOL_SIZE)
+    return _pool
+
+
+def login_client(template):
+    """
+    The client template holds what is the same for all logins against a
+    provider; endpoints, keys and credentials. The grants, that is the per
+    login state, are kept in a copy of the template that only lives as
+    long as the request does.
+
+    :param template: The client template
+    :return: A client for one login
+    """
+    client = copy.copy(template)
+    client.grant = {}
+    client.state = None
+    return client
+
 
 def token_secret_key(sid):
     return "token_secret_%s" % sid
@@ -46,20 +84,35 @@ class OpenIDConnect(Social):
         self.authn_method = None
 
     def dynamic(self, server_env, callback, session):
+        """
+        The provider configuration and the registration are cached and
+        shared, a new client is only built when the provider configuration
+        has been refreshed.
+        """
+        pcr = PROVIDERS(self.srv_discovery_url, self.transport)
+        logger.debug("Got provider config: %s" % pcr)
+        session["service"] = pcr["issuer"]
+
         try:
             client = server_env["OIC_CLIENT"][self.srv_discovery_url]
         except KeyError:
+            client = None
+
+        if client is None or client.provider_info is not pcr:
             client = self.client_cls(client_authn_method=CLIENT_AUTHN_METHOD)
+            self.transport.bind(client)
             client.redirect_uris = [callback]
+            client.handle_provider_config(pcr, self.srv_discovery_url)
+            client.provider_info = pcr
             _me = ME.copy()
             _me["redirect_uris"] = [callback]
 
-            provider_conf = client.provider_config(self.srv_discovery_url)
-            logger.debug("Got provider config: %s" % provider_conf)
-            session["service"] = provider_conf["issuer"]
-            logger.debug("Registering RP")
-            reg_info = client.register(provider_conf["registration_endpoint"],
-                                       **_me)
+            def register():
+                logger.debug("Registering RP")
+                return client.register(pcr["registration_endpoint"], **_me)
+
+            reg_info = REGISTRATIONS(self.srv_discovery_url, callback,
+                                     register)
             logger.debug("Registration response: %s" % reg_info)
             for prop in ["client_id", "client_secret"]:
                 try:
@@ -75,22 +128,39 @@ class OpenIDConnect(Social):
         return client
 
     def static(self, server_env, callback, session):
+        key = (self.name, self.client_id)
         try:
-            client = server_env["OIC_CLIENT"][self.extra["authorization"]]
-            logger.debug("Static client: %s" % server_env["OIC_CLIENT"])
+            return server_env["OIC_CLIENT"][key]
         except KeyError:
-            client = self.client_cls(client_authn_method=CLIENT_AUTHN_METHOD)
-            client.redirect_uris = [callback]
-            for typ in ["authorization", "token", "userinfo"]:
-                endpoint = "%s_endpoint" % typ
-                setattr(client, endpoint, self.extra[endpoint])
+            pass
+
+        client = self.client_cls(client_authn_method=CLIENT_AUTHN_METHOD)
+        self.transport.bind(client)
+        client.redirect_uris = [callback]
+        for typ in ["authorization", "token", "userinfo"]:
+            endpoint = "%s_endpoint" % typ
+            setattr(client, endpoint, self.extra[endpoint])
 
-            client.client_id = self.client_id
-            client.client_secret = self.client_secret
-            #client.keyjar.add_hmac("", self.client_secret, ["sig", "enc"])
+        client.client_id = self.client_id
+        client.client_secret = self.client_secret
+        #client.keyjar.add_hmac("", self.client_secret, ["sig", "enc"])
 
+        try:
+            server_env["OIC_CLIENT"][key] = client
+        except KeyError:
+            server_env["OIC_CLIENT"] = {key: client}
         return client
 
+    def client_template(self, server_env, callback, session):
+        """
+        :return: The shared client for the provider, it must not be used
+            for a login as is, see login_client
+        """
+        if self.srv_discovery_url:
+            return self.dynamic(server_env, callback, session)
+        else:
+            return self.static(server_env, callback, session)
+
     #noinspection PyUnusedLocal
     def begin(self, environ, server_env, start_response, cookie, sid, info):
         """Step 1: Get a access grant.
@@ -108,19 +178,12 @@ class OpenIDConnect(Social):
         session = server_env["CACHE"][sid]
         callback = server_env["base_url"] + self.social_endpoint
 
-        if self.srv_discovery_url:
-            client = self.dynamic(server_env, callback, session)
-        else:
-            client = self.static(server_env, callback, session)
-
-        try:
-            server_env["OIC_CLIENT"][self.name] = client
-        except KeyError:
-            server_env["OIC_CLIENT"] = {self.name: client}
+        client = login_client(self.client_template(server_env, callback,
+                                                   session))
 
         logger.debug("Session: %s" % session)
-        logger.debug("Session_id: %s" % session["req_info"].message.id)
-        _state = copy.copy(session["req_info"].message.id)
+        logger.debug("Session_id: %s" % session["req_info"].id)
+        _state = session["req_info"].id
 
         request_args = {
             "response_type": self.flow_type,
@@ -173,7 +236,7 @@ class OpenIDConnect(Social):
 
     def get_accesstoken(self, client, authresp):
         if self.srv_discovery_url:
-            issuer = client.provider_info.keys()[0]
+            issuer = client.provider_info["issuer"]
             #logger.debug("state: %s (%s)" % (client.state, msg["state"]))
             key = client.keyjar.get_verify_key(owner=issuer)
             kwargs = {"key": key}
@@ -190,7 +253,7 @@ class OpenIDConnect(Social):
             **kwargs)
 
     #noinspection PyUnusedLocal
-    def verify_token(self, client, access_token):
+    def verify_token(self, client, access_token, tokenresp=None):
         return {}
 
     def get_userinfo(self, client, authresp, access_token, **kwargs):
@@ -200,24 +263,50 @@ class OpenIDConnect(Social):
                                            access_token=access_token,
                                            **kwargs)
 
+    def verify_and_get_userinfo(self, client, authresp, access_token,
+                                tokenresp=None):
+        """
+        verify_token and get_userinfo only depend on the access token, so
+        the token is verified in the background while the userinfo is
+        fetched. An exception from either of them is raised here.
+
+        :return: A (verification result, userinfo response) tuple
+        """
+        if self.verify_token.im_func is OpenIDConnect.verify_token.im_func:
+            # Nothing to wait for
+            return (self.verify_token(client, access_token, tokenresp),
+                    self.get_userinfo(client, authresp, access_token))
+
+        verified = thread_pool().apply_async(
+            self.verify_token, (client, access_token, tokenresp))
+        inforesp = self.get_userinfo(client, authresp, access_token)
+        return verified.get(), inforesp
+
     #noinspection PyUnusedLocal
     def phaseN(self, environ, info, server_env, sid):
         """Step 2: Once the consumer has redirected the user back to the
         callback URL you can request the access token the user has
         approved."""
 
-        client = server_env["OIC_CLIENT"][self.name]
+        session = server_env["CACHE"][sid]
+        callback = server_env["base_url"] + self.social_endpoint
+        client = login_client(self.client_template(server_env, callback,
+                                                   session))
+        client.state = session["state"]
         logger.debug("info: %s" % info)
         logger.debug("keyjar: %s" % client.keyjar)
 
         authresp = client.parse_response(AuthorizationResponse, info,
                                          sformat="dict")
 
-        session = server_env["CACHE"][sid]
         if isinstance(authresp, ErrorResponse):
             session["authentication"] = "FAILED"
             return False, "Access denied", session
 
+        if authresp.get("state") != session["state"]:
+            session["authentication"] = "FAILED"
+            return False, "State mismatch", session
+
         #session.session_id = msg["state"]
 
         logger.debug("callback environ: %s" % environ)
@@ -236,11 +325,11 @@ class OpenIDConnect(Social):
 
             access_token = tokenresp["access_token"]
         else:
+            tokenresp = authresp
             access_token = authresp["access_token"]
 
-        userinfo = self.verify_token(client, access_token)
-
-        inforesp = self.get_userinfo(client, authresp, access_token)
+        userinfo, inforesp = self.verify_and_get_userinfo(
+            client, authresp, access_token, tokenresp)
 
         if isinstance(inforesp, ErrorResponse):
             return False, "Invalid response %s." % inforesp["error"], session
@@ -0,0 +1,226 @@
+import os
+import json
+import time
+import fcntl
+import logging
+import tempfile
+import threading
+
+from oic.oic import OIDCONF_PATTERN
+from oic.oic.message import ProviderConfigurationResponse
+from oic.oic.message import RegistrationResponse
+
+from idpproxy.social.transport import TRANSPORT
+from idpproxy.social.transport import cache_ttl
+
+logger = logging.getLogger(__name__)
+
+# Used when the provider doesn't say for how long its configuration can be
+# cached
+DEFAULT_TTL = 3600
+# A registration is renewed this many seconds before its secret expires
+EXPIRY_MARGIN = 300
+
+
+class ProviderError(Exception):
+    pass
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Makes sure only one thread at the time does the work for a key. Threads
+    that ask for the same key while the work is being done wait for it to
+    finish and get the same result, or exception.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, key, func, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args)
+            return call.result
+        except Exception, err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+
+class ProviderCache(object):
+    """
+    Keeps discovered OpenID Connect provider configurations for as long as
+    the provider allows them to be cached. If the configuration can't be
+    fetched again when it has expired the old one is used until it can.
+    """
+
+    def __init__(self, transport=TRANSPORT, default_ttl=DEFAULT_TTL):
+        self.transport = transport
+        self.default_ttl = default_ttl
+        # issuer -> (ProviderConfigurationResponse, expires)
+        self._info = {}
+        self._flight = SingleFlight()
+
+    def fetch(self, issuer, transport=None):
+        transport = transport or self.transport
+        url = OIDCONF_PATTERN % issuer.rstrip("/")
+        r = transport.request("GET", url)
+        if r.status_code != 200:
+            raise ProviderError("Trying '%s', status %s" % (url,
+                                                           r.status_code))
+
+        pcr = ProviderConfigurationResponse().from_json(r.text)
+        ttl = cache_ttl(dict([(k.lower(), v) for k, v in r.headers.items()]),
+                        self.default_ttl)
+        logger.debug("Got provider config for %s, valid for %d seconds" % (
+            issuer, ttl))
+        self._info[issuer] = (pcr, time.time() + ttl)
+        return pcr
+
+    def _refresh(self, issuer, transport):
+        try:
+            return self.fetch(issuer, transport)
+        except Exception, err:
+            try:
+                pcr, _ = self._info[issuer]
+            except KeyError:
+                raise err
+            logger.warning("Using old provider config for %s: %s" % (issuer,
+                                                                     err))
+            return pcr
+
+    def __call__(self, issuer, transport=None):
+        """
+        :param issuer: The issuer URL
+        :return: A ProviderConfigurationResponse instance
+        """
+        try:
+            pcr, expires = self._info[issuer]
+        except KeyError:
+            pass
+        else:
+            if expires > time.time():
+                return pcr
+
+        return self._flight(issuer, self._refresh, issuer, transport)
+
+    def clear(self):
+        self._info.clear()
+
+
+class RegistrationStore(object):
+    """
+    Keeps the result of dynamic client registrations, so that the proxy
+    registers once per provider and redirect URI and not once per process
+    start. If a filename is given the registrations are kept in that file
+    as JSON and are shared by all processes that use the same file. The
+    file is locked while a registration is done, so that only one process
+    registers.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        # key -> registration response as a dictionary
+        self._reg = {}
+        self._flight = SingleFlight()
+
+    @staticmethod
+    def key(issuer, redirect_uri):
+        return "%s %s" % (issuer, redirect_uri)
+
+    @staticmethod
+    def valid(reg):
+        expires = reg.get("client_secret_expires_at", 0)
+        return not expires or expires - EXPIRY_MARGIN > time.time()
+
+    def _read(self):
+        try:
+            _fil = open(self.filename)
+        except IOError:
+            return {}
+        try:
+            return json.load(_fil)
+        except ValueError:
+            logger.error("Can't parse %s, ignoring it" % self.filename)
+            return {}
+        finally:
+            _fil.close()
+
+    def _write(self, regs):
+        _dir = os.path.dirname(os.path.abspath(self.filename))
+        fd, tmp = tempfile.mkstemp(dir=_dir)
+        try:
+            with os.fdopen(fd, "w") as _fil:
+                json.dump(regs, _fil, indent=1)
+            os.rename(tmp, self.filename)
+        except Exception:
+            os.unlink(tmp)
+            raise
+
+    def _register(self, key, register):
+        if not self.filename:
+            reg = register().to_dict()
+            self._reg[key] = reg
+            return reg
+
+        lock = open(self.filename + ".lock", "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            regs = self._read()
+            reg = regs.get(key)
+            if reg is None or not self.valid(reg):
+                reg = register().to_dict()
+                regs[key] = reg
+                self._write(regs)
+            else:
+                logger.debug("Registered by another process: %s" % key)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+        self._reg[key] = reg
+        return reg
+
+    def __call__(self, issuer, redirect_uri, register):
+        """
+        :param issuer: The issuer URL
+        :param redirect_uri: The redirect URI that is registered
+        :param register: Function that does the registration and returns a
+            RegistrationResponse
+        :return: A RegistrationResponse instance
+        """
+        key = self.key(issuer, redirect_uri)
+        reg = self._reg.get(key)
+        if reg is None and self.filename:
+            reg = self._read().get(key)
+        if reg is None or not self.valid(reg):
+            reg = self._flight(key, self._register, key, register)
+        else:
+            self._reg[key] = reg
+        return RegistrationResponse(**reg)
+
+# Shared by all handlers
+PROVIDERS = ProviderCache()
+REGISTRATIONS = RegistrationStore()
@@ -0,0 +1,239 @@
+from __future__ import absolute_import
+
+import re
+import time
+import logging
+import cookielib
+import threading
+
+from urlparse import urlparse
+from urlparse import urlunparse
+from urlparse import parse_qs
+from email.utils import mktime_tz
+from email.utils import parsedate_tz
+
+import requests
+import oauth2 as oauth
+
+from requests.adapters import HTTPAdapter
+
+from idpproxy.social.breaker import CircuitOpen
+
+logger = logging.getLogger(__name__)
+
+POOL_SIZE = 10
+IDLE_TIMEOUT = 60
+# (connect, read) timeout in seconds
+TIMEOUT = (5, 30)
+
+FORM_ENCODED = "application/x-www-form-urlencoded"
+
+MAX_AGE = re.compile(r"max-age\s*=\s*(\d+)")
+
+
+def host_key(url):
+    part = urlparse(url)
+    return "%s://%s" % (part.scheme, part.netloc)
+
+
+def cache_ttl(headers, default=0):
+    """
+    :param headers: The headers of a HTTP response
+    :param default: What to use if the response doesn't say
+    :return: The number of seconds the response can be cached
+    """
+    _cc = headers.get("cache-control", "")
+    if "no-cache" in _cc or "no-store" in _cc:
+        return 0
+    match = MAX_AGE.search(_cc)
+    if match:
+        return int(match.group(1))
+
+    _date = parsedate_tz(headers.get("expires", ""))
+    if _date is not None:
+        return max(0, int(mktime_tz(_date) - time.time()))
+    return default
+
+
+class HTTPClient(object):
+    """ What the handlers need on top of request """
+
+    def request(self, method, url, **kwargs):
+        raise NotImplementedError()
+
+    def bind(self, client):
+        """
+        Makes an oic/oauth2 client send all its requests through this
+        transport.
+
+        :param client: An oic.oauth2.Client instance
+        :return: The client
+        """
+        def http_request(url, method="GET", **kwargs):
+            _kwargs = client.request_args.copy()
+            _kwargs.update(kwargs)
+            return self.request(method, url, **_kwargs)
+
+        client.http_request = http_request
+        return client
+
+    def oauth_request(self, consumer, url, method="GET", body="", token=None):
+        """
+        Sends a signed OAuth 1.0a request, the same way oauth2.Client does
+        but without creating a new connection.
+
+        :param consumer: A oauth2.Consumer instance
+        :param url: The URL
+        :param method: The HTTP method
+        :param body: The body of a POST request
+        :param token: A oauth2.Token instance or None
+        :return: A (response, content) tuple in the same format as
+            oauth2.Client.request returns, that is the response is a
+            dictionary where the status is kept as a string under 'status'.
+        """
+        headers = {}
+        if method == "POST":
+            headers["Content-Type"] = FORM_ENCODED
+            parameters = parse_qs(body) if body else None
+        else:
+            parameters = None
+
+        req = oauth.Request.from_consumer_and_token(
+            consumer, token=token, http_method=method, http_url=url,
+            parameters=parameters, body=body,
+            is_form_encoded=(method == "POST"))
+        req.sign_request(oauth.SignatureMethod_HMAC_SHA1(), consumer, token)
+
+        if method == "POST":
+            body = req.to_postdata()
+        elif method == "GET":
+            url = req.to_url()
+        else:
+            part = urlparse(url)
+            realm = urlunparse((part.scheme, part.netloc, "", None, None,
+                                None))
+            headers.update(req.to_header(realm=realm))
+
+        r = self.request(method, url, data=body or None, headers=headers)
+        resp = dict([(k.lower(), v) for k, v in r.headers.items()])
+        resp["status"] = str(r.status_code)
+        return resp, r.content
+
+
+class Transport(HTTPClient):
+    """
+    Keeps one pooled HTTP session per provider host, so that the connections
+    to the few hosts the proxy talks to are kept alive and reused between
+    logins. A session that has not been used for idle_timeout seconds is
+    closed and replaced, since the provider has most likely closed the
+    connections at its end by then. Can be shared by many threads.
+    """
+
+    def __init__(self, pool_size=POOL_SIZE, idle_timeout=IDLE_TIMEOUT,
+                 timeout=TIMEOUT):
+        """
+        :param pool_size: Max number of kept connections per host
+        :param idle_timeout: Seconds before an unused host pool is dropped
+        :param timeout: Default timeout per call, a number or a
+            (connect, read) tuple
+        """
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        # scheme://host -> [session, last used]
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _new_session(self):
+        session = requests.Session()
+        # The session is shared between users, so no cookies must be kept
+        session.cookies.set_policy(
+            cookielib.DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def session(self, url):
+        """
+        :param url: The URL that is to be requested
+        :return: The requests.Session for the host of the URL
+        """
+        key = host_key(url)
+        now = time.time()
+        stale = None
+        with self._lock:
+            try:
+                item = self._sessions[key]
+            except KeyError:
+                item = self._sessions[key] = [self._new_session(), now]
+            else:
+                if now - item[1] > self.idle_timeout:
+                    stale = item[0]
+                    item[0] = self._new_session()
+                item[1] = now
+            session = item[0]
+
+        if stale is not None:
+            logger.debug("Replacing idle connection pool for %s" % key)
+            stale.close()
+        return session
+
+    def request(self, method, url, **kwargs):
+        """
+        Same arguments as requests.request
+
+        :return: A requests.Response instance
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session(url).request(method, url, **kwargs)
+
+    def for_provider(self, breaker, timeout=None):
+        """
+        :param breaker: The CircuitBreaker of the provider
+        :param timeout: Timeout for calls to the provider, if not the default
+        :return: A ProviderTransport
+        """
+        return ProviderTransport(self, breaker, timeout)
+
+    def clear(self):
+        """ Closes all the kept connections """
+        with self._lock:
+            sessions = [item[0] for item in self._sessions.values()]
+            self._sessions.clear()
+        for session in sessions:
+            session.close()
+
+class ProviderTransport(HTTPClient):
+    """
+    The part of a transport one provider uses. The calls go through the
+    circuit breaker of the provider. A call that raises an exception or
+    gets a 5xx response counts as a failure.
+    """
+
+    def __init__(self, transport, breaker, timeout=None):
+        self.transport = transport
+        self.breaker = breaker
+        self.timeout = timeout
+
+    def available(self):
+        return self.breaker.available()
+
+    def request(self, method, url, **kwargs):
+        if not self.breaker.allow():
+            raise CircuitOpen("%s is not available" % self.breaker.name)
+        if self.timeout is not None:
+            kwargs.setdefault("timeout", self.timeout)
+        try:
+            r = self.transport.request(method, url, **kwargs)
+        except Exception:
+            self.breaker.failure()
+            raise
+        if r.status_code >= 500:
+            self.breaker.failure()
+        else:
+            self.breaker.success()
+        return r
+
+# Used by handlers that are not given a transport of their own
+TRANSPORT = Transport()
@@ -0,0 +1,401 @@
+import re
+import copy
+import logging
+
+from xml.etree.ElementTree import _escape_attrib
+from xml.etree.ElementTree import _escape_cdata
+
+from saml2 import saml
+from saml2 import class_name
+from saml2.assertion import Assertion
+from saml2.assertion import Policy
+from saml2.s_utils import MissingValue
+from saml2.s_utils import rndstr
+from saml2.s_utils import sid
+from saml2.server import AUTHN_DICT_MAP
+from saml2.sigver import pre_signature_part
+from saml2.time_util import instant
+
+from idpproxy.utils import LRUCache
+from idpproxy.utils import add_post_load_process
+
+logger = logging.getLogger(__name__)
+
+# Max number of response templates kept
+MAX_SIZE = 1000
+
+# The values that change with every response, the attribute values and
+# the NameID aside
+FIELDS = ["response_id", "response_instant", "in_response_to",
+          "assertion_id", "assertion_instant", "not_before",
+          "not_on_or_after", "subject_not_on_or_after", "authn_instant",
+          "session_index"]
+
+# A shape no template could be made for
+FAILED = object()
+
+ASSERTION = class_name(saml.Assertion())
+
+
+class Fallback(Exception):
+    pass
+
+
+def _shape(ava):
+    """
+    The attribute names and how many values each has, which together with
+    the SP decide what the attribute statement looks like.
+
+    :param ava: The attributes and values after the release policy is applied
+    :return: A hashable description or None if the values are of a kind
+        templates aren't made for
+    """
+    shape = []
+    for attr, vals in ava.items():
+        if isinstance(vals, basestring):
+            shape.append((attr, bool(vals)))
+        elif isinstance(vals, list) and \
+                all([isinstance(v, basestring) for v in vals]):
+            shape.append((attr, tuple([bool(v) for v in vals])))
+        else:
+            return None
+    return tuple(sorted(shape))
+
+
+def _attribute_values(ava):
+    """ The non empty attribute values by (attribute, index) """
+    values = {}
+    for attr, vals in ava.items():
+        if isinstance(vals, basestring):
+            vals = [vals]
+        for index, val in enumerate(vals):
+            if val:
+                values[(attr, index)] = val
+    return values
+
+
+class Template(object):
+    """
+    A serialized response with the values that change from one response to
+    the next cut out.
+    """
+
+    def __init__(self, xml, tokens):
+        """
+        :param xml: The serialized response, with tokens for the values
+        :param tokens: token -> field
+        """
+        self.parts = []
+        pattern = re.compile("|".join([re.escape(t) for t in tokens]))
+        pos = 0
+        for match in pattern.finditer(xml):
+            self.parts.append(xml[pos:match.start()])
+            # Within a tag the value is an attribute value, otherwise text.
+            # Both are escaped the way ElementTree does it.
+            if xml.rfind("<", 0, match.start()) > xml.rfind(
+                    ">", 0, match.start()):
+                escape = _escape_attrib
+            else:
+                escape = _escape_cdata
+            self.parts.append((tokens[match.group()], escape))
+            pos = match.end()
+        self.parts.append(xml[pos:])
+
+    def fill(self, values):
+        """
+        :param values: field -> value
+        :return: The serialized response
+        """
+        res = []
+        for part in self.parts:
+            if isinstance(part, tuple):
+                res.append(part[1](values[part[0]], "UTF-8"))
+            else:
+                res.append(part)
+        return "".join(res)
+
+
+class ResponseTemplates(object):
+    """
+    Builds authentication responses from templates instead of from a tree
+    of pysaml2 objects. Responses to the same SP with the same issuer,
+    NameID format, authentication context and attributes only differ in
+    their IDs, timestamps, NameID and attribute values. The first time such
+    a response is made it's made the pysaml2 way, a second time with
+    tokens in place of those values, which gives the template. The template
+    is only used if filled in with the values of the first response it
+    gives exactly the same bytes, so canonicalization and signing aren't
+    affected.
+
+    Everything the templates don't cover, like encryption, signed responses
+    or error responses, is left to Server.create_authn_response. The
+    templates are forgotten when the metadata is reloaded.
+
+    Unlike Server.create_authn_response the assertions aren't kept in the
+    session storage, the proxy doesn't answer assertion ID requests or
+    authentication queries.
+    """
+
+    def __init__(self, idp, max_size=MAX_SIZE):
+        """
+        :param idp: The saml2.server.Server instance
+        :param max_size: Max number of templates kept
+        """
+        self.idp = idp
+        self.max_size = max_size
+        self._templates = LRUCache(max_size)
+        self.hits = 0
+        self.misses = 0
+        self.fallbacks = 0
+        add_post_load_process(idp.metadata, self.clear)
+
+    def __call__(self, identity, in_response_to, destination, sp_entity_id,
+                 name_id_policy=None, userid=None, authn=None,
+                 sign_assertion=None, issuer=None, **kwargs):
+        """
+        Same as Server.create_authn_response.
+
+        :return: The response as a string
+        """
+        try:
+            return self._response(identity, in_response_to, destination,
+                                  sp_entity_id, name_id_policy, userid,
+                                  authn, sign_assertion, issuer)
+        except Fallback, err:
+            logger.debug("No response template: %s" % err)
+            self.fallbacks += 1
+        return self.idp.create_authn_response(
+            identity, in_response_to, destination, sp_entity_id,
+            name_id_policy, userid, authn=authn,
+            sign_assertion=sign_assertion, issuer=issuer, **kwargs)
+
+    def _check(self, sign):
+        """ Raises Fallback if Server.create_authn_response would do
+        something the templates don't """
+        idp = self.idp
+        for opt in ["sign_response", "encrypt_assertion"]:
+            if idp.config.getattr(opt, "idp"):
+                raise Fallback(opt)
+        if sign and idp.sec.cert_handler.generate_cert():
+            raise Fallback("Generated certificates")
+
+    def _name_id(self, userid, sp_entity_id, name_id_policy, policy):
+        """ The NameID, found or made the way create_authn_response does
+        it """
+        try:
+            snq = name_id_policy.sp_name_qualifier
+        except AttributeError:
+            snq = sp_entity_id
+        if not snq:
+            snq = sp_entity_id
+
+        kwa = {"sp_name_qualifier": snq}
+        try:
+            kwa["format"] = name_id_policy.format
+        except AttributeError:
+            pass
+
+        try:
+            _nids = self.idp.ident.find_nameid(userid, **kwa)
+            if _nids:
+                return _nids[0]
+            return self.idp.ident.construct_nameid(userid, policy,
+                                                   sp_entity_id,
+                                                   name_id_policy)
+        except IOError, err:
+            raise Fallback(err)
+
+    def _build(self, ava, in_response_to, destination, sp_entity_id, name_id,
+               authn_args, issuer, policy, sign):
+        """ The response the way Server._authn_response makes it """
+        idp = self.idp
+        ast = Assertion(ava)
+        assertion = ast.construct(sp_entity_id, in_response_to, destination,
+                                  name_id, idp.config.attribute_converters,
+                                  policy, issuer=idp._issuer(issuer),
+                                  **authn_args)
+        if sign:
+            assertion.signature = pre_signature_part(assertion.id,
+                                                     idp.sec.my_cert, 1)
+        return idp._response(in_response_to, destination, None, issuer,
+                             assertion=assertion)
+
+    @staticmethod
+    def _set(response, values):
+        """ Sets the values that change with every response """
+        assertion = response.assertion
+        response.id = values["response_id"]
+        response.issue_instant = values["response_instant"]
+        assertion.id = values["assertion_id"]
+        assertion.issue_instant = values["assertion_instant"]
+        assertion.conditions.not_before = values["not_before"]
+        assertion.conditions.not_on_or_after = values["not_on_or_after"]
+        assertion.subject.subject_confirmation[
+            0].subject_confirmation_data.not_on_or_after = values[
+            "subject_not_on_or_after"]
+        if assertion.authn_statement:
+            assertion.authn_statement[0].authn_instant = values[
+                "authn_instant"]
+            assertion.authn_statement[0].session_index = values[
+                "session_index"]
+
+    @staticmethod
+    def _get(response):
+        """ The values that change with every response """
+        assertion = response.assertion
+        values = {
+            "response_id": response.id,
+            "response_instant": response.issue_instant,
+            "in_response_to": response.in_response_to,
+            "assertion_id": assertion.id,
+            "assertion_instant": assertion.issue_instant,
+            "not_before": assertion.conditions.not_before,
+            "not_on_or_after": assertion.conditions.not_on_or_after,
+            "subject_not_on_or_after": assertion.subject.subject_confirmation[
+                0].subject_confirmation_data.not_on_or_after,
+            "name_id": assertion.subject.name_id.text}
+        if assertion.authn_statement:
+            values["authn_instant"] = assertion.authn_statement[
+                0].authn_instant
+            values["session_index"] = assertion.authn_statement[
+                0].session_index
+        return values
+
+    def _compile(self, ava, in_response_to, destination, sp_entity_id,
+                 name_id, authn_args, issuer, policy, sign):
+        """
+        Makes the response the pysaml2 way and a template for responses
+        like it.
+
+        :return: A (template, values, xml) tuple, the template is FAILED if
+            none could be made
+        """
+        response = self._build(ava, in_response_to, destination,
+                               sp_entity_id, name_id, authn_args, issuer,
+                               policy, sign)
+        xml = "%s" % response
+        values = self._get(response)
+        values.update(_attribute_values(ava))
+
+        # Tokens in the place of every value that changes. They are made up
+        # of characters that are never escaped, and the random prefix keeps
+        # them from being mistaken for anything else in the response.
+        prefix = "tmpl%s" % rndstr(16)
+        tokens = {}
+        fields = {}
+
+        def token(field):
+            fields[field] = "%s%d_" % (prefix, len(fields))
+            tokens[fields[field]] = field
+            return fields[field]
+
+        token_ava = {}
+        for attr, vals in ava.items():
+            if isinstance(vals, basestring):
+                token_ava[attr] = token((attr, 0)) if vals else vals
+            else:
+                token_ava[attr] = [token((attr, index)) if val else val
+                                   for index, val in enumerate(vals)]
+        token_name_id = copy.copy(name_id)
+        token_name_id.text = token("name_id")
+
+        response = self._build(token_ava, token("in_response_to"),
+                               destination, sp_entity_id, token_name_id,
+                               authn_args, issuer, policy, False)
+        self._set(response, dict([(f, token(f)) for f in FIELDS
+                                  if f != "in_response_to"]))
+        if sign:
+            response.assertion.signature = pre_signature_part(
+                response.assertion.id, self.idp.sec.my_cert, 1)
+
+        template = Template("%s" % response, tokens)
+        try:
+            if template.fill(values) != xml:
+                raise ValueError("Not the same response")
+        except Exception, err:
+            logger.info("No template for responses to %s: %s" % (
+                sp_entity_id, err))
+            template = FAILED
+        return template, values, xml
+
+    def _response(self, identity, in_response_to, destination, sp_entity_id,
+                  name_id_policy, userid, authn, sign_assertion, issuer):
+        idp = self.idp
+        if sign_assertion is None:
+            sign_assertion = idp.config.getattr("sign_assertion", "idp")
+        sign = bool(sign_assertion)
+        self._check(sign)
+
+        policy = idp.config.getattr("policy", "idp")
+        name_id = self._name_id(userid, sp_entity_id, name_id_policy, policy)
+        if policy is None:
+            policy = Policy()
+
+        ast = Assertion(identity)
+        ast.acs = idp.config.getattr("attribute_converters", "idp")
+        try:
+            ast.apply_policy(sp_entity_id, policy, idp.metadata)
+        except MissingValue, err:
+            # An error response
+            raise Fallback(err)
+        ava = dict(ast)
+
+        authn_args = dict([(AUTHN_DICT_MAP[k], v)
+                           for k, v in (authn or {}).items()
+                           if k in AUTHN_DICT_MAP])
+        shape = _shape(ava)
+        if shape is None:
+            raise Fallback("Attribute values")
+        key = (sp_entity_id, destination, issuer, sign, name_id.format,
+               name_id.name_qualifier, name_id.sp_name_qualifier,
+               name_id.sp_provided_id,
+               tuple(sorted([(k, v) for k, v in authn_args.items()
+                             if k != "authn_instant"])),
+               "authn_instant" in authn_args, shape)
+        try:
+            template = self._templates.get(key)
+        except TypeError:
+            raise Fallback("Authentication context")
+
+        if template is FAILED:
+            raise Fallback("Response can't be made from a template")
+        elif template is None:
+            self.misses += 1
+            template, values, xml = self._compile(
+                ava, in_response_to, destination, sp_entity_id, name_id,
+                authn_args, issuer, policy, sign)
+            self._templates[key] = template
+        else:
+            self.hits += 1
+            if authn_args.get("authn_instant"):
+                authn_instant = instant(time_stamp=authn_args["authn_instant"])
+            else:
+                authn_instant = instant()
+            values = {
+                "response_id": sid(),
+                "response_instant": instant(),
+                "in_response_to": in_response_to,
+                "assertion_id": sid(),
+                "assertion_instant": instant(),
+                "not_before": instant(),
+                "not_on_or_after": policy.not_on_or_after(sp_entity_id),
+                "subject_not_on_or_after": policy.not_on_or_after(
+                    sp_entity_id),
+                "name_id": name_id.text,
+                "authn_instant": authn_instant,
+                "session_index": sid()}
+            values.update(_attribute_values(ava))
+            xml = template.fill(values)
+
+        if sign:
+            return idp.sec.sign_statement(xml, node_name=ASSERTION,
+                                          node_id=values["assertion_id"])
+        return xml
+
+    def clear(self):
+        self._templates.clear()
+        logger.debug("Response templates cleared")
+
+    def stats(self):
+        return {"size": len(self._templates), "hits": self.hits,
+                "misses": self.misses, "fallbacks": self.fallbacks}
@@ -1,9 +1,20 @@
 __author__ = 'rohe0002'
 
 import os
+import ast
 import json
+import time
+import hashlib
+import threading
+import multiprocessing
+
+from collections import OrderedDict
+
+from Crypto import Random
+from Crypto.PublicKey import RSA
 
 from jwkest.jwe import JWE
+from jwkest.jwk import RSAKey
 
 import logging
 logger = logging.getLogger(__name__)
@@ -12,6 +23,8 @@ logger = logging.getLogger(__name__)
 class Info(object):
     def __init__(self):
         self.ava = {}
+        # Incremented every time new information is loaded
+        self.version = 0
 
     def update(self):
         return
@@ -25,42 +38,293 @@ class Info(object):
         except KeyError:
             return 0, self.ava["DEFAULT"][social_service]
 
+    def entity(self, entity_id):
+        """
+        :return: The information about an SP, or None
+        """
+        return self.ava.get(entity_id)
+
     def __call__(self):
         self.update()
 
 
+# Min number of seconds between checks whether the file has changed
+CHECK_INTERVAL = 10
+
+
+def parse_consumer_info(text, file_name=""):
+    """
+    The consumer info is either JSON or a Python dictionary literal. Nothing
+    in it is executed.
+
+    :param text: The content of the file
+    :param file_name: The name of the file, used to pick the format
+    :return: A dictionary
+    """
+    if file_name.endswith(".json"):
+        info = json.loads(text)
+    else:
+        info = ast.literal_eval(text)
+    if not isinstance(info, dict):
+        raise ValueError("Consumer info is not a dictionary")
+    return info
+
+
 class FileInfo(Info):
-    def __init__(self, file_name="", **kwargs):
+    """
+    Consumer info kept in a file. The file is read again when its
+    modification time, size or inode has changed, which is checked at most
+    every check_interval seconds.
+    """
+
+    def __init__(self, file_name="", check_interval=CHECK_INTERVAL, **kwargs):
         Info.__init__(self)
         self.file_name = file_name
-        self._mtime = 0
+        self.check_interval = check_interval
+        self._stat = None
+        self._checked = 0
+        self._lock = threading.Lock()
+        self.reloads = 0
+        # Seconds the last load took
+        self.reload_time = 0.0
         self.ava = {}
         # initial load
-        self.update()
+        self.update(force=True)
 
-    def update(self):
-        _timestamp = os.path.getmtime(self.file_name)
-        if self._mtime != _timestamp:
+    def update(self, force=False):
+        """
+        :return: True if new information was loaded
+        """
+        now = time.time()
+        if not force and now - self._checked < self.check_interval:
+            return False
+        # If another thread is checking there is no need to wait for it
+        if not self._lock.acquire(force):
+            return False
+        try:
+            self._checked = now
+            try:
+                stat = os.stat(self.file_name)
+            except OSError, err:
+                logger.error("Could not read consumer info file: %s" % err)
+                return False
+
+            _stat = (stat.st_mtime, stat.st_size, stat.st_ino)
+            if _stat == self._stat:
+                return False
+            # Whatever happens, don't try again until the file has changed
+            self._stat = _stat
+
+            start = time.time()
             try:
-                info = open(self.file_name).read()
+                _fil = open(self.file_name)
                 try:
-                    self.ava = eval(info)
-                except Exception, err:
-                    logger.error("Could not load consumer info: %s" % err)
-            except Exception, err:
+                    ava = parse_consumer_info(_fil.read(), self.file_name)
+                finally:
+                    _fil.close()
+            except IOError, err:
                 logger.error("Could not read consumer info file: %s" % err)
+                return False
+            except (ValueError, SyntaxError), err:
+                logger.error("Could not load consumer info: %s" % err)
+                return False
+
+            # Swapped in one go so readers never see a half loaded map
+            self.ava = ava
+            self.version += 1
+            self.reloads += 1
+            self.reload_time = time.time() - start
+            logger.info("Loaded consumer info from %s in %.3f seconds" % (
+                self.file_name, self.reload_time))
+            return True
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        return {"file": self.file_name, "version": self.version,
+                "reloads": self.reloads, "reload_time": self.reload_time}
 
 
 ENTITY_ATTR = 'urn:oasis:names:tc:SAML:metadata:attribute&EntityAttributes'
 ATTR_NAME = "http://social2saml.nordu.net/customer"
 
+# Fewer decryptions than this are not worth starting processes for
+MIN_PARALLEL = 50
+
+
+def decrypt_secret(jwe, text, entity_id, dkeys):
+    """
+    :param jwe: A JWE instance
+    :param text: The encrypted client information
+    :param entity_id: The entity ID the information must be meant for
+    :param dkeys: The keys to decrypt with
+    :return: The social secret or None if it's not for this entity
+    """
+    socialsecrets = json.loads(jwe.decrypt(text, dkeys))
+    try:
+        if entity_id in socialsecrets["entityId"]:  # Check the EntityID
+            if "secret" in socialsecrets:
+                return socialsecrets["secret"]
+    except KeyError:
+        pass
+    return None
+
+
+# The keys of a worker process, set by _init_worker
+_worker_keys = None
+
+
+def _init_worker(pems):
+    global _worker_keys
+    # The RNG state was copied by the fork and must not be shared
+    Random.atfork()
+    _worker_keys = [RSAKey(key=RSA.importKey(pem)) for pem in pems]
+
+
+def _decrypt_worker(item):
+    entity_id, text = item
+    try:
+        return decrypt_secret(JWE(), text, entity_id, _worker_keys), None
+    except Exception, err:
+        return None, "%s: %s" % (err.__class__.__name__, err)
+
+
+def add_post_load_process(metad, func):
+    """
+    Adds func to what is run when the metadata has been loaded, after what
+    was there before.
+    """
+    previous = getattr(metad, "post_load_process", None)
+    if previous is None:
+        metad.post_load_process = func
+        return
+
+    def post_load_process():
+        previous()
+        func()
+
+    metad.post_load_process = post_load_process
+
+
+class LRUCache(object):
+    """
+    A bounded mapping. When it's full the entry that was used longest ago
+    is dropped, so what is in use stays.
+    """
+
+    def __init__(self, max_size):
+        """
+        :param max_size: Max number of entries
+        """
+        self.max_size = max_size
+        # Least recently used first
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._cache.pop(key)
+            except KeyError:
+                return default
+            self._cache[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._cache.pop(key, None)
+            self._cache[key] = value
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+    def setdefault(self, key, value):
+        """ Adds the value unless there already is one, which is returned
+        instead """
+        with self._lock:
+            try:
+                value = self._cache.pop(key)
+            except KeyError:
+                pass
+            self._cache[key] = value
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+            return value
+
+    def peek(self, key, default=None):
+        """ Like get but doesn't count as a use of the entry """
+        with self._lock:
+            return self._cache.get(key, default)
+
+    def pop(self, key, *default):
+        with self._lock:
+            return self._cache.pop(key, *default)
+
+    def items(self):
+        """ Least recently used first """
+        with self._lock:
+            return self._cache.items()
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+
+def secret_attribute(item):
+    """
+    :param item: A parsed entity descriptor
+    :return: The attribute value holding the encrypted consumer info or
+        None if the entity has none
+    """
+    res = None
+    for sp in item.get("spsso_descriptor", []):
+        if "extensions" not in sp:
+            continue
+
+        for elem in sp["extensions"]["extension_elements"]:
+            if elem["__class__"] == ENTITY_ATTR:
+                for attr in elem["attribute"]:
+                    if attr["name"] == ATTR_NAME:
+                        for val in attr["attribute_value"]:
+                            res = val
+    return res
+
 
 class MetadataInfo(Info):
-    def __init__(self, dkeys, metad, **kwargs):
+    """
+    Consumer info kept encrypted in the SPs metadata. An SPs information is
+    decrypted the first time it's asked for, not when the metadata is
+    loaded. Decrypted information is remembered by the digest of the
+    ciphertext, so information that hasn't changed isn't decrypted again
+    when the metadata is reloaded. SPs that are looked up on demand, and so
+    weren't in the metadata when it was loaded, are found when asked for.
+    """
+
+    def __init__(self, dkeys, metad, eager=False, processes=None, memo=None,
+                 **kwargs):
+        """
+        :param dkeys: The keys to decrypt with
+        :param metad: The metadata
+        :param eager: If everything should be decrypted when the metadata
+            is loaded, which shows all problems at once
+        :param processes: Number of processes used to decrypt eagerly,
+            defaults to the number of CPUs
+        :param memo: Information decrypted earlier, e.g. kept in a metadata
+            snapshot
+        """
         Info.__init__(self)
         self.dkeys = dkeys
         self.metad = metad
-        metad.post_load_process = self
+        self.eager = eager
+        self.processes = processes
+        # entity_id -> attribute value
+        self._cipher = {}
+        # (ciphertext digest, entity_id) -> secret
+        self._memo = dict(memo or {})
+        self.decryptions = 0
+        add_post_load_process(metad, self)
         self.__call__()
 
     def decrypt_client_secrets(self, jwe, val, entity_id):
@@ -73,42 +337,117 @@ class MetadataInfo(Info):
         :return: The social secret
         """
         try:
-            _msg = jwe.decrypt(val["text"], self.dkeys)
-            socialsecrets = json.loads(_msg)
-            try:
-                if entity_id in socialsecrets["entityId"]:  # Check the EntityID
-                    if "secret" in socialsecrets:
-                        return socialsecrets["secret"]
-            except KeyError:
-                pass
+            return decrypt_secret(jwe, val["text"], entity_id, self.dkeys)
         except Exception, err:
             logger.warning(
                 'The secrets in the metadata cannot be used for the sp: %s' % (
                     entity_id), exc_info=True)
 
+    @staticmethod
+    def memo_key(val, entity_id):
+        return hashlib.sha256(val["text"].encode("utf-8")).digest(), entity_id
+
+    def _lookup(self, entity_id):
+        """ Entities that are looked up on demand weren't among the items
+        of the metadata when it was loaded """
+        try:
+            item = self.metad[entity_id]
+        except KeyError:
+            return None
+        return secret_attribute(item)
+
+    def entity(self, entity_id):
+        try:
+            val = self._cipher[entity_id]
+        except KeyError:
+            val = self._lookup(entity_id)
+            if val is None:
+                return None
+
+        _key = self.memo_key(val, entity_id)
+        try:
+            secret = self._memo[_key]
+        except KeyError:
+            secret = self.decrypt_client_secrets(JWE(), val, entity_id)
+            self.decryptions += 1
+            self._memo[_key] = secret
+        self.ava[entity_id] = secret
+        return secret
+
     def __call__(self):
+        """ Run when the metadata has been loaded """
         res = {}
-        jwe = JWE()
 
         for entid, item in self.metad.items():
-            if "spsso_descriptor" not in item:
-                continue
+            val = secret_attribute(item)
+            if val is not None:
+                res[entid] = val
+
+        # Only what is still in the metadata is remembered
+        in_use = set([self.memo_key(val, entid) for entid, val in res.items()])
+        self._memo = dict([(k, v) for k, v in self._memo.items()
+                           if k in in_use])
+        self._cipher = res
+        self.ava = {}
+        if self.eager:
+            self.decrypt_all()
+        self.version += 1
+
+    def decrypt_all(self):
+        """
+        Decrypts everything that hasn't been decrypted before. If there is
+        much to do the work is spread over a number of processes.
+        """
+        todo = sorted([(entid, val["text"])
+                       for entid, val in self._cipher.items()
+                       if self.memo_key(val, entid) not in self._memo])
+        processes = self.processes or multiprocessing.cpu_count()
+        if processes < 2 or len(todo) < MIN_PARALLEL:
+            for entid, _ in todo:
+                self.entity(entid)
+            return
+
+        start = time.time()
+        pems = [k.key.exportKey("PEM") for k in self.dkeys
+                if k is not None and k.key is not None]
+        pool = multiprocessing.Pool(processes, _init_worker, (pems,))
+        try:
+            # map keeps the order, so the result doesn't depend on which
+            # process was fastest
+            results = pool.map(_decrypt_worker, todo,
+                               max(1, len(todo) // (processes * 4)))
+        finally:
+            pool.close()
+            pool.join()
+
+        for (entid, text), (secret, err) in zip(todo, results):
+            if err is not None:
+                logger.warning(
+                    'The secrets in the metadata cannot be used for the '
+                    'sp: %s (%s)' % (entid, err))
+            self._memo[self.memo_key({"text": text}, entid)] = secret
+            self.ava[entid] = secret
+        self.decryptions += len(todo)
+        logger.info("Decrypted %d consumer infos in %d processes in %.3f "
+                    "seconds" % (len(todo), processes, time.time() - start))
 
-            for sp in item["spsso_descriptor"]:
-                if "extensions" not in sp:
-                    continue
+    def memo(self):
+        """ What has been decrypted so far, can be given to a new instance """
+        return dict(self._memo)
 
-                for elem in sp["extensions"]["extension_elements"]:
-                    if elem["__class__"] == ENTITY_ATTR:
-                        for attr in elem["attribute"]:
-                            if attr["name"] == ATTR_NAME:
-                                for val in attr["attribute_value"]:
-                                    res[entid] = self.decrypt_client_secrets(
-                                        jwe, val, entid)
-        self.ava.update(res)
+    def stats(self):
+        return {"entities": len(self._cipher), "decrypted": len(self._memo),
+                "decryptions": self.decryptions}
 
 
 class ConsumerInfo(object):
+    """
+    Finds the consumer key and secret to use for a social service and an SP.
+    SP specific information in any source is preferred over defaults, and
+    earlier sources are preferred over later ones. All sources are merged
+    into one index that is rebuilt when a source has loaded new information.
+    """
+
     def __init__(self, spec, **kwargs):
         self.info = []
         for sp in spec:
@@ -116,22 +455,82 @@ class ConsumerInfo(object):
                 self.info.append(FileInfo(sp[5:], **kwargs))
             elif sp == "metadata":
                 self.info.append(MetadataInfo(**kwargs))
+        # (social service, entity id) -> (key, secret), the defaults are
+        # kept with None as entity id and (None, entity id) marks that the
+        # information about an SP has been added
+        self._index = {}
+        self._versions = None
+        self._lock = threading.Lock()
+        self.rebuilds = 0
+        # Called when the consumer info has changed
+        self.listeners = []
 
-    def __call__(self, social_service, entity_id):
-        default = {}
-        logger.debug("Consumer info for %s/%s" % (social_service, entity_id))
-        for src in self.info:
+    def build_index(self):
+        """ The index initially only holds the defaults, information about
+        an SP is added the first time it is asked for """
+        index = {}
+        # Later sources are overwritten by earlier ones
+        for src in reversed(self.info):
+            self._add(index, src.entity("DEFAULT"), None)
+        return index
+
+    @staticmethod
+    def _add(index, services, entity_id):
+        if not isinstance(services, dict):
+            return
+        for service, cred in services.items():
             try:
-                ix, di = src.get_consumer_key_and_secret(social_service,
-                                                         entity_id)
-                if ix:
-                    return di["key"], di["secret"]
-                elif not default:
-                    default = di
-            except KeyError, err:
-                pass
+                index[(service, entity_id)] = (cred["key"], cred["secret"])
+            except (KeyError, TypeError):
+                logger.warning("Faulty consumer info for %s/%s" % (
+                    service, entity_id))
+
+    def _resolve(self, index, entity_id):
+        for src in reversed(self.info):
+            self._add(index, src.entity(entity_id), entity_id)
+        # Marks the SP as done
+        index[(None, entity_id)] = None
 
-        if default:
-            return default["key"], default["secret"]
-        else:
-            raise KeyError
+    def _current(self):
+        for src in self.info:
+            src.update()
+        versions = [(id(src), src.version) for src in self.info]
+        if versions != self._versions:
+            with self._lock:
+                if versions != self._versions:
+                    self._index = self.build_index()
+                    self._versions = versions
+                    self.rebuilds += 1
+                    logger.debug("Consumer info index: %d entries" % len(
+                        self._index))
+                    for func in self.listeners:
+                        func()
+        return self._index
+
+    def stats(self):
+        res = [src.stats() for src in self.info if hasattr(src, "stats")]
+        res.append({"index": len(self._index), "rebuilds": self.rebuilds})
+        return res
+
+    def __call__(self, social_service, entity_id):
+        """
+        :return: A (key, secret) tuple
+        :raise: KeyError if there is no consumer info for the social service
+        """
+        index = self._current()
+        res = index.get((social_service, entity_id))
+        if res is None:
+            if (None, entity_id) not in index:
+                # Resolving may mean decrypting or fetching metadata, which
+                # mustn't hold up lookups for other SPs. Two threads may do
+                # the same work, they get the same result.
+                entries = {}
+                self._resolve(entries, entity_id)
+                with self._lock:
+                    index.update(entries)
+                res = index.get((social_service, entity_id))
+        if res is None:
+            res = index.get((social_service, None))
+            if res is None:
+                raise KeyError(social_service)
+        return res
@@ -0,0 +1,103 @@
+"""
+A minimal in-process stand-in for a memcached server. It speaks enough of
+the memcached text protocol for the memcache client used by the session
+cache: get, gets, set, add, replace, delete, flush_all and version.
+"""
+import time
+import threading
+import SocketServer
+
+# Expiration times larger than this are absolute unix times
+MAX_RELATIVE = 60 * 60 * 24 * 30
+
+
+class Handler(SocketServer.StreamRequestHandler):
+    def _reply(self, line):
+        self.wfile.write(line + "\r\n")
+
+    def _get(self, key):
+        try:
+            flags, expires, data = self.server.data[key]
+        except KeyError:
+            return None
+        if expires and expires <= time.time():
+            del self.server.data[key]
+            return None
+        return flags, data
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.split()
+            if not parts:
+                continue
+            cmd = parts[0]
+
+            with self.server.lock:
+                if cmd in ["get", "gets"]:
+                    for key in parts[1:]:
+                        item = self._get(key)
+                        if item is not None:
+                            flags, data = item
+                            self._reply("VALUE %s %s %d" % (key, flags,
+                                                            len(data)))
+                            self._reply(data)
+                    self._reply("END")
+                elif cmd in ["set", "add", "replace"]:
+                    key, flags, exptime, size = parts[1:5]
+                    data = self.rfile.read(int(size) + 2)[:-2]
+                    exptime = int(exptime)
+                    if 0 < exptime <= MAX_RELATIVE:
+                        exptime += time.time()
+                    exists = self._get(key) is not None
+                    if (cmd == "add" and exists) or (
+                            cmd == "replace" and not exists):
+                        reply = "NOT_STORED"
+                    else:
+                        self.server.data[key] = (flags, exptime, data)
+                        reply = "STORED"
+                    if "noreply" not in parts:
+                        self._reply(reply)
+                elif cmd == "delete":
+                    if self._get(parts[1]) is not None:
+                        del self.server.data[parts[1]]
+                        reply = "DELETED"
+                    else:
+                        reply = "NOT_FOUND"
+                    if "noreply" not in parts:
+                        self._reply(reply)
+                elif cmd == "flush_all":
+                    self.server.data.clear()
+                    self._reply("OK")
+                elif cmd == "version":
+                    self._reply("VERSION 1.4.0-fake")
+                elif cmd == "quit":
+                    return
+                else:
+                    self._reply("ERROR")
+
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=("127.0.0.1", 0)):
+        SocketServer.TCPServer.__init__(self, address, Handler)
+        self.data = {}
+        self.lock = threading.Lock()
+
+    @property
+    def address(self):
+        return "%s:%d" % self.server_address
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
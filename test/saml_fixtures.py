@@ -0,0 +1,56 @@
+"""
+SP metadata and IdP configuration shared by the tests that need a
+saml2.server.Server or metadata files to load.
+"""
+import os
+import sys
+
+SP = """<?xml version="1.0"?>
+<ns0:EntityDescriptor xmlns:ns0="urn:oasis:names:tc:SAML:2.0:metadata"
+    %sentityID="%s">
+  <ns0:SPSSODescriptor
+      protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol">
+    <ns0:AssertionConsumerService Location="%s"
+        Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST"
+        index="0"/>
+  </ns0:SPSSODescriptor>
+</ns0:EntityDescriptor>
+"""
+
+CONFIG = """CONFIG = {
+    "entityid": "https://idp.example.com/idp.xml",
+    "service": {"idp": {"name": "Test IdP"}},
+    "metadata": {"local": [%r]},
+    # Nothing is signed by xmlsec1 so any existing file will do
+    "xmlsec_binary": %r,
+}
+"""
+
+
+def sp_metadata(entity_id="https://sp.example.com",
+                acs="https://sp.example.com/acs", valid_until=None):
+    """
+    :param entity_id: The SP's entity ID
+    :param acs: Where its assertion consumer service is
+    :param valid_until: If given, the validUntil of the entity descriptor
+    :return: The metadata as a string
+    """
+    if valid_until:
+        valid_until = 'validUntil="%s" ' % valid_until
+    else:
+        valid_until = ""
+    return SP % (valid_until, entity_id, acs)
+
+
+def write_config(tmpdir, name, md_file):
+    """
+    Writes an IdP configuration that uses the metadata in md_file.
+
+    :param tmpdir: Where the configuration is written
+    :param name: The module name, it should be unique per test module
+    :param md_file: The SP metadata file
+    :return: The configuration file name
+    """
+    config_file = os.path.join(tmpdir, name + ".py")
+    open(config_file, "w").write(CONFIG % (md_file, sys.executable))
+    return config_file
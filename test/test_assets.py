@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+
+from idpproxy.assets import AssetCache
+from idpproxy.assets import gzip_compress
+
+
+class StartResponse(object):
+    def __init__(self):
+        self.status = None
+        self.headers = None
+
+    def __call__(self, status, headers):
+        self.status = status
+        self.headers = dict(headers)
+
+
+def _request(cache, path, **kwargs):
+    environ = {"REQUEST_METHOD": "GET", "wsgi.url_scheme": "http",
+               "HTTP_HOST": "localhost", "PATH_INFO": path}
+    environ.update(kwargs)
+    start_response = StartResponse()
+    body = cache(environ, start_response, path)
+    return start_response, "".join(body)
+
+
+def test_conditional_and_encoding():
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, "style.css")
+    content = "body { color: black; }\n" * 100
+    open(path, "w").write(content)
+    try:
+        cache = AssetCache()
+        assert cache.preload(tmpdir) == 1
+
+        resp, body = _request(cache, path)
+        assert resp.status == "200 OK"
+        assert body == content
+        assert resp.headers["Content-Type"] == "text/css"
+        etag = resp.headers["ETag"]
+
+        resp, body = _request(cache, path, HTTP_IF_NONE_MATCH=etag)
+        assert resp.status == "304 Not Modified"
+        assert body == ""
+
+        resp, body = _request(
+            cache, path,
+            HTTP_IF_MODIFIED_SINCE=resp.headers["Last-Modified"])
+        assert resp.status == "304 Not Modified"
+
+        resp, body = _request(cache, path, HTTP_ACCEPT_ENCODING="gzip")
+        assert resp.status == "200 OK"
+        assert resp.headers["Content-Encoding"] == "gzip"
+        assert resp.headers["ETag"] != etag
+        assert body == gzip_compress(content)
+
+        resp, body = _request(cache, path,
+                              HTTP_ACCEPT_ENCODING="gzip;q=0, deflate")
+        assert "Content-Encoding" not in resp.headers
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_reload_and_missing():
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, "policy.html")
+    open(path, "w").write("<html>v1</html>")
+    try:
+        cache = AssetCache(check_interval=-1)
+        resp, body = _request(cache, path)
+        assert body == "<html>v1</html>"
+
+        open(path, "w").write("<html>version 2</html>")
+        resp, body = _request(cache, path)
+        assert body == "<html>version 2</html>"
+
+        os.unlink(path)
+        resp, body = _request(cache, path)
+        assert resp.status.startswith("404")
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,48 @@
+from saml2 import BINDING_HTTP_POST
+from saml2 import BINDING_HTTP_REDIRECT
+from saml2 import SAMLError
+
+from idpproxy.binding import BindingCache
+
+SP = "https://sp.example.com"
+
+
+class Metadata(object):
+    post_load_process = None
+
+
+class FakeIdP(object):
+    def __init__(self):
+        self.metadata = Metadata()
+        self.calls = 0
+
+    def pick_binding(self, service, bindings=None, entity_id=""):
+        self.calls += 1
+        if entity_id != SP:
+            raise SAMLError("Unkown entity or unsupported bindings")
+        return (bindings or [BINDING_HTTP_POST])[0], "%s/%s" % (SP, service)
+
+
+def test_binding_cache():
+    idp = FakeIdP()
+    cache = BindingCache(idp)
+    bindings = [BINDING_HTTP_REDIRECT, BINDING_HTTP_POST]
+
+    assert cache("assertion_consumer_service", entity_id=SP) == (
+        BINDING_HTTP_POST, SP + "/assertion_consumer_service")
+    cache("assertion_consumer_service", entity_id=SP)
+    assert cache("single_logout_service", bindings, entity_id=SP)[0] == \
+        BINDING_HTTP_REDIRECT
+    assert idp.calls == 2
+
+    try:
+        cache("assertion_consumer_service", entity_id="https://unknown")
+        assert False
+    except SAMLError:
+        pass
+    assert cache.stats() == {"size": 2, "hits": 1, "misses": 3}
+
+    # Reloaded metadata
+    idp.metadata.post_load_process()
+    cache("assertion_consumer_service", entity_id=SP)
+    assert idp.calls == 4
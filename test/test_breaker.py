@@ -0,0 +1,66 @@
+from idpproxy.social.breaker import CircuitBreaker
+from idpproxy.social.breaker import CircuitOpen
+from idpproxy.social.breaker import CLOSED
+from idpproxy.social.breaker import OPEN
+from idpproxy.social.transport import ProviderTransport
+
+
+class Response(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.status_code = 200
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        if self.status_code is None:
+            raise IOError("Connection refused")
+        return Response(self.status_code)
+
+
+def test_breaker():
+    breaker = CircuitBreaker("Dummy", min_calls=4, error_rate=0.5,
+                             open_time=0)
+    for _ in range(3):
+        breaker.failure()
+    # Not enough calls yet
+    assert breaker.state == CLOSED
+    breaker.success()
+    breaker.failure()
+    assert breaker.state == OPEN
+    assert breaker.stats() == {"state": OPEN, "calls": 5, "failures": 4}
+
+    # open_time is 0 so one trial call is allowed
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.success()
+    assert breaker.state == CLOSED
+
+
+def test_provider_transport():
+    breaker = CircuitBreaker("Dummy", min_calls=3, open_time=60)
+    fake = FakeTransport()
+    transport = ProviderTransport(fake, breaker)
+
+    assert transport.request("GET", "https://example.com").status_code == 200
+    fake.status_code = 503
+    transport.request("GET", "https://example.com")
+    fake.status_code = None
+    try:
+        transport.request("GET", "https://example.com")
+        assert False
+    except IOError:
+        pass
+    assert not transport.available()
+
+    # Fails without calling the provider
+    try:
+        transport.request("GET", "https://example.com")
+        assert False
+    except CircuitOpen:
+        pass
+    assert fake.calls == 3
@@ -0,0 +1,182 @@
+import os
+import time
+import shutil
+import tempfile
+
+import fake_memcached
+
+from idpproxy import cache
+
+
+def test_memory_store_expiry():
+    store = cache.MemoryStore(lifetime=1)
+    store["a"] = {"entity_id": "sp"}
+    assert "a" in store
+    assert store["a"] == {"entity_id": "sp"}
+
+    # Pretend the entry was written more than a minute ago
+    store._db["a"] = (time.time() - 1, store._db["a"][1])
+    assert "a" not in store
+    try:
+        _ = store["a"]
+        assert False
+    except KeyError:
+        pass
+    assert store.stats()["expirations"] == 1
+
+
+def test_memory_store_sweep():
+    store = cache.MemoryStore(lifetime=1, sweep_interval=2)
+    store["a"] = 1
+    store["b"] = 2
+    store._db["a"] = (time.time() - 1, 1)
+    store["c"] = 3
+    store["d"] = 4
+    assert len(store) == 3
+    assert sorted(store.keys()) == ["b", "c", "d"]
+
+
+def test_memory_store_size_cap():
+    store = cache.MemoryStore(max_size=2)
+    store["a"] = 1
+    store["b"] = 2
+    store["a"] = 3
+    store["c"] = 4
+    assert sorted(store.keys()) == ["a", "c"]
+
+    _ = store["a"]
+    try:
+        _ = store["b"]
+    except KeyError:
+        pass
+    stats = store.stats()
+    assert stats["evictions"] == 1
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+    assert stats["hit_rate"] == 0.5
+
+
+def test_cache():
+    _cache = cache.factory("memory", "idpproxy", "secret")
+    sid = _cache.sid()
+    _cache[sid] = {"entity_id": "sp"}
+    _cache.alternate_sid(sid, "state")
+    assert _cache.alt_id["state"] == sid
+
+    name, value = _cache.create_cookie(sid, path="/facebook", expire=60)
+    assert _cache.known_as(value) == sid
+
+
+def test_sqlite_store():
+    tmpdir = tempfile.mkdtemp()
+    filename = os.path.join(tmpdir, "session.db")
+    try:
+        store = cache.SQLiteStore(filename, lifetime=1, sweep_interval=2)
+        store["a"] = {"entity_id": "sp"}
+        assert "a" in store
+        assert store["a"] == {"entity_id": "sp"}
+
+        # Survives being reopened
+        store = cache.SQLiteStore(filename, lifetime=1, sweep_interval=2)
+        assert store["a"] == {"entity_id": "sp"}
+
+        store._connection().execute(
+            "UPDATE session SET expires = ? WHERE key = 'a'",
+            (time.time() - 1,))
+        assert "a" not in store
+        assert store.get("a") is None
+        assert len(store) == 1
+
+        store["b"] = 1
+        store["c"] = 2
+        assert len(store) == 2
+        assert sorted(store.keys()) == ["b", "c"]
+
+        del store["b"]
+        store.compact()
+        assert store.keys() == ["c"]
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_file_cache():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        _cache = cache.factory("file:%s" % os.path.join(tmpdir, "cache"),
+                               "idpproxy", "secret")
+        sid = _cache.sid()
+        _cache[sid] = {"entity_id": "sp"}
+        _cache.alternate_sid(sid, "state")
+        assert _cache.alt_id["state"] == sid
+        assert _cache[sid]["entity_id"] == "sp"
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_memcache_cache():
+    server = fake_memcached.Server().start()
+    try:
+        spec = "memcache:['%s']" % server.address
+        _cache = cache.factory(spec, "idpproxy", "secret")
+        sid = _cache.sid()
+        assert sid not in _cache
+
+        _cache[sid] = {"entity_id": "sp"}
+        assert sid in _cache
+        assert _cache[sid] == {"entity_id": "sp"}
+        _cache.alternate_sid(sid, "state")
+        assert _cache.alt_id["state"] == sid
+
+        # Another process sharing the same servers
+        other = cache.factory(spec, "idpproxy", "secret")
+        name, value = _cache.create_cookie(sid, path="/facebook", expire=60)
+        assert other.known_as(value) == sid
+        assert other[sid]["entity_id"] == "sp"
+
+        sid2 = _cache.sid()
+        _cache[sid2] = {"entity_id": "sp2"}
+        res = other.get_multi([sid, sid2, "unknown"])
+        assert res == {sid: {"entity_id": "sp"}, sid2: {"entity_id": "sp2"}}
+
+        del other[sid]
+        assert sid not in _cache
+    finally:
+        server.stop()
+
+
+def test_stateless_cache():
+    _cache = cache.factory("cookie", "idpproxy", "secret")
+    sid = _cache.sid()
+    _cache[sid] = {"entity_id": "sp"}
+    cookie = _cache.create_cookie(sid, path="/facebook", expire=60)
+
+    headers = []
+
+    def start_response(status, _headers, exc_info=None):
+        headers.extend(_headers)
+
+    _start_response = _cache.wrap_start_response(sid, cookie, start_response)
+    # Updated after the cookie was created
+    session = _cache[sid]
+    session["state"] = "abcdef"
+    session["service_info"] = {"name": "x" * 10000}
+    _cache[sid] = session
+    _start_response("302 Found", [("Location", "https://example.com"),
+                                  cookie])
+    assert headers[1][0] == "Set-Cookie"
+    assert headers[1] != cookie
+    # What the social service said isn't kept
+    assert len(headers[1][1]) < cache.MAX_COOKIE_SIZE
+
+    # Another process, that only shares the secret
+    other = cache.factory("cookie", "idpproxy", "secret")
+    other.sid()
+    assert other.known_as(headers[1][1]) == sid
+    assert other[sid] == {"entity_id": "sp", "state": "abcdef"}
+
+    # The old cookie does not contain the state
+    assert other.known_as(cookie[1]) == sid
+    assert other[sid] == {"entity_id": "sp"}
+
+    wrong = cache.factory("cookie", "idpproxy", "other secret")
+    assert wrong.known_as(headers[1][1]) is None
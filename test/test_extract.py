@@ -0,0 +1,123 @@
+import os
+import imp
+import shutil
+import tempfile
+
+from StringIO import StringIO
+from xml.etree import cElementTree as ElementTree
+
+extract = imp.load_source(
+    "extract", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "..", "script", "extract.py"))
+
+ENTITY = """  <md:EntityDescriptor entityID="%s">
+    <md:Extensions>
+      <mdrpi:RegistrationInfo registrationAuthority="%s"/>
+      <mdattr:EntityAttributes
+          xmlns:mdattr="urn:oasis:names:tc:SAML:metadata:attribute">
+        <saml:Attribute Name="http://macedir.org/entity-category">
+          <saml:AttributeValue xsi:type="xs:string">%s</saml:AttributeValue>
+        </saml:Attribute>
+      </mdattr:EntityAttributes>
+    </md:Extensions>
+    <md:SPSSODescriptor
+        protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol"/>
+  </md:EntityDescriptor>
+"""
+
+AGGREGATE = """<?xml version="1.0" encoding="UTF-8"?>
+<md:EntitiesDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata"
+    xmlns:mdrpi="urn:oasis:names:tc:SAML:metadata:rpi"
+    xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion"
+    xmlns:xs="http://www.w3.org/2001/XMLSchema"
+    xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+    Name="urn:test:federation" validUntil="2030-01-01T00:00:00Z">
+%s</md:EntitiesDescriptor>
+""" % "".join([
+    ENTITY % ("https://sp1.example.com", "http://fed.example.com", "one"),
+    ENTITY % ("https://sp2.example.com", "http://fed.example.com", "two"),
+    ENTITY % ("https://sp3.example.org", "http://other.example.org", "three"),
+])
+
+
+def _extract(**kwargs):
+    out = StringIO()
+    count = extract.extract(StringIO(AGGREGATE), extract.Filter(**kwargs),
+                            out)
+    return count, out.getvalue()
+
+
+def _entity_ids(xml):
+    tree = ElementTree.fromstring(xml)
+    return [e.get("entityID") for e in tree.findall(extract.ENTITY_DESCRIPTOR)]
+
+
+def test_extract_all():
+    count, xml = _extract()
+    assert count == 3
+    assert _entity_ids(xml) == ["https://sp1.example.com",
+                                "https://sp2.example.com",
+                                "https://sp3.example.org"]
+    tree = ElementTree.fromstring(xml)
+    assert tree.get("Name") == "urn:test:federation"
+    assert tree.get("validUntil") == "2030-01-01T00:00:00Z"
+
+
+def test_extract_filters():
+    count, xml = _extract(ids=["https://sp2.example.com"])
+    assert count == 1
+    assert _entity_ids(xml) == ["https://sp2.example.com"]
+
+    count, xml = _extract(patterns=[r"\.org$"])
+    assert _entity_ids(xml) == ["https://sp3.example.org"]
+
+    count, xml = _extract(patterns=[r"example"],
+                          registrars=["http://fed.example.com"])
+    assert _entity_ids(xml) == ["https://sp1.example.com",
+                                "https://sp2.example.com"]
+
+    count, xml = _extract(registrars=["http://nowhere.example.com"])
+    assert count == 0
+    assert _entity_ids(xml) == []
+
+
+def test_extract_qname_values():
+    # xs is only used in the xsi:type value and mdattr only in element names
+    # of a child, both must still be declared on the entity
+    count, xml = _extract(ids=["https://sp1.example.com"])
+    entity = xml[xml.index("<md:EntityDescriptor"):]
+    entity = entity[:entity.index(">")]
+    assert 'xmlns:xs="http://www.w3.org/2001/XMLSchema"' in entity
+    assert 'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"' in entity
+    assert entity.count("xmlns:mdattr=") <= 1
+    assert entity.count("xmlns:saml=") == 1
+    # Still well formed with no duplicated declarations
+    ElementTree.fromstring(xml)
+
+
+def test_main():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        metadata = os.path.join(tmpdir, "aggregate.xml")
+        with open(metadata, "w") as fil:
+            fil.write(AGGREGATE)
+        ids = os.path.join(tmpdir, "ids")
+        with open(ids, "w") as fil:
+            fil.write("# SPs to keep\n\nhttps://sp1.example.com\n")
+        output = os.path.join(tmpdir, "out.xml")
+
+        extract.main(["-f", ids, "-r", "sp3", "-o", output, metadata,
+                      "https://sp2.example.com"])
+        with open(output) as fil:
+            xml = fil.read()
+        assert xml.startswith('<?xml version="1.0" encoding="UTF-8"?>\n')
+        assert _entity_ids(xml) == ["https://sp1.example.com",
+                                    "https://sp2.example.com",
+                                    "https://sp3.example.org"]
+
+        extract.main(["-r", "sp", "-a", "http://other.example.org",
+                      "-o", output, metadata])
+        with open(output) as fil:
+            assert _entity_ids(fil.read()) == ["https://sp3.example.org"]
+    finally:
+        shutil.rmtree(tmpdir)
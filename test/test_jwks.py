@@ -0,0 +1,84 @@
+import json
+import time
+
+from Crypto.PublicKey import RSA
+
+from jwkest.jwk import RSAKey
+from jwkest.jws import JWS
+
+from idpproxy.social.jwks import JWKSCache
+from idpproxy.social.jwks import IdTokenError
+from idpproxy.social.transport import cache_ttl
+
+ISSUER = "https://accounts.example.com"
+JWKS_URI = "https://accounts.example.com/certs"
+
+
+class Response(object):
+    def __init__(self, text, headers):
+        self.status_code = 200
+        self.text = text
+        self.headers = headers
+
+
+class FakeTransport(object):
+    def __init__(self, keys):
+        self.keys = keys
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        jwks = {"keys": [k.serialize() for k in self.keys]}
+        return Response(json.dumps(jwks), {"Cache-Control": "max-age=600"})
+
+
+def _key(kid):
+    key = RSAKey(key=RSA.generate(1024), kid=kid)
+    key.serialize()
+    return key
+
+
+def _id_token(key, **kwargs):
+    claims = {"iss": ISSUER, "aud": "client", "sub": "1234",
+              "exp": int(time.time()) + 300}
+    claims.update(kwargs)
+    return JWS(json.dumps(claims), alg="RS256").sign_compact([key])
+
+
+def test_cache_ttl():
+    assert cache_ttl({"cache-control": "public, max-age=120"}) == 120
+    assert cache_ttl({"cache-control": "no-cache"}) == 0
+    assert cache_ttl({}, 30) == 30
+
+
+def test_verify():
+    key1 = _key("1")
+    transport = FakeTransport([key1])
+    cache = JWKSCache(transport, min_refresh=0)
+
+    claims = cache.verify(_id_token(key1), JWKS_URI, [ISSUER], "client")
+    assert claims["sub"] == "1234"
+    cache.verify(_id_token(key1), JWKS_URI, [ISSUER], "client")
+    assert transport.calls == 1
+
+    for kwargs in [{"aud": "other"}, {"iss": "https://evil.example.com"},
+                   {"exp": int(time.time()) - 3600}]:
+        try:
+            cache.verify(_id_token(key1, **kwargs), JWKS_URI, [ISSUER],
+                         "client")
+            assert False
+        except IdTokenError:
+            pass
+
+    # A new key is picked up
+    key2 = _key("2")
+    transport.keys.append(key2)
+    cache.verify(_id_token(key2), JWKS_URI, [ISSUER], "client")
+    assert transport.calls == 2
+
+    # Signed with a key that isn't published
+    try:
+        cache.verify(_id_token(_key("1")), JWKS_URI, [ISSUER], "client")
+        assert False
+    except IdTokenError:
+        pass
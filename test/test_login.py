@@ -0,0 +1,44 @@
+import cPickle as pickle
+
+from saml2 import BINDING_HTTP_POST
+from saml2 import BINDING_HTTP_REDIRECT
+from saml2 import samlp
+from saml2.saml import NAMEID_FORMAT_TRANSIENT
+
+from idpproxy.login import LoginContext
+
+
+class Request(object):
+    def __init__(self, message, issuer):
+        self.message = message
+        self.issuer = issuer
+
+    def sender(self):
+        return self.issuer
+
+
+def test_from_request():
+    message = samlp.AuthnRequest(
+        id="id-1234", assertion_consumer_service_url="https://sp/acs",
+        protocol_binding=BINDING_HTTP_POST,
+        name_id_policy=samlp.NameIDPolicy(format=NAMEID_FORMAT_TRANSIENT,
+                                          allow_create="true"))
+    ctx = LoginContext.from_request(Request(message, "https://sp"),
+                                    BINDING_HTTP_REDIRECT, "relay")
+
+    for _ctx in [ctx, pickle.loads(pickle.dumps(ctx, 0)),
+                 pickle.loads(pickle.dumps(ctx, pickle.HIGHEST_PROTOCOL))]:
+        assert _ctx.id == "id-1234"
+        assert _ctx.sender() == "https://sp"
+        assert _ctx.binding == BINDING_HTTP_REDIRECT
+        assert _ctx.relay_state == "relay"
+        policy = _ctx.name_id_policy
+        assert policy.format == NAMEID_FORMAT_TRANSIENT
+        assert policy.allow_create == "true"
+
+
+def test_no_name_id_policy():
+    message = samlp.AuthnRequest(id="id-1234")
+    ctx = LoginContext.from_request(Request(message, "https://sp"))
+    assert ctx.name_id_policy is None
+    assert ctx.relay_state == ""
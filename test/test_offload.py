@@ -0,0 +1,69 @@
+import time
+import threading
+
+from idpproxy.social.offload import OffloadQueue
+from idpproxy.social.offload import please_wait
+
+
+def _wait(queue, key, func, args):
+    for _ in range(100):
+        res = queue(key, func, args)
+        if res is not None:
+            return res
+        time.sleep(0.01)
+    raise AssertionError("Job never finished")
+
+
+def test_offload():
+    queue = OffloadQueue(workers=2, wait=0.01)
+    event = threading.Event()
+
+    def slow(val):
+        event.wait()
+        return val * 2
+
+    assert queue("sid1", slow, (2,)) is None
+    # Still running
+    assert queue("sid1", slow, (2,)) is None
+    event.set()
+    assert _wait(queue, "sid1", slow, (2,)) == 4
+    assert queue.stats()["jobs"] == 0
+
+
+def test_offload_fast():
+    queue = OffloadQueue(workers=1)
+    # Answered at once, the user agent doesn't have to come back
+    assert queue("sid1", lambda val: val * 2, (2,)) == 4
+    assert queue.stats()["jobs"] == 0
+
+
+def test_offload_error():
+    queue = OffloadQueue(workers=1)
+
+    def fail():
+        raise ValueError("Provider down")
+
+    try:
+        _wait(queue, "sid1", fail, ())
+        assert False
+    except ValueError:
+        pass
+
+
+def test_offload_full():
+    queue = OffloadQueue(workers=1, max_pending=0)
+    # Run in the calling thread
+    assert queue("sid1", lambda: "done", ()) == "done"
+
+
+def test_please_wait():
+    headers = []
+
+    def start_response(status, _headers):
+        headers.extend(_headers)
+
+    environ = {"SCRIPT_NAME": "/proxy", "PATH_INFO": "/facebook",
+               "QUERY_STRING": "code=1&state=2"}
+    body = please_wait(environ, start_response, ("Set-Cookie", "x"))[0]
+    assert 'url=/proxy/facebook?code=1&amp;state=2"' in body
+    assert ("Retry-After", "1") in headers
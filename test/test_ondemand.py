@@ -0,0 +1,118 @@
+import os
+import time
+import shutil
+import tempfile
+import xmldsig
+
+from saml2 import md
+from saml2 import saml
+from saml2.sigver import XmlsecError
+from saml2.time_util import in_a_while
+
+from idpproxy import utils
+from idpproxy.metadata.ondemand import EntityCache
+from idpproxy.metadata.ondemand import MetaDataOnDemand
+from idpproxy.metadata.ondemand import entity_hash
+
+from saml_fixtures import sp_metadata
+
+ONTS = {saml.NAMESPACE: saml, md.NAMESPACE: md,
+        xmldsig.NAMESPACE: xmldsig}
+
+
+def test_entity_cache():
+    cache = EntityCache(max_entities=2)
+    cache["a"] = {"a": 1}
+    cache["b"] = {"b": 1}
+    cache["a"]
+    cache["c"] = {"c": 1}
+    # b was the least recently used
+    assert cache.keys() == ["a", "c"]
+
+    cache["d"] = None
+    assert "d" not in cache
+    assert cache.lookup("d") is None
+    try:
+        cache["d"]
+        assert False
+    except KeyError:
+        pass
+
+    # Expired entities are looked up again
+    cache = EntityCache(lifetime=-1)
+    cache["a"] = {"a": 1}
+    try:
+        cache.lookup("a")
+        assert False
+    except KeyError:
+        pass
+    assert "a" not in cache
+    assert cache.stats() == {"entities": 0, "hits": 0, "misses": 1}
+
+
+def test_metadata_on_demand():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for sp in ["https://sp1.example.com", "https://sp2.example.com"]:
+            open(os.path.join(tmpdir, entity_hash(sp) + ".xml"),
+                 "w").write(sp_metadata(sp))
+
+        mds = MetaDataOnDemand(ONTS, None, tmpdir, max_entities=1)
+        # Nothing is parsed at startup
+        assert mds.keys() == []
+
+        ent = mds["https://sp1.example.com"]
+        assert "spsso_descriptor" in ent
+        assert mds.service("https://sp1.example.com", "spsso_descriptor",
+                           "assertion_consumer_service")
+        assert "https://sp2.example.com" in mds
+        assert mds.keys() == ["https://sp2.example.com"]
+
+        assert "https://unknown.example.com" not in mds
+        stats = mds.stats()
+        assert stats["entities"] == 1
+        assert stats["misses"] == 3
+
+        # The consumer info is looked up on demand too
+        mds.post_load_process = None
+        info = utils.MetadataInfo([None], mds)
+        assert info.entity("https://sp1.example.com") is None
+        assert mds.keys() == ["https://sp1.example.com"]
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+class BrokenSignatures(object):
+    def __init__(self):
+        self.calls = 0
+
+    def verify_signature(self, *args, **kwargs):
+        self.calls += 1
+        raise XmlsecError("Signature is not valid")
+
+
+def test_metadata_on_demand_not_valid():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for sp, until in [("https://old.example.com", "2000-01-01T00:00:00Z"),
+                          ("https://soon.example.com",
+                           in_a_while(seconds=600))]:
+            open(os.path.join(tmpdir, entity_hash(sp) + ".xml"),
+                 "w").write(sp_metadata(sp, valid_until=until))
+
+        mds = MetaDataOnDemand(ONTS, None, tmpdir)
+        assert "https://old.example.com" not in mds
+        # Not used after it stops being valid
+        assert "https://soon.example.com" in mds
+        expires = mds.entity._cache.peek("https://soon.example.com")[0]
+        assert expires <= time.time() + 600
+
+        # A bad signature is logged and remembered, not raised
+        security = BrokenSignatures()
+        mds = MetaDataOnDemand(ONTS, None, tmpdir, cert="cert.pem",
+                               security=security)
+        for _ in range(2):
+            assert "https://soon.example.com" not in mds
+        assert security.calls == 1
+    finally:
+        shutil.rmtree(tmpdir)
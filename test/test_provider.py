@@ -0,0 +1,93 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+
+from oic.oic.message import RegistrationResponse
+
+from idpproxy.social.openidconnect.provider import ProviderCache
+from idpproxy.social.openidconnect.provider import RegistrationStore
+
+ISSUER = "https://op.example.com"
+CALLBACK = "https://proxy.example.com/oic"
+
+
+class Response(object):
+    status_code = 200
+
+    def __init__(self, text, headers):
+        self.text = text
+        self.headers = headers
+
+
+class SlowTransport(object):
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        time.sleep(0.1)
+        info = {"issuer": ISSUER,
+                "registration_endpoint": ISSUER + "/register"}
+        return Response(json.dumps(info),
+                        {"Cache-Control": "max-age=%d" % self.max_age})
+
+
+def test_provider_cache():
+    transport = SlowTransport(600)
+    cache = ProviderCache(transport)
+
+    res = []
+    threads = [threading.Thread(target=lambda: res.append(cache(ISSUER)))
+               for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Concurrent misses gave one fetch
+    assert transport.calls == 1
+    assert len(res) == 5
+    assert res[0]["issuer"] == ISSUER
+    assert cache(ISSUER) is res[0]
+    assert transport.calls == 1
+
+    transport.max_age = 0
+    cache.clear()
+    cache(ISSUER)
+    cache(ISSUER)
+    assert transport.calls == 3
+
+
+def test_registration_store():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, "registrations.json")
+        calls = []
+
+        def register():
+            calls.append(1)
+            return RegistrationResponse(client_id="id%d" % len(calls),
+                                        client_secret="secret",
+                                        client_secret_expires_at=0)
+
+        reg = RegistrationStore(filename)(ISSUER, CALLBACK, register)
+        assert reg["client_id"] == "id1"
+
+        # Another process, or a restart, reuses the registration
+        reg = RegistrationStore(filename)(ISSUER, CALLBACK, register)
+        assert reg["client_id"] == "id1"
+        assert len(calls) == 1
+
+        # An expired registration is renewed
+        regs = json.load(open(filename))
+        for val in regs.values():
+            val["client_secret_expires_at"] = int(time.time())
+        json.dump(regs, open(filename, "w"))
+        reg = RegistrationStore(filename)(ISSUER, CALLBACK, register)
+        assert reg["client_id"] == "id2"
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,68 @@
+import os
+import shutil
+import tempfile
+
+from idpproxy import router
+from idpproxy.assets import AssetCache
+
+SERVICE = {
+    "facebook": {"saml_endpoint": "facebook_sso",
+                 "social_endpoint": "facebook"},
+    "google": {"saml_endpoint": "google_sso",
+               "social_endpoint": "google"},
+}
+
+
+def _server_env(static_dir, metadata_dir):
+    return {"STATIC_DIR": static_dir, "METADATA_DIR": metadata_dir,
+            "service": SERVICE}
+
+
+def test_route():
+    static_dir = tempfile.mkdtemp() + "/"
+    os.mkdir(static_dir + "css")
+    open(static_dir + "favicon.ico", "w").write("ico")
+    open(static_dir + "css/style.css", "w").write("css")
+    try:
+        rtr = router.router_factory(_server_env(static_dir, "nonexistent/"))
+
+        assert rtr("/favicon.ico") == (router.STATIC,
+                                       static_dir + "favicon.ico")
+        assert rtr("/css/style.css") == (router.STATIC,
+                                         static_dir + "css/style.css")
+        assert rtr("/") == (router.BASE, None)
+        assert rtr("/logout") == (router.LOGOUT, None)
+        assert rtr("/logo/facebook.png") == (router.LOGO, None)
+        assert rtr("/metadata") == (router.METADATA, None)
+        assert rtr("/metadata/save") == (router.METADATA, None)
+        assert rtr("/facebook_sso") == (router.SERVICE,
+                                        ("facebook", "begin"))
+        assert rtr("/facebook/abc") == (router.SERVICE,
+                                        ("facebook", "callback"))
+        assert rtr("/google") == (router.SERVICE, ("google", "callback"))
+        assert rtr("/unknown") == (router.UNKNOWN, None)
+    finally:
+        shutil.rmtree(static_dir)
+
+
+def test_static_added_later():
+    static_dir = tempfile.mkdtemp() + "/"
+    try:
+        rtr = router.Router(assets=AssetCache())
+        rtr.add_directory(static_dir)
+        assert rtr("/robots.txt") == (router.UNKNOWN, None)
+
+        open(static_dir + "robots.txt", "w").write("txt")
+        assert rtr("/robots.txt") == (router.STATIC,
+                                      static_dir + "robots.txt")
+
+        # Nothing outside of the directory
+        name = os.path.basename(os.path.dirname(static_dir))
+        open(static_dir + "../" + name + "-secret", "w").write("secret")
+        try:
+            assert rtr("/../%s-secret" % name) == (router.UNKNOWN, None)
+        finally:
+            os.unlink(static_dir + "../" + name + "-secret")
+        assert rtr("/..") == (router.UNKNOWN, None)
+    finally:
+        shutil.rmtree(static_dir)
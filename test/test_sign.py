@@ -0,0 +1,111 @@
+import os
+import re
+
+import pytest
+
+from base64 import b64decode
+
+from Crypto.Hash import SHA
+from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
+
+from saml2 import saml
+from saml2 import samlp
+from saml2 import class_name
+from saml2.sigver import CryptoBackendXmlSec1
+from saml2.sigver import SigverError
+from saml2.sigver import get_xmlsec_binary
+from saml2.sigver import pre_signature_part
+
+etree = pytest.importorskip("lxml.etree")
+
+from idpproxy.sign import InProcessBackend
+
+PKI = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pki")
+KEY_FILE = os.path.join(PKI, "mykey.pem")
+CERT_FILE = os.path.join(PKI, "mycert.pem")
+DS = "{http://www.w3.org/2000/09/xmldsig#}"
+
+
+class Fallback(object):
+    def __init__(self):
+        self.calls = 0
+
+    def sign_statement(self, statement, *args):
+        self.calls += 1
+        return statement
+
+
+def _response():
+    assertion = saml.Assertion(
+        id="id-assertion", version="2.0",
+        issue_instant="2014-01-01T00:00:00Z",
+        issuer=saml.Issuer(text="https://idp.example.com/idp.xml"),
+        signature=pre_signature_part("id-assertion"))
+    return samlp.Response(id="id-response", version="2.0",
+                          issue_instant="2014-01-01T00:00:00Z",
+                          assertion=assertion,
+                          signature=pre_signature_part("id-response"))
+
+
+def _sign(backend, statement):
+    statement = backend.sign_statement(
+        "%s" % statement, class_name(saml.Assertion()), KEY_FILE,
+        "id-assertion", "ID")
+    return backend.sign_statement(
+        statement, class_name(samlp.Response()), KEY_FILE, "id-response",
+        "ID")
+
+
+def _values(signed):
+    """ The digest and signature values, formatting aside """
+    doc = etree.fromstring(signed)
+    return [re.sub(r"\s", "", elem.text) for elem in doc.iter()
+            if elem.tag in [DS + "DigestValue", DS + "SignatureValue"]]
+
+
+def test_sign():
+    fallback = Fallback()
+    backend = InProcessBackend(KEY_FILE, fallback)
+    signed = _sign(backend, _response())
+    assert fallback.calls == 0
+
+    # The response signature is over its canonical SignedInfo
+    doc = etree.fromstring(signed)
+    signed_info = doc.find(DS + "Signature/" + DS + "SignedInfo")
+    data = etree.tostring(signed_info, method="c14n", exclusive=True)
+    verifier = PKCS1_v1_5.new(RSA.importKey(open(KEY_FILE).read()))
+    assert verifier.verify(SHA.new(data), b64decode(
+        doc.find(DS + "Signature/" + DS + "SignatureValue").text))
+
+    # Another key is handed to the fallback
+    backend.sign_statement("%s" % _response(), class_name(samlp.Response()),
+                           "other.pem", "id-response", "ID")
+    assert fallback.calls == 1
+
+
+def test_verify():
+    xmlsec = pytest.importorskip("xmlsec")
+
+    backend = InProcessBackend(KEY_FILE, Fallback())
+    doc = etree.fromstring(_sign(backend, _response()))
+    cert = open(CERT_FILE).read()
+    # Checks the digests of the referenced elements too
+    assert xmlsec.verify(doc, cert)
+
+    # The assertion on its own, as the SP would use it
+    assertion = etree.fromstring(etree.tostring(
+        doc.find("{%s}Assertion" % saml.NAMESPACE)))
+    assert xmlsec.verify(assertion, cert)
+
+
+def test_same_as_xmlsec1():
+    try:
+        xmlsec = CryptoBackendXmlSec1(get_xmlsec_binary())
+    except SigverError:
+        pytest.skip("xmlsec1 isn't installed")
+
+    backend = InProcessBackend(KEY_FILE, xmlsec)
+    # RSA PKCS#1 v1.5 signatures are deterministic
+    assert _values(_sign(backend, _response())) == _values(
+        _sign(xmlsec, _response()))
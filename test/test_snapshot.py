@@ -0,0 +1,54 @@
+import os
+import shutil
+import tempfile
+
+from idpproxy.metadata.snapshot import Snapshot
+
+from saml_fixtures import sp_metadata
+from saml_fixtures import write_config
+
+
+def _acs(conf):
+    return conf.metadata.assertion_consumer_service(
+        "https://sp.example.com")[0]["location"]
+
+
+def test_snapshot():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        md_file = os.path.join(tmpdir, "sp.xml")
+        open(md_file, "w").write(sp_metadata())
+        config_file = write_config(tmpdir, "snapshot_idp_conf", md_file)
+        filename = os.path.join(tmpdir, "metadata.snapshot")
+
+        snap = Snapshot(filename, config_file)
+        conf = snap.config()
+        assert snap.stale
+        assert _acs(conf) == "https://sp.example.com/acs"
+        snap.save(conf.metadata, {("digest", "https://sp.example.com"): 1})
+        assert os.stat(filename).st_mode & 0777 == 0600
+
+        snap = Snapshot(filename, config_file)
+        conf = snap.config()
+        assert not snap.stale
+        assert _acs(conf) == "https://sp.example.com/acs"
+        assert snap.memo == {("digest", "https://sp.example.com"): 1}
+
+        # A snapshot others could have written isn't read
+        os.chmod(filename, 0666)
+        snap = Snapshot(filename, config_file)
+        snap.config()
+        assert snap.stale
+        assert snap.memo == {}
+        os.chmod(filename, 0600)
+
+        # Changed metadata makes the snapshot stale
+        open(md_file, "w").write(
+            sp_metadata(acs="https://sp.example.com/acs2"))
+        snap = Snapshot(filename, config_file)
+        conf = snap.config()
+        assert snap.stale
+        assert snap.memo == {}
+        assert _acs(conf) == "https://sp.example.com/acs2"
+    finally:
+        shutil.rmtree(tmpdir)
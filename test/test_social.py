@@ -0,0 +1,99 @@
+import threading
+
+from idpproxy.social import HandlerRegistry
+from idpproxy.social import Social
+from idpproxy.social.openidconnect import OpenIDConnect
+from idpproxy.social.openidconnect import login_client
+
+SERVICE = {
+    "dummy": {
+        "saml_endpoint": "dummy_sso",
+        "social_endpoint": "dummy",
+        "class": Social,
+        "name": "Dummy",
+    }
+}
+
+
+def test_handler_registry():
+    registry = HandlerRegistry(SERVICE, max_size=2, DOMAIN="example.org")
+
+    handler = registry("dummy", "key", "secret")
+    assert handler.client_id == "key"
+    assert handler.name == "Dummy"
+    assert handler.extra["DOMAIN"] == "example.org"
+    # The configuration is left untouched
+    assert "DOMAIN" not in SERVICE["dummy"]
+
+    assert registry("dummy", "key", "secret") is handler
+    other = registry("dummy", "key2", "secret2")
+    assert other is not handler
+    assert other.client_id == "key2"
+
+    # The one used longest ago is dropped
+    registry("dummy", "key", "secret")
+    registry("dummy", "key3", "secret3")
+    assert registry("dummy", "key", "secret") is handler
+    assert registry("dummy", "key2", "secret2") is not other
+
+    registry.clear()
+    assert registry("dummy", "key", "secret") is not handler
+
+
+class SlowOIC(OpenIDConnect):
+    """ Each call waits for the other one to have started, which only
+    happens if they run at the same time """
+
+    def __init__(self, *args, **kwargs):
+        OpenIDConnect.__init__(self, *args, **kwargs)
+        self.verifying = threading.Event()
+        self.fetching = threading.Event()
+        self.overlapped = []
+
+    def verify_token(self, client, access_token, tokenresp=None):
+        self.verifying.set()
+        self.overlapped.append(self.fetching.wait(5))
+        if access_token == "bad":
+            raise ValueError("Invalid token")
+        return {"user_id": "foo"}
+
+    def get_userinfo(self, client, authresp, access_token, **kwargs):
+        self.fetching.set()
+        self.overlapped.append(self.verifying.wait(5))
+        return {"name": "Foo"}
+
+
+def test_verify_and_get_userinfo():
+    handler = SlowOIC("key", "secret")
+
+    userinfo, inforesp = handler.verify_and_get_userinfo(None, {}, "token")
+    assert handler.overlapped == [True, True]
+    assert userinfo == {"user_id": "foo"}
+    assert inforesp == {"name": "Foo"}
+
+    try:
+        handler.verify_and_get_userinfo(None, {}, "bad")
+        assert False
+    except ValueError:
+        pass
+
+
+def test_login_client():
+    handler = OpenIDConnect("key", "secret", name="OIC",
+                            authorization_endpoint="https://op/authz",
+                            token_endpoint="https://op/token",
+                            userinfo_endpoint="https://op/userinfo")
+    server_env = {}
+    template = handler.client_template(server_env, "https://proxy/oic", {})
+    assert handler.client_template(server_env, "https://proxy/oic",
+                                   {}) is template
+
+    client1 = login_client(template)
+    client2 = login_client(template)
+    client1.grant["state1"] = "grant"
+    client1.state = "state1"
+    assert client2.grant == {}
+    assert client2.state is None
+    assert template.grant == {}
+    assert client2.token_endpoint == "https://op/token"
+    assert client2.client_secret == "secret"
@@ -0,0 +1,87 @@
+import os
+import re
+import sys
+import shutil
+import tempfile
+
+from saml2 import samlp
+from saml2.saml import NAMEID_FORMAT_TRANSIENT
+from saml2.server import Server
+
+from idpproxy.template import ResponseTemplates
+
+from saml_fixtures import sp_metadata
+from saml_fixtures import write_config
+
+IDENTITY = {"givenName": ["Dave"], "sn": u"J\xe4rvinen",
+            "mail": ["dave@example.com", "<dave&co>@example.com"]}
+AUTHN = {"class_ref": "urn:oasis:names:tc:SAML:2.0:ac:classes:Password",
+         "authn_auth": "https://idp.example.com/facebook"}
+POLICY = samlp.NameIDPolicy(format=NAMEID_FORMAT_TRANSIENT,
+                            allow_create="true")
+
+
+class Crypto(object):
+    """ Leaves the signature template as it is """
+
+    def sign_statement(self, statement, node_name, key_file, node_id,
+                       id_attr):
+        return statement
+
+
+def _normalized(xml):
+    """ Without the IDs and timestamps, which differ every time """
+    xml = re.sub(r"id-[a-zA-Z0-9]{17}", "ID", "%s" % xml)
+    return re.sub(r"\d{4}-\d\d-\d\dT\d\d:\d\d:\d\dZ", "INSTANT", xml)
+
+
+def _response(func, idp, identity, sign, issuer=None):
+    return func(identity, "id-request", "https://sp.example.com/acs",
+                "https://sp.example.com", POLICY, "dave", authn=AUTHN,
+                sign_assertion=sign, issuer=issuer)
+
+
+def test_response_templates():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        md_file = os.path.join(tmpdir, "sp.xml")
+        open(md_file, "w").write(sp_metadata())
+        config_file = write_config(tmpdir, "template_idp_conf", md_file)
+        sys.path.insert(0, tmpdir)
+        try:
+            idp = Server(config_file)
+        finally:
+            sys.path.remove(tmpdir)
+        idp.sec.crypto = Crypto()
+        templates = ResponseTemplates(idp)
+
+        for sign in [False, True]:
+            expected = _normalized(_response(idp.create_authn_response, idp,
+                                             IDENTITY, sign))
+            # Made the pysaml2 way, then from the template
+            for _ in range(2):
+                assert _normalized(_response(templates, idp, IDENTITY,
+                                             sign)) == expected
+
+            identity = {"givenName": ["Eve"], "sn": u"M\xf6ller",
+                        "mail": ["eve@example.com", "e'\"ve@example.com"]}
+            assert _normalized(_response(templates, idp, identity, sign)) == \
+                _normalized(_response(idp.create_authn_response, idp,
+                                      identity, sign))
+
+        assert templates.stats() == {"size": 2, "hits": 4, "misses": 2,
+                                     "fallbacks": 0}
+
+        # Another issuer, another template
+        issuer = "https://idp.example.com/twitter"
+        assert _normalized(_response(templates, idp, IDENTITY, True,
+                                     issuer)) == \
+            _normalized(_response(idp.create_authn_response, idp, IDENTITY,
+                                  True, issuer))
+        assert templates.stats()["size"] == 3
+
+        # Reloaded metadata
+        idp.metadata.post_load_process()
+        assert templates.stats()["size"] == 0
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,67 @@
+import threading
+import BaseHTTPServer
+
+import oauth2 as oauth
+
+from urlparse import parse_qs
+from urlparse import urlparse
+
+from idpproxy.social.transport import Transport
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.seen.append((self.client_address[1], self.path))
+        body = "oauth_token=abc&oauth_token_secret=def"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _server():
+    srv = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), Handler)
+    srv.seen = []
+    thread = threading.Thread(target=srv.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return srv, "http://127.0.0.1:%d" % srv.server_address[1]
+
+
+def test_connection_reuse():
+    srv, url = _server()
+    try:
+        transport = Transport(pool_size=2, idle_timeout=60)
+        for _ in range(3):
+            assert transport.request("GET", url + "/").status_code == 200
+        # all the requests went over the same connection
+        assert len(set([port for port, _ in srv.seen])) == 1
+
+        transport.idle_timeout = -1
+        transport.request("GET", url + "/")
+        assert len(set([port for port, _ in srv.seen])) == 2
+        transport.clear()
+    finally:
+        srv.shutdown()
+
+
+def test_oauth_request():
+    srv, url = _server()
+    try:
+        transport = Transport()
+        consumer = oauth.Consumer("key", "secret")
+        resp, content = transport.oauth_request(consumer, url + "/token")
+        assert resp["status"] == "200"
+        assert parse_qs(content)["oauth_token"] == ["abc"]
+
+        query = parse_qs(urlparse(srv.seen[0][1]).query)
+        assert query["oauth_consumer_key"] == ["key"]
+        assert "oauth_signature" in query
+        transport.clear()
+    finally:
+        srv.shutdown()
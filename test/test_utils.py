@@ -9,4 +9,186 @@ ci = utils.ConsumerInfo(spec)
 key, sec = ci("Google", "foobar")
 
 assert key == "lingon"
-assert sec == "aaaaa"
\ No newline at end of file
+assert sec == "aaaaa"
+
+def test_file_info_reload():
+    import os
+    import tempfile
+
+    fd, name = tempfile.mkstemp()
+    try:
+        os.write(fd, '{"DEFAULT": {"Google": {"key": "a", "secret": "b"}}}')
+        os.close(fd)
+        info = utils.FileInfo(name, check_interval=0)
+        assert info.get_consumer_key_and_secret("Google", "sp") == (
+            0, {"key": "a", "secret": "b"})
+        assert info.version == 1
+        # Nothing has changed
+        assert not info.update()
+
+        open(name, "w").write('{"sp": {"Google": {"key": "c", "secret": "d"}}}')
+        os.utime(name, (0, 0))
+        assert info.update()
+        assert info.get_consumer_key_and_secret("Google", "sp") == (
+            1, {"key": "c", "secret": "d"})
+
+        # Code is not executed, the old information is kept
+        open(name, "w").write('__import__("os").getcwd()')
+        os.utime(name, (1, 1))
+        assert not info.update()
+        assert info.version == 2
+        assert "sp" in info.ava
+    finally:
+        os.unlink(name)
+
+
+def test_consumer_info_index():
+    import os
+    import tempfile
+
+    names = []
+    for content in ['{"DEFAULT": {"Google": {"key": "a", "secret": "b"}}}',
+                    '{"DEFAULT": {"Google": {"key": "x", "secret": "y"}},'
+                    ' "sp": {"Google": {"key": "c", "secret": "d"}}}']:
+        fd, name = tempfile.mkstemp()
+        os.write(fd, content)
+        os.close(fd)
+        names.append(name)
+    try:
+        info = utils.ConsumerInfo(["file:%s" % n for n in names])
+        changes = []
+        info.listeners.append(lambda: changes.append(1))
+        assert info("Google", "sp") == ("c", "d")
+        assert info("Google", "other") == ("a", "b")
+        try:
+            info("Facebook", "sp")
+            assert False
+        except KeyError:
+            pass
+        assert info.rebuilds == 1
+
+        info.info[0].ava = {"sp": {"Google": {"key": "e", "secret": "f"}}}
+        info.info[0].version += 1
+        assert info("Google", "sp") == ("e", "f")
+        assert info("Google", "other") == ("x", "y")
+        assert info.rebuilds == 2
+        assert len(changes) == 2
+    finally:
+        for name in names:
+            os.unlink(name)
+
+
+class FakeMetadata(dict):
+    post_load_process = None
+
+
+def _sp(text):
+    return {"spsso_descriptor": [{"extensions": {"extension_elements": [
+        {"__class__": utils.ENTITY_ATTR,
+         "attribute": [{"name": utils.ATTR_NAME,
+                        "attribute_value": [{"text": text}]}]}]}}]}
+
+
+def test_metadata_info_lazy():
+    import json
+    from Crypto.PublicKey import RSA
+    from jwkest.jwk import RSAKey
+    from jwkest.jwe import JWE
+
+    key = RSAKey(key=RSA.generate(1024))
+    secret = {"Google": {"key": "a", "secret": "b"}}
+    texts = {}
+    for sp in ["sp1", "sp2"]:
+        msg = json.dumps({"entityId": [sp], "secret": secret})
+        texts[sp] = JWE(msg, alg="RSA-OAEP",
+                        enc="A128CBC-HS256").encrypt([key])
+
+    metad = FakeMetadata([(sp, _sp(text)) for sp, text in texts.items()])
+    info = utils.MetadataInfo([key], metad)
+    assert metad.post_load_process is info
+    assert info.decryptions == 0
+
+    ci = utils.ConsumerInfo([])
+    ci.info.append(info)
+    assert ci("Google", "sp1") == ("a", "b")
+    assert ci("Google", "sp1") == ("a", "b")
+    assert info.decryptions == 1
+
+    # Reloading unchanged metadata doesn't decrypt again
+    metad.post_load_process()
+    assert ci("Google", "sp1") == ("a", "b")
+    assert info.decryptions == 1
+
+    eager = utils.MetadataInfo([key], metad, eager=True)
+    assert eager.decryptions == 2
+
+
+def test_metadata_info_parallel():
+    import json
+    from Crypto.PublicKey import RSA
+    from jwkest.jwk import RSAKey
+    from jwkest.jwe import JWE
+
+    key = RSAKey(key=RSA.generate(1024))
+    metad = FakeMetadata()
+    for i in range(6):
+        sp = "sp%d" % i
+        msg = json.dumps({"entityId": [sp],
+                          "secret": {"Google": {"key": sp, "secret": "s"}}})
+        metad[sp] = _sp(JWE(msg, alg="RSA-OAEP",
+                            enc="A128CBC-HS256").encrypt([key]))
+    metad["broken"] = _sp("not a JWE")
+
+    _min = utils.MIN_PARALLEL
+    utils.MIN_PARALLEL = 2
+    try:
+        info = utils.MetadataInfo([key], metad, eager=True, processes=2)
+    finally:
+        utils.MIN_PARALLEL = _min
+
+    assert info.decryptions == 7
+    assert info.ava["broken"] is None
+    for i in range(6):
+        assert info.ava["sp%d" % i] == {"Google": {"key": "sp%d" % i,
+                                                   "secret": "s"}}
+    # Nothing left to do
+    info.decrypt_all()
+    assert info.decryptions == 7
+
+
+def test_consumer_info_resolve_unlocked():
+    import threading
+
+    class SlowInfo(utils.Info):
+        """ Looking up "slow" takes until the event is set """
+
+        def __init__(self):
+            utils.Info.__init__(self)
+            self.ava = {"slow": {"Google": {"key": "s", "secret": "t"}},
+                        "fast": {"Google": {"key": "f", "secret": "g"}}}
+            self.started = threading.Event()
+            self.event = threading.Event()
+            self.waited = None
+
+        def entity(self, entity_id):
+            if entity_id == "slow":
+                self.started.set()
+                self.waited = self.event.wait(5)
+            return self.ava.get(entity_id)
+
+    src = SlowInfo()
+    ci = utils.ConsumerInfo([])
+    ci.info.append(src)
+    res = []
+    thread = threading.Thread(target=lambda: res.append(ci("Google",
+                                                           "slow")))
+    thread.start()
+    try:
+        src.started.wait(5)
+        # Not held up by the lookup of the other SP
+        assert ci("Google", "fast") == ("f", "g")
+    finally:
+        src.event.set()
+        thread.join()
+    assert src.waited
+    assert res == [("s", "t")]